@@ -2,27 +2,44 @@ import streamlit as st
 import sys
 import os
 import base64
-import pandas as pd
 import hashlib
 import calendar as cal_module
 import time
+import functools
 from datetime import datetime, timedelta
-import plotly.graph_objects as go
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "src"))
 from gemini_api import (
     calculate_vms_science, get_serving_scale, get_scientific_db,
     search_vantage_db, search_open_food_facts, vision_live_scan_dark,
-    generate_health_insights, generate_meal_plan, generate_daily_recipes,
-    get_db_connection, get_trend_data_db, get_all_calendar_data_db,
+    get_health_insights, peek_health_insights, health_insights_key, generate_meal_plan, get_daily_recipes, generate_daily_recipes,
+    generate_meal_plan_streaming, MEAL_PLAN_DAYS, MEAL_PLAN_MODE,
+    peek_daily_recipes, start_recipe_pregeneration, start_db_maintenance,
+    get_db_connection, get_trend_chart_db, count_calendar_items_db, get_month_summary_db,
     get_gemini_api_key, authenticate_user,
     add_calendar_item_db, get_calendar_items_db, delete_item_db,
-    get_log_history_db, create_user
+    get_log_history_db, get_log_history_page_db, LOG_PAGE_SIZE, AGENT_HISTORY_LIMIT, create_user,
+    export_calendar_file, import_calendar_db, get_storage_metrics, get_read_cache_metrics
 )
+import metrics
+import profiler
+from logs import get_logger, get_context, set_context, new_id
+from meal_planner import plan_meals_local, start_meal_planner_warmup
 from streamlit_back_camera_input import back_camera_input
 
 st.set_page_config(page_title="FoodVantage", page_icon="🥗", layout="wide", initial_sidebar_state="expanded")
 
+# Optional: keep tomorrow's shared recipes generated ahead of time (one thread per process)
+if os.getenv("FOODVANTAGE_PREGENERATE_RECIPES") == "1":
+    start_recipe_pregeneration()
+start_meal_planner_warmup()
+start_db_maintenance()
+metrics.start_metrics_server()  # only with FOODVANTAGE_METRICS_PORT set
+
+# Users who see the 📊 Metrics page (comma-separated usernames)
+ADMIN_USERS = {u.strip() for u in os.getenv("FOODVANTAGE_ADMIN_USERS", "").split(",") if u.strip()}
+
 # --- SESSION STATE ---
 # FIX 1: NO LOGIN PAGE - Direct to main app
 if 'logged_in' not in st.session_state: st.session_state.logged_in = True
@@ -39,17 +56,67 @@ if 'scan_status' not in st.session_state: st.session_state.scan_status = None
 if 'detected_items' not in st.session_state: st.session_state.detected_items = []
 # AI Agent state
 if 'ai_insights' not in st.session_state: st.session_state.ai_insights = None
+if 'ai_insights_key' not in st.session_state: st.session_state.ai_insights_key = None  # (days, digest) the insights were built for
 if 'meal_plan' not in st.session_state: st.session_state.meal_plan = None
+if 'meal_plan_source' not in st.session_state: st.session_state.meal_plan_source = None
+if 'log_cursors' not in st.session_state: st.session_state.log_cursors = [None]  # keyset cursor of each visited Log page
 if 'daily_recipes' not in st.session_state: st.session_state.daily_recipes = None
 if 'recipes_date' not in st.session_state: st.session_state.recipes_date = None
+if 'calendar_picks' not in st.session_state: st.session_state.calendar_picks = 0  # items added from calendar search
+if 'scan_logged' not in st.session_state: st.session_state.scan_logged = False  # shows "Added!" after the full rerun a log triggers
+if 'log_export' not in st.session_state: st.session_state.log_export = None  # (format, file path, prepared at) from "Prepare export"
+
+# --- LOG CONTEXT ---
+# Every log line of a script run carries its session, a run ID and the user (see src/logs.py)
+log = get_logger("app")
+
+def start_log_run():
+    script = get_script_run_ctx()
+    set_context(session=script.session_id if script else None, run=new_id(), user=st.session_state.get("user_id"))
+
+start_log_run()
+profiler.start_run(page=st.session_state.page)  # when armed from the 📊 Metrics page; finish_run() at the end
 
 # --- BACKGROUND IMAGE ---
+# Converted once per process to a small WebP under static/ and served by Streamlit's static file
+# server (server.enableStaticServing), so the CSS refers to it by URL and the browser caches it,
+# instead of every rerun reading, base64-encoding and hashing the PNG inline.
+# A WebP already under static/ that is newer than the PNG is reused, so a restart doesn't re-encode it.
 _bg_path = os.path.join(os.path.dirname(__file__), "assets", "image_1010.png")
-if os.path.exists(_bg_path):
-    with open(_bg_path, "rb") as _f:
-        _bg_b64 = base64.b64encode(_f.read()).decode()
-else:
-    _bg_b64 = ""
+STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
+
+@st.cache_resource
+def get_background_url(max_side=1024, quality=70):
+    """URL of the background WebP, a data: URI if it can't be served statically, or "" without the asset"""
+    if not os.path.exists(_bg_path):
+        return ""
+    target = os.path.join(STATIC_DIR, "background.webp")
+    static = st.get_option("server.enableStaticServing")
+    if static and os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(_bg_path):
+        with open(target, "rb") as f:
+            return f"app/static/background.webp?v={hashlib.md5(f.read()).hexdigest()[:10]}"
+    import io
+    from PIL import Image
+    with open(_bg_path, "rb") as f:
+        source = f.read()
+    image = Image.open(io.BytesIO(source))
+    image.thumbnail((max_side, max_side))
+    buf = io.BytesIO()
+    image.save(buf, "WEBP", quality=quality, method=6)
+    webp = buf.getvalue()
+    log.info("Background converted", png_kb=round(len(source) / 1024), webp_kb=round(len(webp) / 1024))
+    if static:
+        try:
+            os.makedirs(STATIC_DIR, exist_ok=True)
+            tmp = f"{target}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(webp)
+            os.replace(tmp, target)
+            # ?v= makes the URL change with the image, and lets the server mark it cacheable for good
+            return f"app/static/background.webp?v={hashlib.md5(webp).hexdigest()[:10]}"
+        except OSError as e:
+            log.warning("Can't write the background, inlining it", path=target, error=str(e))
+    return "data:image/webp;base64," + base64.b64encode(webp).decode()
 
 # --- COLOR PALETTE (Grocery Template) ---
 COLORS = {
@@ -112,7 +179,10 @@ def needs_portion_size(item_name):
 # --- CSS (Grocery Template Theme) ---
 st.markdown('<link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/4.7.0/css/font-awesome.min.css">', unsafe_allow_html=True)
 st.markdown('<link href="https://fonts.googleapis.com/css2?family=Josefin+Sans:wght@300;400;600;700&display=swap" rel="stylesheet">', unsafe_allow_html=True)
-st.markdown(f"""
+@st.cache_resource
+def get_theme_css(background_url):
+    """The theme's <style> block, built once per process and reused by every rerun"""
+    return f"""
     <style>
     /* === GLOBAL === */
     .stApp {{
@@ -128,7 +198,7 @@ st.markdown(f"""
         left: 0;
         width: 100%;
         height: 100%;
-        background-image: url("data:image/png;base64,{_bg_b64}");
+        background-image: url("{background_url}");
         background-size: cover;
         background-position: center;
         background-repeat: no-repeat;
@@ -363,12 +433,19 @@ st.markdown(f"""
         border: 1px solid #C8E6C9;
     }}
     </style>
-""", unsafe_allow_html=True)
+"""
+
+st.markdown(get_theme_css(get_background_url()), unsafe_allow_html=True)
 
 def render_logo(size="3rem"):
     st.markdown(f"<div style='text-align: center; margin-bottom: 10px;'><div class='logo-text' style='font-size: {size}; font-family: Josefin Sans, sans-serif;'>foodvantage<span class='logo-dot'>.</span></div></div>", unsafe_allow_html=True)
 
-def create_html_calendar(year, month, selected_day=None):
+def create_html_calendar(year, month, selected_day=None, day_stats=None):
+    """
+    Month grid as one HTML table. day_stats ({day: (count, avg_score)}, from get_month_summary_db)
+    tints each logged day by its average VMS and shows the item count under the date.
+    """
+    day_stats = day_stats or {}
     cal = cal_module.monthcalendar(year, month)
     html = "<table style='width:100%; text-align:center;'><thead><tr>"
     for day in ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]: html += f"<th style='color:{COLORS['terracotta']};'>{day}</th>"
@@ -378,38 +455,177 @@ def create_html_calendar(year, month, selected_day=None):
         for day in week:
             if day == 0: html += "<td></td>"
             else:
-                style = f"background:{COLORS['terracotta']}; color:white; border-radius:50%;" if day == selected_day else ""
-                html += f"<td style='padding:10px; {style}'>{day}</td>"
+                style, label, title = "", str(day), ""
+                if day in day_stats:
+                    count, avg = day_stats[day]
+                    clr = COLORS['green'] if avg < 3.0 else COLORS['yellow'] if avg < 7.0 else COLORS['red']
+                    style = f"background:{clr}33; border-radius:12px;"  # 20% alpha tint
+                    label = f"{day}<div style='font-size:0.7rem; color:{clr}; font-weight:700;'>{count}</div>"
+                    title = f" title='{count} items · avg VMS {avg:.1f}'"
+                if day == selected_day:
+                    style = f"background:{COLORS['terracotta']}; color:white; border-radius:50%;"
+                    if day in day_stats:
+                        label = f"{day}<div style='font-size:0.7rem; font-weight:700;'>{day_stats[day][0]}</div>"
+                html += f"<td style='padding:10px; {style}'{title}>{label}</td>"
         html += "</tr>"
     return html + "</tbody></table>"
 
-# === MAIN APP (NO LOGIN PAGE) ===
-with st.sidebar:
-    st.write("")
-    st.markdown("##### 🔍 Search")
+# --- TREND CHART ---
+# FOODVANTAGE_TREND_CHART=vega draws the trends as a Vega-Lite spec: no Plotly figure to build or validate
+TREND_CHART = os.getenv("FOODVANTAGE_TREND_CHART", "plotly")
+TREND_SERIES = [
+    ('healthy', 'Healthy', 'rgba(217,217,217,0.7)'),
+    ('moderate', 'Moderate', 'rgba(139,195,74,0.7)'),
+    ('unhealthy', 'Unhealthy', 'rgba(51,51,51,0.7)'),
+]
+
+@st.cache_resource(max_entries=1024, show_spinner=False)
+def build_trend_chart(chart, renderer="plotly"):
+    """
+    Trend chart for get_trend_chart_db's pivoted data, built once per distinct data and view and shared
+    by all sessions. The data only changes when the user logs (new data version), so that is the key.
+    Returns a Plotly figure, or (Vega-Lite spec, long-format DataFrame) for renderer="vega".
+    """
+    series = [s for s in TREND_SERIES if any(chart[s[0]])]  # categories without items get no legend entry
+    if renderer == "vega":
+        import pandas as pd
+        data = pd.DataFrame([{"date": d, "category": label, "count": n}
+                             for key, label, _ in series for d, n in zip(chart["dates"], chart[key]) if n])
+        axis = {"labelColor": '#1A1A1A', "title": None}
+        spec = {
+            "height": 300,
+            "mark": {"type": "bar"},
+            "encoding": {
+                "x": {"field": "date", "type": "temporal", "timeUnit": "utcyearmonthdate", "axis": dict(axis, format="%b %d")},
+                "y": {"field": "count", "type": "quantitative", "aggregate": "sum", "stack": "zero",
+                      "axis": dict(axis, gridColor='#E0E0E0')},
+                "color": {"field": "category", "type": "nominal",
+                          "scale": {"domain": [s[1] for s in series], "range": [s[2] for s in series]},
+                          "legend": {"orient": "top", "title": None, "labelColor": '#1A1A1A'}},
+                "tooltip": [{"field": "date", "type": "temporal", "timeUnit": "utcyearmonthdate", "title": "Date"},
+                            {"field": "category", "title": "Category"},
+                            {"field": "count", "type": "quantitative", "title": "Items"}],
+            },
+        }
+        return spec, data
+
+    import plotly.graph_objects as go
+    fig = go.Figure()
+    for key, label, color in series:
+        fig.add_trace(go.Bar(
+            x=chart["dates"],
+            y=chart[key],
+            name=label,
+            marker_color=color,
+            hovertemplate=f'%{{y}} {key} items<extra></extra>'
+        ))
+    fig.update_layout(
+        barmode='stack',
+        height=300,
+        margin=dict(l=20, r=20, t=20, b=40),
+        plot_bgcolor='rgba(0,0,0,0)',
+        paper_bgcolor='rgba(0,0,0,0)',
+        xaxis=dict(type='date', showgrid=False, showline=False, title=None, tickfont=dict(color='#1A1A1A'), color='#1A1A1A'),
+        yaxis=dict(showgrid=True, gridcolor='#E0E0E0', showline=False, title=None, tickfont=dict(color='#1A1A1A'), color='#1A1A1A'),
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="center", x=0.5, font=dict(color='#1A1A1A')),
+        hovermode='x unified'
+    )
+    return fig
+
+def result_cards_html(results, portion_suffix=" per serving"):
+    """A whole display-only result list as one HTML block inside the scroll container (one element, not one per card)"""
+    cards = []
+    for i, d in enumerate(results):
+        c = COLORS['green'] if d['vms_score'] < 3.0 else COLORS['yellow'] if d['vms_score'] < 7.0 else COLORS['red']
+        portion_label = portion_suffix if needs_portion_size(d['name']) else ""  # FIX 2: portion size label
+        cards.append(
+            f"<div class='card' style='padding:12px; margin-bottom:8px;'>"
+            f"<div style='font-size:0.9rem; font-weight:bold;'>{i+1}. {d['name']}</div>"
+            f"<div style='color:{c}; font-weight:bold; font-size:1.3rem;'>{d['vms_score']}{portion_label}</div>"
+            f"<div style='font-size:0.8rem; color:{c};'>{d['rating']}</div>"
+            f"</div>")
+    return f"<div class='results-scroll-container'>{''.join(cards)}</div>"
+
+def result_picker(results, key, on_pick, selected=None, portion_suffix=" /serving"):
+    """
+    A clickable result list as one st.dataframe with single-row selection: one element and one widget
+    however long the list, scrolled (and virtualized) by the grid. Clicking a row calls on_pick(result)
+    as a callback, before the rerun that shows its effect.
+    """
+    rows = [{"Item": f"{'✓ ' if r == selected else ''}{i+1}. {r['name']}",
+             "VMS": f"{r['vms_score']}{portion_suffix if needs_portion_size(r['name']) else ''}"}
+            for i, r in enumerate(results)]
+    colors = [COLORS['green'] if r['vms_score'] < 3.0 else COLORS['yellow'] if r['vms_score'] < 7.0 else COLORS['red']
+              for r in results]
+    import pandas as pd
+    styled = pd.DataFrame(rows).style.apply(lambda col: [f"color: {c}; font-weight: bold" for c in colors], subset=["VMS"])
+
+    def pick():
+        picked = st.session_state[key].selection.rows
+        if picked:
+            on_pick(results[picked[0]])
+
+    st.dataframe(styled, key=key, on_select=pick, selection_mode="single-row", hide_index=True,
+                 height=min(400, 35 * len(rows) + 38))
+
+def render_meal_plan_day(day_name, meals, interactive=True):
+    """One day's expander. interactive=False skips the ➕ buttons (used while days are still streaming in)."""
+    today_str = datetime.now().strftime("%Y-%m-%d")
+    with st.expander(f"📅 {day_name}", expanded=False):
+        for midx, meal in enumerate(meals):
+            meal_type = meal.get('meal', 'Meal')
+            meal_name = meal.get('name', 'Unknown')
+            est_score = meal.get('estimated_score', 5.0)
+
+            clr = COLORS['green'] if est_score < 3.0 else COLORS['yellow'] if est_score < 7.0 else COLORS['red']
+
+            col_meal, col_score, col_add = st.columns([3, 1, 0.6])
+            with col_meal:
+                st.markdown(f"**{meal_type}:** {meal_name}")
+            with col_score:
+                st.markdown(f"<div style='text-align:center; color:{clr}; font-weight:bold;'>{est_score}</div>", unsafe_allow_html=True)
+            if not interactive:
+                continue
+            with col_add:
+                if st.button("➕", key=f"mp_{day_name}_{midx}", help=f"Add {meal_name} to today"):
+                    add_calendar_item_db(
+                        st.session_state.user_id,
+                        today_str,
+                        meal_name,
+                        est_score
+                    )
+                    st.success(f"✅ Added!")
+                    time.sleep(0.5)
+                    st.rerun()
+
+# --- DASHBOARD FRAGMENTS ---
+# Each section reruns on its own when its widgets change; only navigation and logging rerun the whole page.
+def fragment(fn):
+    """st.fragment whose reruns log with their own run ID (they run on a new thread and skip the top of the script)"""
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        if not get_context():
+            start_log_run()
+            with profiler.profile("run", fragment=fn.__name__):
+                return fn(*args, **kwargs)
+        return fn(*args, **kwargs)
+    return st.fragment(run)
+
+def set_state(**values):
+    """on_click callback: the state changes before the fragment reruns, so one run shows it (no st.rerun)"""
+    for key, value in values.items():
+        st.session_state[key] = value
+
+@fragment
+def render_sidebar_search():
     search_q = st.text_input("Quick check score", key="sidebar_search")
     if search_q:
         results = search_vantage_db(search_q, limit=20)  # FIX 3: Increased from 5 to 20
         filtered_results = [r for r in results if r['vms_score'] != 10.0] if results else []
         
         if filtered_results:
-            st.markdown("**Top Results:**")
-            # FIX 3: Add scrollable container
-            st.markdown('<div class="results-scroll-container">', unsafe_allow_html=True)
-            for i, d in enumerate(filtered_results):
-                c = COLORS['green'] if d['vms_score'] < 3.0 else COLORS['yellow'] if d['vms_score'] < 7.0 else COLORS['red']
-                
-                # FIX 2: Add portion size label if needed
-                portion_label = " per serving" if needs_portion_size(d['name']) else ""
-                
-                st.markdown(f"""
-                    <div class='card' style='padding:12px; margin-bottom:8px;'>
-                        <div style='font-size:0.9rem; font-weight:bold;'>{i+1}. {d['name']}</div>
-                        <div style='color:{c}; font-weight:bold; font-size:1.3rem;'>{d['vms_score']}{portion_label}</div>
-                        <div style='font-size:0.8rem; color:{c};'>{d['rating']}</div>
-                    </div>
-                """, unsafe_allow_html=True)
-            st.markdown('</div>', unsafe_allow_html=True)
+            # FIX 3: All results in one scrollable block
+            st.markdown("**Top Results:**\n\n" + result_cards_html(filtered_results), unsafe_allow_html=True)
         else:
             # FIX 7: Friendly error message
             st.markdown("""
@@ -421,27 +637,14 @@ with st.sidebar:
                     </div>
                 </div>
             """, unsafe_allow_html=True)
-    st.markdown("---")
-    if st.button("🏠 Dashboard", use_container_width=True): st.session_state.page = 'dashboard'; st.rerun()
-    if st.button("📅 Calendar", use_container_width=True): st.session_state.page = 'calendar'; st.rerun()
-    if st.button("📝 Log History", use_container_width=True): st.session_state.page = 'log'; st.rerun()
 
-if st.session_state.page == 'dashboard':
-    render_logo(size="3.5rem")
-    st.markdown("<h3 style='text-align: center;'>Active Focus Scanner</h3>", unsafe_allow_html=True)
-    st.markdown('<div class="white-shelf"></div>', unsafe_allow_html=True)
-    
+@fragment
+def render_scanner():
     if not st.session_state.camera_active:
         st.markdown('<div class="tomato-wrapper"><i class="fa fa-camera tomato-icon"></i></div>', unsafe_allow_html=True)
-        if st.button("Start Live Scan", type="primary", use_container_width=True):
-            st.session_state.camera_active = True
-            st.session_state.scanning = True
-            st.session_state.scan_count = 0
-            st.session_state.scan_results = None
-            st.session_state.selected_result = None
-            st.session_state.scan_status = None
-            st.session_state.detected_items = []
-            st.rerun()
+        st.button("Start Live Scan", type="primary", use_container_width=True, on_click=set_state,
+                  kwargs=dict(camera_active=True, scanning=True, scan_count=0, scan_results=None,
+                              selected_result=None, scan_status=None, detected_items=[]))
     else:
         # SCANNER ACTIVE
         # Show status ABOVE camera as overlay bubble (same style as metabolic score)
@@ -488,14 +691,9 @@ if st.session_state.page == 'dashboard':
         
         col1, col2, col3 = st.columns([1, 2, 1])
         with col2:
-            if st.button("❌ Stop Scanning", use_container_width=True):
-                st.session_state.camera_active = False
-                st.session_state.scan_results = None
-                st.session_state.selected_result = None
-                st.session_state.scanning = False
-                st.session_state.scan_status = None
-                st.session_state.detected_items = []
-                st.rerun()
+            st.button("❌ Stop Scanning", use_container_width=True, on_click=set_state,
+                      kwargs=dict(camera_active=False, scan_results=None, selected_result=None,
+                                  scanning=False, scan_status=None, detected_items=[]))
         
         # SCANNING LOGIC
         if image and st.session_state.scanning:
@@ -517,7 +715,7 @@ if st.session_state.page == 'dashboard':
                 else:
                     # Clear analyzing status so it doesn't stick on failure
                     st.session_state.scan_status = None
-                st.rerun()
+                st.rerun(scope="fragment")
 
     # FIX 3: Show ALL results with scroll
     if st.session_state.scan_results:
@@ -527,28 +725,9 @@ if st.session_state.page == 'dashboard':
         # FIX 7: Verification reminder
         st.info("💡 Always verify your selection matches what you scanned!")
         
-        # FIX 3: Scrollable results (NO 5-item cap)
-        st.markdown('<div class="results-scroll-container">', unsafe_allow_html=True)
-        for i, result in enumerate(st.session_state.scan_results):
-            clr = COLORS['green'] if result['vms_score'] < 3.0 else COLORS['yellow'] if result['vms_score'] < 7.0 else COLORS['red']
-            selected = st.session_state.selected_result == result
-            
-            # FIX 2: Add portion size label
-            portion_label = " /serving" if needs_portion_size(result['name']) else ""
-            
-            col1, col2 = st.columns([4, 1])
-            with col1:
-                if st.button(
-                    f"{i+1}. {result['name']}", 
-                    key=f"select_{i}",
-                    type="primary" if selected else "secondary",
-                    use_container_width=True
-                ):
-                    st.session_state.selected_result = result
-                    st.rerun()
-            with col2:
-                st.markdown(f"<div style='text-align:center; color:{clr}; font-size:1.5rem; font-weight:bold;'>{result['vms_score']}{portion_label}</div>", unsafe_allow_html=True)
-        st.markdown('</div>', unsafe_allow_html=True)
+        # FIX 3: Scrollable results (NO 5-item cap), one grid with row selection
+        result_picker(st.session_state.scan_results, "scan_pick", selected=st.session_state.selected_result,
+                      on_pick=lambda result: set_state(selected_result=result))
 
     # DEEP DIVE
     if st.session_state.selected_result:
@@ -582,35 +761,34 @@ if st.session_state.page == 'dashboard':
                         st.session_state.selected_result['name'], 
                         st.session_state.selected_result['vms_score']
                     )
+                    # Full rerun so the trend and coach fragments pick up the new item
+                    st.session_state.scan_logged = True
+                    st.rerun()
+                if st.session_state.scan_logged:
+                    st.session_state.scan_logged = False
                     st.success("✅ Added!")
             with col2:
-                if st.button("🔄 Scan Again", use_container_width=True):
-                    st.session_state.scan_results = None
-                    st.session_state.selected_result = None
-                    st.session_state.scanning = True
-                    st.session_state.detected_items = []
-                    st.rerun()
+                st.button("🔄 Scan Again", use_container_width=True, on_click=set_state,
+                          kwargs=dict(scan_results=None, selected_result=None, scanning=True, detected_items=[]))
 
-    # TRENDS
+@fragment
+def render_trends():
     st.markdown("### 📈 Your Health Trends")
     
     st.markdown('<div class="trend-tabs-container">', unsafe_allow_html=True)
     col_d, col_w, col_m = st.columns(3)
     with col_d:
-        if st.button("Day", use_container_width=True, key="day_tab",
-                    type="primary" if st.session_state.trends_view == 'daily' else "secondary"):
-            st.session_state.trends_view = 'daily'
-            st.rerun()
+        st.button("Day", use_container_width=True, key="day_tab",
+                  type="primary" if st.session_state.trends_view == 'daily' else "secondary",
+                  on_click=set_state, kwargs=dict(trends_view='daily'))
     with col_w:
-        if st.button("Week", use_container_width=True, key="week_tab",
-                    type="primary" if st.session_state.trends_view == 'weekly' else "secondary"):
-            st.session_state.trends_view = 'weekly'
-            st.rerun()
+        st.button("Week", use_container_width=True, key="week_tab",
+                  type="primary" if st.session_state.trends_view == 'weekly' else "secondary",
+                  on_click=set_state, kwargs=dict(trends_view='weekly'))
     with col_m:
-        if st.button("Month", use_container_width=True, key="month_tab",
-                    type="primary" if st.session_state.trends_view == 'monthly' else "secondary"):
-            st.session_state.trends_view = 'monthly'
-            st.rerun()
+        st.button("Month", use_container_width=True, key="month_tab",
+                  type="primary" if st.session_state.trends_view == 'monthly' else "secondary",
+                  on_click=set_state, kwargs=dict(trends_view='monthly'))
     st.markdown('</div>', unsafe_allow_html=True)
     
     if st.session_state.trends_view == 'daily':
@@ -620,107 +798,81 @@ if st.session_state.page == 'dashboard':
     else:
         days = 30
     
-    all_data = get_all_calendar_data_db(st.session_state.user_id)
-    raw = get_trend_data_db(st.session_state.user_id, days=days)
-    
-    if raw and len(raw) > 0:
-        df = pd.DataFrame(raw, columns=["date", "category", "count"])
-        df['date'] = pd.to_datetime(df['date'])
-        df_pivot = df.pivot_table(index='date', columns='category', values='count', aggfunc='sum', fill_value=0)
-        
-        fig = go.Figure()
-        
-        if 'healthy' in df_pivot.columns:
-            fig.add_trace(go.Bar(
-                x=df_pivot.index,
-                y=df_pivot['healthy'],
-                name='Healthy',
-                marker_color='rgba(217,217,217,0.7)',
-                hovertemplate='%{y} healthy items<extra></extra>'
-            ))
-        
-        if 'moderate' in df_pivot.columns:
-            fig.add_trace(go.Bar(
-                x=df_pivot.index,
-                y=df_pivot['moderate'],
-                name='Moderate',
-                marker_color='rgba(139,195,74,0.7)',
-                hovertemplate='%{y} moderate items<extra></extra>'
-            ))
-        
-        if 'unhealthy' in df_pivot.columns:
-            fig.add_trace(go.Bar(
-                x=df_pivot.index,
-                y=df_pivot['unhealthy'],
-                name='Unhealthy',
-                marker_color='rgba(51,51,51,0.7)',
-                hovertemplate='%{y} unhealthy items<extra></extra>'
-            ))
-        
-        fig.update_layout(
-            barmode='stack',
-            height=300,
-            margin=dict(l=20, r=20, t=20, b=40),
-            plot_bgcolor='rgba(0,0,0,0)',
-            paper_bgcolor='rgba(0,0,0,0)',
-            xaxis=dict(showgrid=False, showline=False, title=None, tickfont=dict(color='#1A1A1A'), color='#1A1A1A'),
-            yaxis=dict(showgrid=True, gridcolor='#E0E0E0', showline=False, title=None, tickfont=dict(color='#1A1A1A'), color='#1A1A1A'),
-            legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="center", x=0.5, font=dict(color='#1A1A1A')),
-            hovermode='x unified'
-        )
-        
-        st.plotly_chart(fig, use_container_width=True)
-        
-        total_items = int(df['count'].sum())
-        healthy_count = int(df[df['category'] == 'healthy']['count'].sum()) if 'healthy' in df['category'].values else 0
-        st.markdown(f"**Total items:** {total_items} | **Healthy choices:** {healthy_count}")
+    chart = get_trend_chart_db(st.session_state.user_id, days=days)
 
-        # === AI HEALTH COACH ===
-        st.markdown("---")
-        col_ins1, col_ins2 = st.columns([3, 1])
-        with col_ins1:
-            st.markdown("#### 🧠 AI Health Coach")
-        with col_ins2:
-            if st.session_state.ai_insights:
-                if st.button("🔄 Refresh", key="refresh_insights", use_container_width=True):
-                    st.session_state.ai_insights = None
-                    st.rerun()
+    if chart["dates"]:
+        if TREND_CHART == "vega":
+            spec, data = build_trend_chart(chart, "vega")
+            st.vega_lite_chart(data, spec, use_container_width=True)
+        else:
+            st.plotly_chart(build_trend_chart(chart), use_container_width=True)
 
-        if not st.session_state.ai_insights:
-            if st.button("🧠 Get AI Insights", use_container_width=True, type="primary"):
-                with st.spinner("🧠 Your AI Health Coach is analyzing your patterns..."):
-                    try:
-                        insights = generate_health_insights(raw, all_data, days)
-                        if insights:
-                            st.session_state.ai_insights = insights
-                            st.rerun()
-                        else:
-                            st.warning("Could not generate insights. Please try again.")
-                    except Exception as e:
-                        st.error(f"AI Insights error: {e}")
+        total_items = sum(sum(chart[key]) for key, _, _ in TREND_SERIES)
+        healthy_count = sum(chart['healthy'])
+        st.markdown(f"**Total items:** {total_items} | **Healthy choices:** {healthy_count}")
 
-        if st.session_state.ai_insights:
-            for i, insight in enumerate(st.session_state.ai_insights):
-                emoji = insight.get('emoji', '💡')
-                title = insight.get('title', 'Insight')
-                body = insight.get('insight', '')
-                action = insight.get('action', '')
-                border_colors = [COLORS['olive'], COLORS['yellow'], COLORS['terracotta']]
-                bc = border_colors[i % len(border_colors)]
-                st.markdown(f"""
-                    <div class='card' style='border-left: 4px solid {bc}; padding: 16px;'>
-                        <div style='font-size: 1.1rem; font-weight: 800; margin-bottom: 6px;'>{emoji} {title}</div>
-                        <div style='color: #444; font-size: 0.95rem; margin-bottom: 8px;'>{body}</div>
-                        <div style='color: {COLORS["olive"]}; font-weight: 600; font-size: 0.9rem;'>→ {action}</div>
-                    </div>
-                """, unsafe_allow_html=True)
+        render_coach(days)
 
     else:
-        if all_data and len(all_data) > 0:
-            st.warning(f"⚠️ You have {len(all_data)} logged items, but none in the last {days} day(s). Try selecting a different time range.")
+        total_logged = count_calendar_items_db(st.session_state.user_id)
+        if total_logged > 0:
+            st.warning(f"⚠️ You have {total_logged} logged items, but none in the last {days} day(s). Try selecting a different time range.")
         else:
             st.info("📊 No data yet. Start logging items!")
 
+@fragment
+def render_coach(days):
+    """AI Health Coach for the trend window; nested in render_trends so Refresh only reruns the coach"""
+    # Insights belong to one window and its data: look them up again when Day/Week/Month or new logs change it
+    key = health_insights_key(st.session_state.user_id, days)
+    if key is None or key != st.session_state.ai_insights_key:
+        st.session_state.ai_insights = None
+        st.session_state.ai_insights_key = key
+
+    st.markdown("---")
+    col_ins1, col_ins2 = st.columns([3, 1])
+    with col_ins1:
+        st.markdown("#### 🧠 AI Health Coach")
+    with col_ins2:
+        if st.session_state.ai_insights:
+            st.button("🔄 Refresh", key="refresh_insights", use_container_width=True,
+                      on_click=set_state, kwargs=dict(ai_insights=None))
+
+    # Insights are stored per user and only regenerated when new logs change the trend window
+    if not st.session_state.ai_insights:
+        st.session_state.ai_insights = peek_health_insights(st.session_state.user_id, days)
+
+    if not st.session_state.ai_insights:
+        if st.button("🧠 Get AI Insights", use_container_width=True, type="primary"):
+            with st.spinner("🧠 Your AI Health Coach is analyzing your patterns..."):
+                try:
+                    insights = get_health_insights(st.session_state.user_id, days)
+                    if insights:
+                        st.session_state.ai_insights = insights
+                        st.rerun(scope="fragment")
+                    else:
+                        st.warning("Could not generate insights. Please try again.")
+                except Exception as e:
+                    st.error(f"AI Insights error: {e}")
+
+    if st.session_state.ai_insights:
+        for i, insight in enumerate(st.session_state.ai_insights):
+            emoji = insight.get('emoji', '💡')
+            title = insight.get('title', 'Insight')
+            body = insight.get('insight', '')
+            action = insight.get('action', '')
+            border_colors = [COLORS['olive'], COLORS['yellow'], COLORS['terracotta']]
+            bc = border_colors[i % len(border_colors)]
+            st.markdown(f"""
+                <div class='card' style='border-left: 4px solid {bc}; padding: 16px;'>
+                    <div style='font-size: 1.1rem; font-weight: 800; margin-bottom: 6px;'>{emoji} {title}</div>
+                    <div style='color: #444; font-size: 0.95rem; margin-bottom: 8px;'>{body}</div>
+                    <div style='color: {COLORS["olive"]}; font-weight: 600; font-size: 0.9rem;'>→ {action}</div>
+                </div>
+            """, unsafe_allow_html=True)
+
+@fragment
+def render_recipes():
     # === DAILY HEALTHY RECIPES ===
     st.markdown("---")
     st.markdown("### 🥗 Healthy Recipes for the Day")
@@ -732,15 +884,19 @@ if st.session_state.page == 'dashboard':
         st.session_state.daily_recipes = None
         st.session_state.recipes_date = today_str
 
+    # Recipes are shared by everyone for the day - show them straight away if already generated
+    if not st.session_state.daily_recipes:
+        st.session_state.daily_recipes = peek_daily_recipes()
+
     if not st.session_state.daily_recipes:
         if st.button("🍳 Discover Today's Recipes", use_container_width=True, type="primary"):
             with st.spinner("🍳 Finding healthy recipes for you..."):
                 try:
-                    recipes = generate_daily_recipes()
+                    recipes = get_daily_recipes()
                     if recipes:
                         st.session_state.daily_recipes = recipes
                         st.session_state.recipes_date = today_str
-                        st.rerun()
+                        st.rerun(scope="fragment")
                     else:
                         st.warning("Could not load recipes. Please try again.")
                 except Exception as e:
@@ -779,8 +935,142 @@ if st.session_state.page == 'dashboard':
         col_refresh = st.columns([3, 1])[1]
         with col_refresh:
             if st.button("🔄 New Recipes", key="refresh_recipes", use_container_width=True):
-                st.session_state.daily_recipes = None
-                st.rerun()
+                # A set for this session only: the shared daily entry stays as it is for everyone else
+                with st.spinner("🍳 Finding new recipes..."):
+                    try:
+                        shown = [r.get('name', '') for r in st.session_state.daily_recipes]
+                        st.session_state.daily_recipes = generate_daily_recipes(exclude=shown) or st.session_state.daily_recipes
+                    except Exception as e:
+                        st.error(f"Recipe error: {e}")
+                st.rerun(scope="fragment")
+
+# --- ADMIN METRICS ---
+def _labels_text(labels):
+    return ", ".join(f"{k}={v}" for k, v in labels.items())
+
+def render_metrics_page():
+    """Latency percentiles, counters and storage stats of this process, plus the Prometheus dump"""
+    import pandas as pd
+
+    st.markdown("## 📊 Metrics")
+    if st.button("🔄 Refresh"):
+        st.rerun()
+    snap = metrics.snapshot()
+    st.caption(f"Since this process started · percentiles over the last {metrics.SAMPLES} observations per series")
+
+    def ms(seconds):
+        return None if seconds is None else round(seconds * 1000, 1)
+
+    latency = [{"metric": name, "labels": _labels_text(labels), "count": h["count"], "p50 ms": ms(h["p50"]),
+                "p95 ms": ms(h["p95"]), "p99 ms": ms(h["p99"]), "max ms": ms(h["max"]), "total s": round(h["sum"], 2)}
+               for name, labels, h in snap["histograms"] if name.endswith("_seconds")]
+    sizes = [{"metric": name, "labels": _labels_text(labels), "count": h["count"], "mean": h["mean"],
+              "p50": h["p50"], "p99": h["p99"], "max": h["max"]}
+             for name, labels, h in snap["histograms"] if not name.endswith("_seconds")]
+    counters = [{"metric": name, "labels": _labels_text(labels), "value": value}
+                for name, labels, value in snap["counters"]]
+    counters += [{"metric": name, "labels": _labels_text(labels), "value": value}
+                 for name, _, labels, value in snap["collected"] if value is not None]
+
+    st.markdown("#### ⏱️ Latency")
+    if latency:
+        st.dataframe(pd.DataFrame(latency).sort_values("p99 ms", ascending=False), hide_index=True)
+    else:
+        st.info("Nothing timed yet")
+    if sizes:
+        st.markdown("#### 📦 Sizes")
+        st.dataframe(pd.DataFrame(sizes), hide_index=True)
+    if counters:
+        st.markdown("#### 🔢 Counters")
+        st.dataframe(pd.DataFrame(counters), hide_index=True)
+
+    with st.expander("🗄️ Storage"):
+        st.json(get_storage_metrics())
+    with st.expander("🧠 Read cache"):
+        st.json(get_read_cache_metrics())
+    text = metrics.prometheus_text()
+    with st.expander("📜 Prometheus text"):
+        st.code(text, language="text")
+    st.download_button("⬇️ Download metrics.prom", text, file_name="foodvantage_metrics.prom", mime="text/plain")
+    render_profiling()
+
+PROFILE_TARGETS = {"run": "script runs", "scan": "scans", "search": "product searches"}
+
+def render_profiling():
+    """Arms the profiler for the next runs or operations of this process; summary and files of saved profiles"""
+    import pandas as pd
+
+    st.markdown("#### 🔬 Profiling")
+    st.caption(f"Profiles the next runs or operations of this worker process, in any session including yours · "
+               f"saved to {profiler.PROFILE_DIR}")
+    with st.form("arm_profiler"):
+        c1, c2, c3 = st.columns([2, 1, 2])
+        target = c1.selectbox("Profile the next", profiler.TARGETS, format_func=PROFILE_TARGETS.get)
+        runs = c2.number_input("How many", min_value=1, max_value=50, value=3)
+        cpu = c3.checkbox("CPU (cProfile + flame graph)", value=True)
+        memory = c3.checkbox("Memory (tracemalloc, slower)")
+        if st.form_submit_button("▶️ Arm"):
+            if cpu or memory:
+                profiler.arm(target, runs, cpu=cpu, memory=memory)
+            else:
+                st.warning("Pick CPU, memory or both")
+    armed = profiler.armed()
+    if armed:
+        st.info("Armed: " + ", ".join(f"{a['remaining']} {PROFILE_TARGETS[t]}" for t, a in armed.items()))
+        if st.button("⏹️ Disarm"):
+            profiler.disarm()
+            st.rerun()
+
+    profiles = profiler.list_profiles()
+    if not profiles:
+        st.caption("No profiles saved yet")
+        return
+    st.dataframe(pd.DataFrame([{
+        "profile": p["id"], "target": p["target"], "labels": _labels_text(p["labels"]),
+        "user": p["context"].get("user"), "outcome": p["outcome"], "wall ms": round(p["wall_ms"], 1),
+        "cpu ms": None if p["cpu_ms"] is None else round(p["cpu_ms"], 1),
+        "memory KB": round(p["memory"]["profile"]["kb"], 1) if "memory" in p else None,
+    } for p in profiles]), hide_index=True)
+
+    chosen = st.selectbox("Profile", [p["id"] for p in profiles])
+    summary = next(p for p in profiles if p["id"] == chosen)
+    if summary.get("functions"):
+        st.markdown(f"**Top functions** · {summary['samples']} stack samples")
+        st.dataframe(pd.DataFrame(summary["functions"]).sort_values("cumulative_ms", ascending=False), hide_index=True)
+    if summary.get("memory"):
+        memory = summary["memory"]
+        st.markdown(f"**Memory** · {memory['profile']['kb']:+,.0f} KB over the profile, "
+                    f"{memory['since_tracing']['kb']:+,.0f} KB since tracing started, peak {memory['peak_kb']:,.0f} KB")
+        over, since = st.tabs(["Over the profile", "Since tracing started"])
+        over.dataframe(pd.DataFrame(memory["profile"]["lines"]), hide_index=True)
+        since.dataframe(pd.DataFrame(memory["since_tracing"]["lines"]), hide_index=True)
+    for col, name in zip(st.columns(len(summary["files"])), summary["files"]):
+        try:
+            col.download_button(f"⬇️ {name.rsplit('.', 1)[1]}", profiler.read_profile_file(name), file_name=name,
+                                key=f"profile_{name}")
+        except OSError:
+            col.caption(f"{name} was pruned")
+
+# === MAIN APP (NO LOGIN PAGE) ===
+with st.sidebar:
+    st.write("")
+    st.markdown("##### 🔍 Search")
+    render_sidebar_search()
+    st.markdown("---")
+    if st.button("🏠 Dashboard", use_container_width=True): st.session_state.page = 'dashboard'; st.rerun()
+    if st.button("📅 Calendar", use_container_width=True): st.session_state.page = 'calendar'; st.rerun()
+    if st.button("📝 Log History", use_container_width=True): st.session_state.page = 'log'; st.rerun()
+    if st.session_state.user_id in ADMIN_USERS:
+        if st.button("📊 Metrics", use_container_width=True): st.session_state.page = 'metrics'; st.rerun()
+
+if st.session_state.page == 'dashboard':
+    render_logo(size="3.5rem")
+    st.markdown("<h3 style='text-align: center;'>Active Focus Scanner</h3>", unsafe_allow_html=True)
+    st.markdown('<div class="white-shelf"></div>', unsafe_allow_html=True)
+
+    render_scanner()
+    render_trends()
+    render_recipes()
 
 elif st.session_state.page == 'calendar':
     st.markdown("## 📅 Grocery Calendar")
@@ -789,7 +1079,8 @@ elif st.session_state.page == 'calendar':
     with c1:
         st.markdown('<div class="card">', unsafe_allow_html=True)
         sel_date = st.date_input("Select Date", datetime.now(), label_visibility="collapsed")
-        st.markdown(create_html_calendar(sel_date.year, sel_date.month, sel_date.day), unsafe_allow_html=True)
+        month_stats = get_month_summary_db(st.session_state.user_id, sel_date.year, sel_date.month)
+        st.markdown(create_html_calendar(sel_date.year, sel_date.month, sel_date.day, month_stats), unsafe_allow_html=True)
         st.markdown('</div>', unsafe_allow_html=True)
     
     with c2:
@@ -803,31 +1094,19 @@ elif st.session_state.page == 'calendar':
             filtered_results = [r for r in search_results if r['vms_score'] != 10.0] if search_results else []
             
             if filtered_results:
-                # FIX 3: Scrollable container
-                st.markdown('<div class="results-scroll-container">', unsafe_allow_html=True)
-                for idx, result in enumerate(filtered_results):
-                    clr = COLORS['green'] if result['vms_score'] < 3.0 else COLORS['yellow'] if result['vms_score'] < 7.0 else COLORS['red']
-                    
-                    # FIX 2: Add portion size label
-                    portion_label = " /serving" if needs_portion_size(result['name']) else ""
-                    
-                    col_a, col_b, col_c = st.columns([3, 1, 0.6])
-                    with col_a:
-                        st.markdown(f"**{result['name']}**")
-                    with col_b:
-                        st.markdown(f"<div style='text-align:center; color:{clr}; font-weight:bold; font-size:1.2rem;'>{result['vms_score']}{portion_label}</div>", unsafe_allow_html=True)
-                    with col_c:
-                        if st.button("➕", key=f"add_cal_{idx}_{sel_date}", help=f"Add {result['name']}"):
-                            add_calendar_item_db(
-                                st.session_state.user_id,
-                                sel_date.strftime("%Y-%m-%d"),
-                                result['name'],
-                                result['vms_score']
-                            )
-                            st.success(f"✅ Added!")
-                            time.sleep(0.5)
-                            st.rerun()
-                st.markdown('</div>', unsafe_allow_html=True)
+                def add_to_day(result):
+                    add_calendar_item_db(
+                        st.session_state.user_id,
+                        sel_date.strftime("%Y-%m-%d"),
+                        result['name'],
+                        result['vms_score']
+                    )
+                    st.session_state.calendar_picks += 1  # fresh grid, so the same item can be added again
+                    st.toast(f"✅ Added {result['name']}")
+
+                # FIX 3: Scrollable results, one grid with row selection
+                st.caption("Tap an item to add it to this day")
+                result_picker(filtered_results, f"add_cal_{sel_date}_{st.session_state.calendar_picks}", on_pick=add_to_day)
             else:
                 # FIX 7: Friendly error
                 st.markdown("""
@@ -845,28 +1124,90 @@ elif st.session_state.page == 'calendar':
         
         items = get_calendar_items_db(st.session_state.user_id, sel_date.strftime("%Y-%m-%d"))
         if items:
-            for iid, name, score, cat in items:
+            for iid, name, score, cat, tier in items:
                 clr = COLORS['green'] if score < 3.0 else COLORS['yellow'] if score < 7.0 else COLORS['red']
                 col_item, col_del = st.columns([5, 1])
                 with col_item:
                     st.markdown(f"<div class='list-row'><span>{name}</span><strong style='color:{clr}'>{score}</strong></div>", unsafe_allow_html=True)
                 with col_del:
-                    if st.button("🗑️", key=f"del_{iid}", help="Delete this item"):
-                        delete_item_db(iid)
+                    if tier == 'cold':
+                        st.markdown("<div style='text-align:center; padding-top:12px;' title='Archived'>🔒</div>", unsafe_allow_html=True)
+                    elif st.button("🗑️", key=f"del_{iid}", help="Delete this item"):
+                        delete_item_db(st.session_state.user_id, iid)
                         st.rerun()
         else:
             st.info("📭 No items for this date. Add items above!")
 
 elif st.session_state.page == 'log':
     st.markdown("## 📝 Log History")
-    history = get_log_history_db(st.session_state.user_id)
-    if history:
-        for d, name, score, cat in history:
+    # One page at a time via a (date, id) keyset cursor; the page is rendered as a single HTML block
+    page_no = len(st.session_state.log_cursors) - 1
+    rows, next_cursor = get_log_history_page_db(st.session_state.user_id, st.session_state.log_cursors[-1])
+    if rows:
+        total_logged = count_calendar_items_db(st.session_state.user_id)
+        first = page_no * LOG_PAGE_SIZE + 1
+        st.caption(f"Showing {first}–{first + len(rows) - 1} of {total_logged} items")
+        row_html = []
+        for _, d, name, score, cat in rows:
             clr = COLORS['green'] if score < 3.0 else COLORS['yellow'] if score < 7.0 else COLORS['red']
-            st.markdown(f"<div class='list-row'><span><b>{d}</b>: {name}</span><strong style='color:{clr}'>{score}</strong></div>", unsafe_allow_html=True)
+            row_html.append(f"<div class='list-row'><span><b>{d}</b>: {name}</span><strong style='color:{clr}'>{score}</strong></div>")
+        st.markdown("".join(row_html), unsafe_allow_html=True)
+
+        col_newer, col_older = st.columns(2)
+        with col_newer:
+            if st.button("← Newer", key="log_newer", use_container_width=True, disabled=page_no == 0):
+                st.session_state.log_cursors.pop()
+                st.rerun()
+        with col_older:
+            if st.button("Older →", key="log_older", use_container_width=True, disabled=next_cursor is None):
+                st.session_state.log_cursors.append(next_cursor)
+                st.rerun()
+    elif page_no > 0:
+        st.session_state.log_cursors = [None]  # page emptied by deletes elsewhere: back to the newest
+        st.rerun()
     else:
         st.info("📭 No history yet. Start logging items!")
 
+    with st.expander("📦 Import / Export"):
+        fmt = st.radio("Format", ["parquet", "csv", "jsonl"], horizontal=True, key="export_format")
+        # The full history is only read when asked for, not on every render of this page
+        if st.button(f"📦 Prepare export (.{fmt})", key="export_btn", use_container_width=True):
+            with st.spinner("Exporting..."):
+                previous = st.session_state.log_export
+                st.session_state.log_export = (fmt, export_calendar_file(st.session_state.user_id, fmt),
+                                               datetime.now().strftime("%H:%M"))
+                if previous and os.path.exists(previous[1]):
+                    os.remove(previous[1])
+        export = st.session_state.log_export
+        if export and export[0] == fmt:
+            try:
+                with open(export[1], "rb") as f:
+                    st.download_button(
+                        f"⬇️ Download history (.{fmt}, as of {export[2]})",
+                        data=f,
+                        file_name=f"foodvantage_{st.session_state.user_id}.{fmt}",
+                        use_container_width=True,
+                    )
+            except FileNotFoundError:
+                st.session_state.log_export = None  # expired (EXPORT_TTL): prepare it again
+        upload = st.file_uploader("Import a history file (date, item_name, optional score)",
+                                  type=["parquet", "csv", "jsonl", "json"], key="import_file")
+        if upload is not None and st.button("⬆️ Import", key="import_btn", use_container_width=True):
+            import tempfile
+            suffix = os.path.splitext(upload.name)[1]
+            with tempfile.NamedTemporaryFile(suffix=suffix) as tmp:
+                tmp.write(upload.getbuffer())
+                tmp.flush()
+                try:
+                    with st.spinner("Importing..."):
+                        stats = import_calendar_db(tmp.name, username=st.session_state.user_id)
+                    st.success(f"✅ Imported {stats['inserted']} items "
+                               f"({stats['duplicates']} already logged, {stats['skipped']} skipped)")
+                    st.session_state.log_cursors = [None]
+                except Exception as e:
+                    log.exception("Calendar import failed")
+                    st.error(f"Import failed: {e}")
+
     # === AI MEAL PLANNING AGENT ===
     st.markdown("---")
     col_mp1, col_mp2 = st.columns([3, 1])
@@ -880,51 +1221,74 @@ elif st.session_state.page == 'log':
 
     if not st.session_state.meal_plan:
         st.markdown("Get a personalized 7-day meal plan based on your eating history.")
-        if st.button("🤖 Generate AI Meal Plan", use_container_width=True, type="primary"):
-            with st.spinner("🤖 Your AI nutritionist is crafting your personalized meal plan..."):
+        col_ai, col_local = st.columns([2, 1])
+        with col_ai:
+            generate_ai = st.button("🤖 Generate AI Meal Plan", use_container_width=True, type="primary")
+        with col_local:
+            generate_local = st.button("⚡ Instant Plan", use_container_width=True,
+                                       help="Built from our product index in milliseconds - no AI call")
+        if generate_local:
+            history = get_log_history_db(st.session_state.user_id, limit=AGENT_HISTORY_LIMIT)
+            st.session_state.meal_plan = plan_meals_local(history, st.session_state.user_id)
+            st.session_state.meal_plan_source = 'local'
+            st.rerun()
+        if generate_ai:
+            history = get_log_history_db(st.session_state.user_id, limit=AGENT_HISTORY_LIMIT)
+            if MEAL_PLAN_MODE == "parallel":
+                # Days are generated concurrently; each expander appears as soon as its day is ready
+                status = st.empty()
+                placeholders = {day_name: st.empty() for day_name in MEAL_PLAN_DAYS}
+                plan, failed = {}, []
+                status.info("🤖 Your AI nutritionist is crafting your personalized meal plan...")
                 try:
-                    history = get_log_history_db(st.session_state.user_id)
-                    plan = generate_meal_plan(history, st.session_state.user_id)
-                    if plan:
-                        st.session_state.meal_plan = plan
-                        st.rerun()
-                    else:
-                        st.warning("Could not generate meal plan. Please try again.")
-                except Exception as e:
-                    st.error(f"Meal Plan error: {e}")
+                    for day_name, meals, error in generate_meal_plan_streaming(history, st.session_state.user_id):
+                        if meals:
+                            plan[day_name] = meals
+                            with placeholders[day_name].container():
+                                render_meal_plan_day(day_name, meals, interactive=False)
+                        else:
+                            failed.append(day_name)
+                        status.info(f"🤖 {len(plan) + len(failed)}/{len(MEAL_PLAN_DAYS)} days planned...")
+                except Exception:
+                    log.exception("Streaming meal plan failed")
+                # Days the model couldn't deliver (slow, rate-limited, unavailable) come from the local planner
+                missing = [d for d in MEAL_PLAN_DAYS if d not in plan]
+                if missing:
+                    local_plan = plan_meals_local(history, st.session_state.user_id)
+                    for day_name in missing:
+                        plan[day_name] = local_plan[day_name]
+                st.session_state.meal_plan = plan
+                st.session_state.meal_plan_source = 'local' if len(missing) == len(MEAL_PLAN_DAYS) else 'mixed' if missing else 'ai'
+                st.rerun()
+            else:
+                with st.spinner("🤖 Your AI nutritionist is crafting your personalized meal plan..."):
+                    try:
+                        plan = generate_meal_plan(history, st.session_state.user_id)
+                        source = 'ai'
+                    except Exception:
+                        log.exception("Meal plan failed")
+                        plan = None
+                    if not plan:
+                        plan, source = plan_meals_local(history, st.session_state.user_id), 'local'
+                    st.session_state.meal_plan = plan
+                    st.session_state.meal_plan_source = source
+                    st.rerun()
 
     if st.session_state.meal_plan:
-        day_order = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
         plan = st.session_state.meal_plan
-        today_str = datetime.now().strftime("%Y-%m-%d")
+        if st.session_state.meal_plan_source == 'local':
+            st.caption("⚡ Instant plan built from our product index")
+        elif st.session_state.meal_plan_source == 'mixed':
+            st.caption("⚡ Some days were filled in from our product index while the AI was unavailable")
 
-        for day_name in day_order:
+        for day_name in MEAL_PLAN_DAYS:
             meals = plan.get(day_name, [])
             if not meals:
                 continue
+            render_meal_plan_day(day_name, meals)
 
-            with st.expander(f"📅 {day_name}", expanded=False):
-                for midx, meal in enumerate(meals):
-                    meal_type = meal.get('meal', 'Meal')
-                    meal_name = meal.get('name', 'Unknown')
-                    est_score = meal.get('estimated_score', 5.0)
-
-                    clr = COLORS['green'] if est_score < 3.0 else COLORS['yellow'] if est_score < 7.0 else COLORS['red']
-
-                    col_meal, col_score, col_add = st.columns([3, 1, 0.6])
-                    with col_meal:
-                        st.markdown(f"**{meal_type}:** {meal_name}")
-                    with col_score:
-                        st.markdown(f"<div style='text-align:center; color:{clr}; font-weight:bold;'>{est_score}</div>", unsafe_allow_html=True)
-                    with col_add:
-                        if st.button("➕", key=f"mp_{day_name}_{midx}", help=f"Add {meal_name} to today"):
-                            add_calendar_item_db(
-                                st.session_state.user_id,
-                                today_str,
-                                meal_name,
-                                est_score
-                            )
-                            st.success(f"✅ Added!")
-                            time.sleep(0.5)
-                            st.rerun()
+elif st.session_state.page == 'metrics' and st.session_state.user_id in ADMIN_USERS:
+    render_metrics_page()
 
+# Saves this run's profile when "run" is armed (a run ended by st.rerun() is saved when the next one starts)
+profiler.finish_run()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Offline batch scanner: runs the scan pipeline over a directory of images
+without Streamlit and writes one row per resolved item.
+
+Usage:
+    python src/batch_scan.py photos/ --output results.parquet --backend local --workers 8
+    python src/batch_scan.py photos/ --output results.jsonl --backend openai
+
+Reports images/sec and p50/p95/p99 latency for each pipeline stage.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+sys.path.append(os.path.dirname(__file__))
+from scan_pipeline import run_scan, LocalVisionBackend, OpenAIVisionBackend, STAGES
+from gemini_api import get_gemini_api_key
+
+# Cached DB helpers warn on every worker thread when run outside `streamlit run`
+logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").setLevel(logging.ERROR)
+logging.getLogger("streamlit.runtime.caching.cache_data_api").setLevel(logging.ERROR)
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+
+
+def find_images(input_dir):
+    paths = []
+    for root, _, files in os.walk(input_dir):
+        for f in files:
+            if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS:
+                paths.append(os.path.join(root, f))
+    return sorted(paths)
+
+
+def make_backend(name, latency=0.0):
+    if name == "local":
+        return LocalVisionBackend(latency=latency)
+    api_key = get_gemini_api_key()
+    if not api_key:
+        raise SystemExit("❌ OPENAI_API_KEY is not set (use --backend local for the offline stand-in)")
+    return OpenAIVisionBackend(api_key)
+
+
+def scan_one(path, backend):
+    """Returns (rows, timings, error) for one image"""
+    try:
+        with open(path, "rb") as f:
+            scan = run_scan(f.read(), backend)
+    except Exception as e:
+        return [{"image": path, "error": f"{type(e).__name__}: {e}"}], None, e
+
+    rows = []
+    for r in scan["results"]:
+        rows.append({
+            "image": path,
+            "detected": ", ".join(scan["detected"]),
+            "name": r["name"],
+            "brand": r["brand"],
+            "vms_score": r["vms_score"],
+            "rating": r["rating"],
+            "error": None,
+        })
+    if not rows:
+        rows.append({"image": path, "detected": ", ".join(scan["detected"]), "name": None,
+                     "brand": None, "vms_score": None, "rating": None, "error": None})
+    return rows, scan["timings"], None
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def write_results(rows, output):
+    """JSONL directly; Parquet through DuckDB's native writer (no pandas/pyarrow needed)"""
+    if output.endswith(".parquet"):
+        import duckdb
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as tmp:
+            for row in rows:
+                tmp.write(json.dumps(row) + "\n")
+        try:
+            duckdb.connect().execute(
+                f"COPY (SELECT * REPLACE (CAST(error AS VARCHAR) AS error) "
+                f"FROM read_json_auto('{tmp.name}', format='newline_delimited')) "
+                f"TO '{output}' (FORMAT PARQUET)"
+            )
+        finally:
+            os.remove(tmp.name)
+    else:
+        with open(output, "w") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FoodVantage offline batch scanner")
+    parser.add_argument("input_dir", help="Directory of images (searched recursively)")
+    parser.add_argument("--output", default="scan_results.jsonl", help=".jsonl or .parquet")
+    parser.add_argument("--backend", choices=["local", "openai"], default="local")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Simulated detect latency for the local backend (seconds)")
+    args = parser.parse_args()
+
+    images = find_images(args.input_dir)
+    if not images:
+        raise SystemExit(f"❌ No images found in {args.input_dir}")
+
+    backend = make_backend(args.backend, args.latency)
+    print(f"🚀 Scanning {len(images)} images with '{backend.name}' backend, {args.workers} workers...")
+
+    all_rows, stage_times, errors = [], {s: [] for s in STAGES}, 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(scan_one, path, backend) for path in images]
+        for future in as_completed(futures):
+            rows, timings, error = future.result()
+            all_rows.extend(rows)
+            if error:
+                errors += 1
+                continue
+            for stage in STAGES:
+                stage_times[stage].append(timings[stage])
+    elapsed = time.perf_counter() - start
+
+    write_results(all_rows, args.output)
+
+    print("=" * 60)
+    print(f"✅ {len(images)} images in {elapsed:.2f}s → {len(images) / elapsed:.1f} images/sec")
+    print(f"   {len(all_rows)} rows written to {args.output} ({errors} failed images)")
+    print(f"{'STAGE':<12} | {'p50 ms':>8} | {'p95 ms':>8} | {'p99 ms':>8}")
+    for stage in STAGES:
+        t = stage_times[stage]
+        print(f"{stage:<12} | {percentile(t, 50) * 1000:>8.1f} | {percentile(t, 95) * 1000:>8.1f} | {percentile(t, 99) * 1000:>8.1f}")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
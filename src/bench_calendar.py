@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Synthetic-data benchmark for the calendar schema.
+
+Builds user DBs of growing size with the real schema (init_user_db), fills them
+with generated log rows and times the per-user queries the app runs. With rows
+clustered by user the latency should stay roughly flat as the table grows.
+
+Usage:
+    python src/bench_calendar.py                                  # 100k users, 50M rows
+    python src/bench_calendar.py --users 20000 --rows 10000000 --steps 3
+    python src/bench_calendar.py --users 20000 --rows 10000000 --unclustered   # comparison
+
+Each step multiplies the number of users (rows per user stays the same), so
+the last step is the full --users / --rows size.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import logging
+import contextlib
+from datetime import date, timedelta
+
+import duckdb
+
+sys.path.append(os.path.dirname(__file__))
+from gemini_api import init_user_db, rebuild_daily_rollup, CALENDAR_COLUMNS
+
+logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").setLevel(logging.ERROR)
+
+ITEMS = ["Apple", "Banana", "Greek Yogurt", "Oats", "Salmon", "Chicken Breast", "Lentil Soup", "Broccoli",
+         "White Bread", "Cola", "Chocolate Bar", "Potato Chips", "Cheddar", "Granola", "Orange Juice", "Almonds"]
+HISTORY_DAYS = 730
+END_DATE = date(2026, 10, 19)
+
+# The per-user reads the app makes, keyed by a short label
+QUERIES = {
+    "trend_30d": """
+        SELECT date, category, COUNT(*) FROM calendar
+        WHERE username = ? AND date >= ? GROUP BY date, category ORDER BY date
+    """,
+    "trend_rollup": "SELECT date, category, count FROM daily_rollup WHERE username = ? AND date >= ? ORDER BY date",
+    "day_items": "SELECT id, item_name, score, category FROM calendar WHERE username = ? AND date = ?",
+    "history_50": """
+        SELECT date, item_name, score, category FROM calendar
+        WHERE username = ? ORDER BY date DESC, id DESC LIMIT 50
+    """,
+}
+
+
+def username(i):
+    return f"user{i:06d}"
+
+
+def build(db_path, users, rows, clustered=True):
+    """Fresh DB at db_path with `rows` generated log rows spread evenly over `users` users."""
+    for suffix in ("", ".wal"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    with contextlib.redirect_stdout(None):  # migration log lines would break up the table
+        con = init_user_db(duckdb.connect(db_path), archive_dir=db_path + ".archive")
+    rows_per_user = max(1, rows // users)
+    items = "[" + ", ".join(f"'{i}'" for i in ITEMS) + "]"
+    order = "username, date" if clustered else "hash(i)"
+    start = time.perf_counter()
+    con.execute(f"""
+        INSERT INTO calendar ({CALENDAR_COLUMNS})
+        SELECT username, date, item_name, score,
+               CASE WHEN score < 3.0 THEN 'healthy' WHEN score < 7.0 THEN 'moderate' ELSE 'unhealthy' END
+        FROM (
+            SELECT i,
+                   'user' || lpad(CAST(i // {rows_per_user} AS VARCHAR), 6, '0') AS username,
+                   DATE '{END_DATE}' - CAST(hash(i) % {HISTORY_DAYS} AS INTEGER) AS date,
+                   list_element({items}, CAST(hash(i * 3) % {len(ITEMS)} AS INTEGER) + 1) AS item_name,
+                   CAST((hash(i * 7) % 110) / 10.0 - 1.0 AS FLOAT) AS score
+            FROM range({users * rows_per_user}) t(i)
+        )
+        ORDER BY {order}
+    """)
+    rebuild_daily_rollup(con)
+    con.execute("CHECKPOINT")
+    return con, time.perf_counter() - start
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def time_queries(con, users, samples, seed=7):
+    rng = random.Random(seed)
+    latencies = {name: [] for name in QUERIES}
+    for _ in range(samples):
+        user = username(rng.randrange(users))
+        day = END_DATE - timedelta(days=rng.randrange(HISTORY_DAYS))
+        params = {
+            "trend_30d": [user, END_DATE - timedelta(days=29)],
+            "trend_rollup": [user, END_DATE - timedelta(days=29)],
+            "day_items": [user, day],
+            "history_50": [user],
+        }
+        for name, sql in QUERIES.items():
+            start = time.perf_counter()
+            con.execute(sql, params[name]).fetchall()
+            latencies[name].append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calendar schema scale benchmark")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--rows", type=int, default=50_000_000)
+    parser.add_argument("--steps", type=int, default=4, help="Table sizes to test, doubling up to --users")
+    parser.add_argument("--samples", type=int, default=200, help="Random users queried per step")
+    parser.add_argument("--db", default="/tmp/bench_calendar.db")
+    parser.add_argument("--unclustered", action="store_true", help="Insert rows in random order instead")
+    args = parser.parse_args()
+
+    rows_per_user = max(1, args.rows // args.users)
+    print(f"📊 Calendar benchmark: up to {args.users:,} users × {rows_per_user} rows "
+          f"({'unclustered' if args.unclustered else 'clustered by user'})\n")
+    print(f"{'rows':>12} {'build s':>8}  " + "  ".join(f"{q + ' p50/p95 ms':>24}" for q in QUERIES))
+
+    for step in range(args.steps - 1, -1, -1):
+        users = max(1, args.users >> step)
+        con, build_s = build(args.db, users, users * rows_per_user, clustered=not args.unclustered)
+        total = con.execute("SELECT COUNT(*) FROM calendar").fetchone()[0]
+        time_queries(con, users, 20)  # warm-up
+        latencies = time_queries(con, users, args.samples)
+        cols = "  ".join(f"{percentile(v, 50):>11.2f} / {percentile(v, 95):>8.2f}" for v in latencies.values())
+        print(f"{total:>12,} {build_s:>8.1f}  {cols}")
+        con.close()
+
+    for suffix in ("", ".wal"):
+        if os.path.exists(args.db + suffix):
+            os.remove(args.db + suffix)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Per-interaction server time of the dashboard.
+
+Starts the app with `streamlit run` on a scratch user DB seeded with a month of
+logs, connects to it over the websocket like a browser would and clicks through
+the dashboard (trend tabs, scanner start/stop, sidebar search) and the calendar
+search. For every interaction it reports the time from sending the click to the
+end of the script run, how many script runs it took and how many elements (and
+KB of element messages) were sent back.
+
+Usage:
+    python src/bench_interactions.py
+    python src/bench_interactions.py --rounds 20 --port 8765
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import logging
+import tempfile
+import statistics
+import subprocess
+import urllib.request
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER = "demo_user"
+ITEMS = [("Apple", 1.2), ("Greek Yogurt", 2.1), ("Granola", 5.4), ("Cola", 8.9), ("Lentil Soup", 1.8), ("Chips", 9.1)]
+
+# (label, kind, value): buttons are clicked, text inputs are set to value
+INTERACTIONS = [
+    ("Month", "button", None),
+    ("Day", "button", None),
+    ("Week", "button", None),
+    ("Start Live Scan", "button", None),
+    ("❌ Stop Scanning", "button", None),
+    ("Quick check score", "text", "a"),
+    ("Quick check score", "text", ""),
+    ("📅 Calendar", "button", None),
+    ("Search for an item", "text", "a"),
+    ("Search for an item", "text", ""),
+    ("🏠 Dashboard", "button", None),
+]
+
+
+def seed(db_path, days=30, per_day=6):
+    """A month of logs for the demo user, so the trend chart and coach have data"""
+    import duckdb
+    from gemini_api import init_user_db, rebuild_daily_rollup, CALENDAR_COLUMNS
+
+    rng = random.Random(7)
+    rows = []
+    for d in range(days):
+        day = (date.today() - timedelta(days=d)).isoformat()
+        for _ in range(per_day):
+            name, score = rng.choice(ITEMS)
+            category = "healthy" if score < 3.0 else "moderate" if score < 7.0 else "unhealthy"
+            rows.append((USER, day, name, score, category))
+    con = init_user_db(duckdb.connect(db_path), archive_dir=db_path + ".archive")
+    con.executemany(f"INSERT INTO calendar ({CALENDAR_COLUMNS}) VALUES (?, ?, ?, ?, ?)", rows)
+    rebuild_daily_rollup(con)
+    con.execute("CHECKPOINT")
+    con.close()
+
+
+class Session:
+    """Minimal websocket client: sends reruns with widget states, reads ForwardMsgs until the run ends"""
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.widgets = {}  # label -> (widget id, fragment id)
+        self.values = {}   # widget id -> text value sent with every rerun
+
+    async def rerun(self, trigger=None, fragment_id=""):
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        msg = BackMsg()
+        msg.rerun_script.query_string = ""
+        for widget_id, value in self.values.items():
+            state = msg.rerun_script.widget_states.widgets.add()
+            state.id, state.string_value = widget_id, value
+        if trigger:
+            state = msg.rerun_script.widget_states.widgets.add()
+            state.id, state.trigger_value = trigger, True
+        if fragment_id:
+            msg.rerun_script.fragment_id = fragment_id
+
+        runs, elements, size = 0, 0, 0
+        start = time.perf_counter()
+        await self.ws.write_message(msg.SerializeToString(), binary=True)
+        while True:
+            raw = await self.ws.read_message()
+            if raw is None:
+                raise ConnectionError("App closed the websocket")
+            fwd = ForwardMsg()
+            fwd.ParseFromString(raw)
+            kind = fwd.WhichOneof("type")
+            if kind == "delta" and fwd.delta.WhichOneof("type") == "new_element":
+                elements += 1
+                size += len(raw)
+                element = fwd.delta.new_element
+                widget = getattr(element, element.WhichOneof("type"))
+                if element.WhichOneof("type") in ("button", "text_input"):
+                    self.widgets[widget.label] = (widget.id, fwd.delta.fragment_id)
+            elif kind == "script_finished":
+                runs += 1
+                if fwd.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    return time.perf_counter() - start, runs, elements, size
+
+    async def interact(self, label, kind, value):
+        widget_id, fragment_id = self.widgets[label]
+        if kind == "button":
+            return await self.rerun(trigger=widget_id, fragment_id=fragment_id)
+        self.values[widget_id] = value
+        return await self.rerun(fragment_id=fragment_id)
+
+
+async def drive(url, rounds):
+    from tornado.websocket import websocket_connect
+
+    ws = await websocket_connect(url, subprotocols=["streamlit", "PLACEHOLDER_AUTH_TOKEN"], max_message_size=200 << 20)
+    session = Session(ws)
+    first = await session.rerun()
+    timings = {}
+    for r in range(rounds + 1):  # round 0 warms the caches
+        for label, kind, value in INTERACTIONS:
+            result = await session.interact(label, kind, value)
+            if r:
+                timings.setdefault((label, value), []).append(result)
+    ws.close()
+    return first, timings
+
+
+def wait_for_app(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=2)
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError("App did not start")
+            time.sleep(0.3)
+
+
+def main():
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").setLevel(logging.ERROR)
+    parser = argparse.ArgumentParser(description="Dashboard per-interaction server time")
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="fv_interactions_")
+    db_path = os.path.join(workdir, "user_data.db")
+    seed(db_path)
+    env = dict(os.environ, FOODVANTAGE_USER_DB=db_path)
+    env.pop("FOODVANTAGE_STORAGE_ADDRS", None)
+    app = subprocess.Popen([sys.executable, "-m", "streamlit", "run", os.path.join(ROOT, "app.py"),
+                            "--server.port", str(args.port), "--server.headless", "true"],
+                           cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_app(args.port)
+        first, timings = asyncio.run(drive(f"ws://127.0.0.1:{args.port}/_stcore/stream", args.rounds))
+    finally:
+        app.terminate()
+        app.wait(timeout=30)
+
+    print(f"⏱️ Dashboard interactions, median of {args.rounds} rounds\n")
+    print(f"{'interaction':<28} {'ms':>8} {'runs':>5} {'elements':>9} {'KB':>7}")
+    print(f"{'first load':<28} {first[0] * 1000:>8.1f} {first[1]:>5} {first[2]:>9} {first[3] / 1024:>7.1f}")
+    for (label, value), results in timings.items():
+        name = label if value is None else f"{label} = {value!r}"
+        print(f"{name:<28} {statistics.median(r[0] for r in results) * 1000:>8.1f} "
+              f"{results[0][1]:>5} {results[0][2]:>9} {results[0][3] / 1024:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Hot/cold tiering for the calendar.
+
+Rows older than the hot horizon are moved out of the `calendar` table into
+Parquet files partitioned by year and month:
+
+    <archive_dir>/year=2025/month=3/run<id>_0.parquet
+
+The `calendar_all` view unions the hot table with the archive. Reads that pass
+year/month bounds (see month_bounds) only open the matching partitions, so the
+hot table stays small while the full history remains queryable. Archived rows
+are read-only; daily_rollup keeps covering them.
+"""
+import os
+import re
+import glob
+import uuid
+from datetime import date
+
+COLUMNS = "id, username, date, item_name, score, category"
+
+
+def archive_glob(archive_dir):
+    return os.path.join(archive_dir, "year=*", "month=*", "*.parquet")
+
+
+def has_archive(archive_dir):
+    return bool(glob.glob(archive_glob(archive_dir)))
+
+
+_upper_bounds = {}  # archive_dir -> first date after the newest archived month (None: no archive)
+
+def cold_upper_bound(archive_dir):
+    """
+    Every archived row is dated before this (month granularity, from the partition
+    directories). Reads entirely on or after it can skip the archive. None if empty.
+    """
+    if archive_dir not in _upper_bounds:
+        newest = None
+        for path in glob.glob(archive_glob(archive_dir)):
+            m = re.search(r"year=(\d+)[/\\]month=(\d+)", path)
+            if m and (newest is None or (int(m.group(1)), int(m.group(2))) > newest):
+                newest = (int(m.group(1)), int(m.group(2)))
+        _upper_bounds[archive_dir] = None if newest is None else (
+            date(newest[0] + newest[1] // 12, newest[1] % 12 + 1, 1))
+    return _upper_bounds[archive_dir]
+
+
+def create_calendar_view(cur, archive_dir):
+    """(Re)creates calendar_all: hot rows, plus archived rows when there are any"""
+    _upper_bounds.pop(archive_dir, None)
+    hot = f"SELECT {COLUMNS}, year(date) AS year, month(date) AS month, 'hot' AS tier FROM calendar"
+    if has_archive(archive_dir):
+        path = archive_glob(archive_dir).replace("'", "''")
+        cold = (f"SELECT {COLUMNS}, year, month, 'cold' AS tier "
+                f"FROM read_parquet('{path}', hive_partitioning = true, union_by_name = true)")
+        cur.execute(f"CREATE OR REPLACE VIEW calendar_all AS {hot} UNION ALL {cold}")
+    else:
+        cur.execute(f"CREATE OR REPLACE VIEW calendar_all AS {hot}")
+
+
+def month_bounds(start_date, end_date=None):
+    """
+    SQL predicate and params limiting calendar_all to the months spanned by the dates,
+    so the archive is pruned to those partitions. Dates may be date objects or 'YYYY-MM-DD'.
+    """
+    start = str(start_date)[:7]
+    if end_date is None:
+        return "(year * 100 + month) >= ?", [int(start[:4]) * 100 + int(start[5:7])]
+    end = str(end_date)[:7]
+    return ("(year * 100 + month) BETWEEN ? AND ?",
+            [int(start[:4]) * 100 + int(start[5:7]), int(end[:4]) * 100 + int(end[5:7])])
+
+
+def archive_calendar(cur, archive_dir, cutoff):
+    """
+    Moves calendar rows dated before cutoff into the Parquet archive, inside the
+    caller's transaction: files are written first, then the rows are deleted and the
+    view is switched over. If anything fails, this run's files are removed again.
+    The files are not rolled back with the transaction, so it must hold nothing else
+    (BatchWriter.submit(..., exclusive=True)).
+
+    Returns:
+        number of rows archived
+    """
+    rows = cur.execute("SELECT COUNT(*) FROM calendar WHERE date < ?", [cutoff]).fetchone()[0]
+    if not rows:
+        return 0
+    os.makedirs(archive_dir, exist_ok=True)
+    run_id = uuid.uuid4().hex[:12]
+    path = archive_dir.replace("'", "''")
+    try:
+        cur.execute(f"""
+            COPY (
+                SELECT {COLUMNS}, year(date) AS year, month(date) AS month
+                FROM calendar WHERE date < ?
+                ORDER BY username, date, id
+            ) TO '{path}' (FORMAT PARQUET, COMPRESSION ZSTD, PARTITION_BY (year, month),
+                           FILENAME_PATTERN 'run{run_id}_{{i}}', OVERWRITE_OR_IGNORE)
+        """, [cutoff])
+        cur.execute("DELETE FROM calendar WHERE date < ?", [cutoff])
+        create_calendar_view(cur, archive_dir)
+    except Exception:
+        for f in glob.glob(os.path.join(archive_dir, "year=*", "month=*", f"run{run_id}_*.parquet")):
+            os.remove(f)
+        raise
+    return rows
@@ -0,0 +1,177 @@
+"""
+Bulk import / export of calendar logs in Parquet, CSV or JSONL.
+
+Everything runs inside DuckDB (COPY ... TO, read_parquet / read_csv / read_json),
+so rows stream between the file and the table without passing through Python
+lists. Functions take a cursor so they work on the app's batch writer as well
+as on a connection opened by db_admin.py.
+
+Import:
+    - username comes from the file, or from the `username` argument (which wins)
+    - rows without a score are rescored in bulk from the products index (scores passed in)
+    - category is always recomputed from the score
+    - rows already in the calendar are skipped, so re-importing an export is a no-op;
+      legitimate repeats (two apples on the same day) are kept by matching occurrences
+    - calendar and daily_rollup are updated in the caller's transaction
+"""
+import os
+
+FORMATS = {
+    "parquet": ("(FORMAT PARQUET, COMPRESSION ZSTD)", "read_parquet(?)"),
+    "csv": ("(FORMAT CSV, HEADER)", "read_csv_auto(?, header = true)"),
+    "jsonl": ("(FORMAT JSON)", "read_json_auto(?, format = 'newline_delimited')"),
+}
+EXTENSIONS = {".parquet": "parquet", ".pq": "parquet", ".csv": "csv", ".jsonl": "jsonl", ".json": "jsonl", ".ndjson": "jsonl"}
+
+CATEGORY_SQL = "CASE WHEN score < 3.0 THEN 'healthy' WHEN score < 7.0 THEN 'moderate' ELSE 'unhealthy' END"
+
+
+def detect_format(path, fmt=None):
+    """Format name from an explicit fmt or the file extension"""
+    fmt = fmt or EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported format for {path!r} (use one of: {', '.join(FORMATS)})")
+    return fmt
+
+
+def export_calendar(cur, path, username=None, fmt=None, usernames=None):
+    """
+    Writes one user's calendar (or these users', or every user's, when both are None) to path.
+    Returns the number of rows written.
+    """
+    copy_options, _ = FORMATS[detect_format(path, fmt)]
+    if username is None:
+        where, params = ("", []) if usernames is None else (
+            "WHERE username IN (SELECT unnest(?::VARCHAR[]))", [list(usernames)])
+        sql = f"""
+            COPY (SELECT username, date, item_name, score, category FROM calendar_all {where} ORDER BY username, date, id)
+            TO '{_quote(path)}' {copy_options}
+        """
+        return cur.execute(sql, params).fetchone()[0]
+    sql = f"""
+        COPY (SELECT date, item_name, score, category FROM calendar_all WHERE username = ? ORDER BY date, id)
+        TO '{_quote(path)}' {copy_options}
+    """
+    return cur.execute(sql, [username]).fetchone()[0]
+
+
+def _quote(path):
+    return str(path).replace("'", "''")
+
+
+def _source(cur, path, fmt, username, usernames=None):
+    """
+    (sql, params) selecting username, date, item_name, score from the file with normalised
+    types; with usernames, only those users' rows (e.g. the ones that belong to a shard)
+    """
+    _, reader = FORMATS[detect_format(path, fmt)]
+    columns = {row[0].lower() for row in cur.execute(f"DESCRIBE SELECT * FROM {reader}", [path]).fetchall()}
+    missing = {"date", "item_name"} - columns
+    if missing:
+        raise ValueError(f"{path} is missing required column(s): {', '.join(sorted(missing))}")
+    if username is None and "username" not in columns:
+        raise ValueError(f"{path} has no username column; pass the user to import into")
+    user_expr = "CAST(? AS VARCHAR)" if username is not None else "CAST(username AS VARCHAR)"
+    score_expr = "TRY_CAST(score AS FLOAT)" if "score" in columns else "CAST(NULL AS FLOAT)"
+    sql = f"""
+        SELECT {user_expr} AS username, TRY_CAST(date AS DATE) AS date,
+               TRIM(CAST(item_name AS VARCHAR)) AS item_name, {score_expr} AS score
+        FROM {reader}
+    """
+    params = ([username] if username is not None else []) + [path]
+    if usernames is not None:
+        sql = f"SELECT * FROM ({sql}) WHERE username IN (SELECT unnest(?::VARCHAR[]))"
+        params.append(list(usernames))
+    return sql, params
+
+
+def file_usernames(cur, path, fmt=None):
+    """Distinct usernames in a file that has a username column"""
+    sql, params = _source(cur, path, fmt, None)
+    return [r[0] for r in cur.execute(f"SELECT DISTINCT username FROM ({sql}) WHERE username IS NOT NULL", params).fetchall()]
+
+
+def unscored_item_names(cur, path, fmt=None, username=None, usernames=None):
+    """Distinct item names in the file that have no score, for the batch scorer"""
+    sql, params = _source(cur, path, fmt, username, usernames)
+    rows = cur.execute(f"SELECT DISTINCT item_name FROM ({sql}) WHERE score IS NULL AND item_name <> ''", params).fetchall()
+    return [r[0] for r in rows]
+
+
+def import_calendar(cur, path, fmt=None, username=None, scores=None, usernames=None):
+    """
+    Imports a calendar file in the caller's transaction.
+
+    Args:
+        cur: cursor on the user DB (inside a transaction)
+        scores: {item_name: score} for unscored rows (from the batch scorer); rows still
+                without a score after this are skipped
+        usernames: only import these users' rows (the rest of the file is ignored)
+    Returns:
+        dict with read / inserted / duplicates / rescored / skipped counts and the
+        usernames that received rows
+    """
+    sql, params = _source(cur, path, fmt, username, usernames)
+    cur.execute(f"CREATE OR REPLACE TEMP TABLE import_source AS {sql}", params)
+
+    cur.execute("CREATE OR REPLACE TEMP TABLE import_scores (item_name VARCHAR, score FLOAT)")
+    scored = {name: score for name, score in (scores or {}).items() if score is not None}
+    if scored:
+        cur.execute("INSERT INTO import_scores SELECT unnest(?::VARCHAR[]), unnest(?::FLOAT[])",
+                    [list(scored), list(scored.values())])
+
+    # Rescore, then number identical rows so repeats inside the file and in the table line up.
+    # seq is the row's position in the file, so items logged on the same day keep their order.
+    cur.execute(f"""
+        CREATE OR REPLACE TEMP TABLE import_rows AS
+        WITH scored AS (
+            SELECT s.rowid AS seq, s.username, s.date, s.item_name,
+                   COALESCE(s.score, sc.score) AS score,
+                   s.score IS NULL AND sc.score IS NOT NULL AS rescored
+            FROM import_source s
+            LEFT JOIN import_scores sc ON sc.item_name = s.item_name
+            WHERE s.username IS NOT NULL AND s.date IS NOT NULL AND s.item_name IS NOT NULL AND s.item_name <> ''
+        )
+        SELECT *, {CATEGORY_SQL} AS category,
+               row_number() OVER (PARTITION BY username, date, item_name, score ORDER BY seq) AS occurrence
+        FROM scored
+        WHERE score IS NOT NULL
+    """)
+    cur.execute("""
+        CREATE OR REPLACE TEMP TABLE import_new AS
+        SELECT i.* FROM import_rows i
+        ANTI JOIN (
+            SELECT c.username, c.date, c.item_name, c.score,
+                   row_number() OVER (PARTITION BY c.username, c.date, c.item_name, c.score) AS occurrence
+            FROM calendar_all c
+            WHERE c.username IN (SELECT DISTINCT username FROM import_rows)
+        ) e
+        ON e.username = i.username AND e.date = i.date AND e.item_name = i.item_name
+           AND e.score = i.score AND e.occurrence = i.occurrence
+    """)
+
+    cur.execute("""
+        INSERT INTO calendar (username, date, item_name, score, category)
+        SELECT username, date, item_name, score, category FROM import_new ORDER BY username, date, seq
+    """)
+    cur.execute("""
+        INSERT INTO daily_rollup
+        SELECT username, date, category, COUNT(*), SUM(score) FROM import_new GROUP BY username, date, category
+        ON CONFLICT (username, date, category) DO UPDATE
+        SET count = count + EXCLUDED.count, score_sum = score_sum + EXCLUDED.score_sum
+    """)
+
+    read = cur.execute("SELECT COUNT(*) FROM import_source").fetchone()[0]
+    valid, rescored = cur.execute("SELECT COUNT(*), COUNT(*) FILTER (WHERE rescored) FROM import_rows").fetchone()
+    inserted = cur.execute("SELECT COUNT(*) FROM import_new").fetchone()[0]
+    users = [r[0] for r in cur.execute("SELECT DISTINCT username FROM import_new").fetchall()]
+    for table in ("import_source", "import_scores", "import_rows", "import_new"):
+        cur.execute(f"DROP TABLE IF EXISTS {table}")
+    return {
+        "read": read,
+        "inserted": inserted,
+        "duplicates": valid - inserted,
+        "rescored": rescored,
+        "skipped": read - valid,
+        "users": users,
+    }
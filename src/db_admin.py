@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Maintenance commands for the user DB.
+
+Usage:
+    python src/db_admin.py status
+    python src/db_admin.py rebuild-rollup
+    python src/db_admin.py --db /path/to/user_data.db rebuild-rollup
+    python src/db_admin.py export-all all_users.parquet
+    python src/db_admin.py export alice.csv --user alice
+    python src/db_admin.py import backfill.parquet [--user alice]
+    python src/db_admin.py checkpoint
+    python src/db_admin.py archive [--hot-days 365 | --before 2025-01-01]
+    python src/db_admin.py compact
+    python src/db_admin.py --shard 2 status          # one shard of a sharded user DB
+
+DuckDB allows one writing process per file, so run these while the app (or the
+shard's storage service) is stopped. Opening the DB also applies any pending
+schema migrations. To change the number of shards, see user_shards.py.
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+from datetime import datetime, timedelta
+
+import duckdb
+
+sys.path.append(os.path.dirname(__file__))
+from gemini_api import (init_user_db, rebuild_daily_rollup, compact_calendar, score_item_names, user_shard,
+                        USER_DB_PATHS, ARCHIVE_DIRS, USER_DB_SHARDS, HOT_DAYS)
+from calendar_archive import archive_calendar
+from calendar_io import export_calendar, import_calendar, unscored_item_names, file_usernames
+
+logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").setLevel(logging.ERROR)
+
+
+def cmd_status(con, args):
+    version = con.execute("SELECT MAX(version) FROM schema_version").fetchone()[0]
+    print(f"Schema version: v{version}")
+    for table in ("users", "calendar", "daily_rollup", "coach_insights"):
+        print(f"  {table:<15} {con.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]:>12,} rows")
+
+
+def cmd_rebuild_rollup(con, args):
+    start = time.perf_counter()
+    con.execute("BEGIN TRANSACTION")
+    try:
+        rows = rebuild_daily_rollup(con)
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    print(f"✅ Rebuilt daily_rollup: {rows:,} rows in {time.perf_counter() - start:.2f}s")
+
+
+def cmd_checkpoint(con, args):
+    wal_path = args.db + ".wal"
+    wal = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+    start = time.perf_counter()
+    con.execute("CHECKPOINT")
+    print(f"✅ Checkpointed {wal / 1024:.0f} KB of WAL in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+
+def cmd_compact(con, args):
+    """
+    Full offline compaction: re-cluster every row, then copy the database into a
+    fresh file (DuckDB never shrinks a file in place) and swap it in.
+    """
+    before = os.path.getsize(args.db)
+    start = time.perf_counter()
+    con.execute("BEGIN TRANSACTION")
+    try:
+        rows = compact_calendar(con)
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    source = con.execute("SELECT current_database()").fetchone()[0]
+    fresh = args.db + ".compact"
+    if os.path.exists(fresh):
+        os.remove(fresh)
+    con.execute(f"ATTACH '{fresh}' AS compacted")
+    con.execute(f"COPY FROM DATABASE \"{source}\" TO compacted")
+    con.execute("DETACH compacted")
+    con.close()
+    os.replace(fresh, args.db)
+    print(f"✅ Compacted calendar ({rows:,} rows) in {time.perf_counter() - start:.2f}s; "
+          f"file {before / 1e6:.1f} MB → {os.path.getsize(args.db) / 1e6:.1f} MB")
+
+
+def cmd_archive(con, args):
+    cutoff = args.before or (datetime.now().date() - timedelta(days=args.hot_days)).isoformat()
+    start = time.perf_counter()
+    con.execute("BEGIN TRANSACTION")
+    try:
+        rows = archive_calendar(con, args.archive_dir, cutoff)
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    con.execute("CHECKPOINT")
+    print(f"✅ Archived {rows:,} rows dated before {cutoff} to {args.archive_dir} in {time.perf_counter() - start:.2f}s")
+
+
+def cmd_export(con, args):
+    start = time.perf_counter()
+    rows = export_calendar(con, args.path, username=args.user, fmt=args.format)
+    print(f"✅ Exported {rows:,} rows to {args.path} in {time.perf_counter() - start:.2f}s")
+
+
+def cmd_export_all(con, args):
+    args.user = None
+    cmd_export(con, args)
+
+
+def cmd_import(con, args):
+    start = time.perf_counter()
+    usernames = None
+    if USER_DB_SHARDS > 1:
+        # Only this shard's users: run the import once per shard to load a multi-user file
+        if args.user is not None and user_shard(args.user) != args.shard:
+            sys.exit(f"{args.user} belongs to shard {user_shard(args.user)}, not {args.shard}")
+        if args.user is None:
+            usernames = [u for u in file_usernames(con, args.path, args.format) if user_shard(u) == args.shard]
+    names = unscored_item_names(con, args.path, fmt=args.format, username=args.user, usernames=usernames)
+    scores = score_item_names(names) if names else {}
+    con.execute("BEGIN TRANSACTION")
+    try:
+        stats = import_calendar(con, args.path, fmt=args.format, username=args.user, scores=scores, usernames=usernames)
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    print(f"✅ Imported {args.path} in {time.perf_counter() - start:.2f}s: {stats['read']:,} read, "
+          f"{stats['inserted']:,} inserted, {stats['duplicates']:,} duplicates, "
+          f"{stats['rescored']:,} rescored, {stats['skipped']:,} skipped")
+
+
+# name -> (handler, help, extra arguments)
+COMMANDS = {
+    "status": (cmd_status, "Schema version and table sizes", []),
+    "rebuild-rollup": (cmd_rebuild_rollup, "Recompute daily_rollup from the calendar table", []),
+    "checkpoint": (cmd_checkpoint, "Flush the WAL into the DB file", []),
+    "compact": (cmd_compact, "Re-cluster calendar and rewrite the DB file to reclaim space", []),
+    "archive": (cmd_archive, "Move rows past the hot horizon to the Parquet archive",
+                [("--hot-days", {"type": int, "default": HOT_DAYS}), ("--before", {"help": "Archive rows dated before YYYY-MM-DD"})]),
+    "export": (cmd_export, "Export one user's calendar (.parquet/.csv/.jsonl)",
+               [("path", {}), ("--user", {"required": True}), ("--format", {})]),
+    "export-all": (cmd_export_all, "Export every user's calendar", [("path", {}), ("--format", {})]),
+    "import": (cmd_import, "Bulk import a calendar file in one transaction",
+               [("path", {}), ("--user", {"help": "Import into this user (required if the file has no username column)"}),
+                ("--format", {})]),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FoodVantage user DB maintenance")
+    parser.add_argument("--shard", type=int, default=0, help=f"Shard to open (FOODVANTAGE_USER_SHARDS={USER_DB_SHARDS})")
+    parser.add_argument("--db", help=f"User DB path (default: the shard's, {USER_DB_PATHS[0]} for shard 0)")
+    parser.add_argument("--archive-dir", help="Parquet archive directory (default: the shard's)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name, (_, help_text, arguments) in COMMANDS.items():
+        cmd = sub.add_parser(name, help=help_text)
+        for arg, kwargs in arguments:
+            cmd.add_argument(arg, **kwargs)
+    args = parser.parse_args()
+    if not 0 <= args.shard < USER_DB_SHARDS:
+        parser.error(f"--shard must be below FOODVANTAGE_USER_SHARDS={USER_DB_SHARDS}")
+    if args.db is None:
+        args.db, args.archive_dir = USER_DB_PATHS[args.shard], args.archive_dir or ARCHIVE_DIRS[args.shard]
+    args.archive_dir = args.archive_dir or os.path.join(os.path.dirname(os.path.abspath(args.db)), "calendar_archive")
+
+    con = init_user_db(duckdb.connect(args.db), archive_dir=args.archive_dir)
+    try:
+        COMMANDS[args.command][0](con, args)
+    finally:
+        con.close()
+
+
+if __name__ == "__main__":
+    main()
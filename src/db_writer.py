@@ -0,0 +1,132 @@
+"""
+Single writer thread for the user DB.
+
+Sessions submit write operations and get a Future back. The writer drains the
+queue in batches and runs each batch in one transaction (group commit), so
+concurrent users never share a cursor and commits are amortised across writes.
+If a batch fails, its operations are retried one by one so only the bad one
+errors. Operations with side effects outside the database (files) can't be
+rolled back and retried like that: submit them with exclusive=True to run alone
+in their own transaction. Maintenance statements that can't run inside a
+transaction (CHECKPOINT) go through run_exclusive. Both run between batches.
+"""
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+import metrics
+from logs import get_logger
+
+log = get_logger("db_writer")
+
+MAX_BATCH = 256       # operations per transaction
+MAX_WAIT = 0.005      # seconds to wait for more operations after the first one arrives
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+metrics.describe("db_writer_batch_seconds", "Group commits: one transaction for a batch of writes")
+metrics.describe("db_writer_batch_ops", "Operations per group commit")
+
+
+class BatchWriter:
+    def __init__(self, cursor, max_batch=MAX_BATCH, max_wait=MAX_WAIT, name="user-db-writer"):
+        self.cursor = cursor  # owned by the writer thread only
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self._held = None  # exclusive op pulled off the queue while filling a batch
+        self.stats = {"batches": 0, "ops": 0, "failed_batches": 0, "largest_batch": 0}
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, exclusive=False):
+        """
+        Queue fn(cursor) to run inside the writer's next transaction.
+        Returns a Future resolved with fn's return value once the transaction commits.
+
+        Batched operations may run twice: when another operation of the batch fails,
+        the batch is rolled back and each operation is rerun in its own transaction.
+        So fn must only change the database. With exclusive=True, fn runs alone in its
+        own transaction and is never batched or rerun; use it for operations that
+        also write files (archiving to Parquet).
+        """
+        future = Future()
+        self.queue.put((fn, future, exclusive, True))
+        return future
+
+    def run_exclusive(self, fn):
+        """Queue fn(cursor) to run alone, outside any transaction (e.g. CHECKPOINT). Returns a Future."""
+        future = Future()
+        self.queue.put((fn, future, True, False))
+        return future
+
+    def execute(self, sql, params=None):
+        """Shortcut for a single statement. Returns a Future of its fetched rows."""
+        return self.submit(lambda cur: cur.execute(sql, params or []).fetchall())
+
+    def _next_batch(self):
+        if self._held is not None:
+            first, self._held = self._held, None
+        else:
+            first = self.queue.get()
+        batch = [first]
+        if first[2]:
+            return batch
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=max(remaining, 0)) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item[2]:
+                self._held = item  # runs right after this batch
+                break
+            batch.append(item)
+        return batch
+
+    def _run_exclusive(self, item):
+        fn, future, _, transaction = item
+        try:
+            # Not rerun when it fails: the caller decides whether to retry or report
+            future.set_result(self._run_transaction([item])[0] if transaction else fn(self.cursor))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _run_transaction(self, batch):
+        self.cursor.execute("BEGIN TRANSACTION")
+        try:
+            results = [fn(self.cursor) for fn, *_ in batch]
+            self.cursor.execute("COMMIT")
+            return results
+        except Exception:
+            self.cursor.execute("ROLLBACK")
+            raise
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch[0][2]:
+                self._run_exclusive(batch[0])
+                continue
+            start = time.perf_counter()
+            try:
+                results = self._run_transaction(batch)
+                for (_, future, *_), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as batch_error:
+                self.stats["failed_batches"] += 1
+                # Isolate the failing operation(s): rerun each in its own transaction
+                for item in batch:
+                    future = item[1]
+                    try:
+                        future.set_result(self._run_transaction([item])[0])
+                    except Exception as e:
+                        future.set_exception(e)
+                if len(batch) == 1:
+                    log.error("Write failed", writer=self.thread.name, error=str(batch_error))
+            metrics.observe("db_writer_batch_seconds", time.perf_counter() - start, writer=self.thread.name)
+            metrics.observe("db_writer_batch_ops", len(batch), buckets=BATCH_SIZE_BUCKETS, writer=self.thread.name)
+            self.stats["batches"] += 1
+            self.stats["ops"] += len(batch)
+            self.stats["largest_batch"] = max(self.stats["largest_batch"], len(batch))
@@ -3,16 +3,29 @@ import os
 import zipfile
 import streamlit as st
 import hashlib
-from openai import OpenAI
+import json
+import threading
+import functools
+import time
+import tempfile
 from dotenv import load_dotenv
-from PIL import Image
-import io
-import base64
-import requests
 from datetime import datetime, timedelta
+import metrics
+import profiler
+from logs import get_logger
+from llm_client import chat_completion, is_rate_limit_error
+from shared_cache import SingleFlight, JsonDiskCache, VersionedCache, NoCache
+from prompt_builder import PromptBuilder, compress_history
+from db_writer import BatchWriter
+from calendar_io import export_calendar, import_calendar, unscored_item_names, detect_format, file_usernames
+from calendar_archive import archive_calendar, create_calendar_view, cold_upper_bound, month_bounds
+from user_shards import shard_for, shard_paths
+from storage_service import StorageClient, parse_addresses
 
 load_dotenv()
 
+log = get_logger("gemini_api")
+
 # === 1. VMS ALGORITHM (ENHANCED FOR FIX 5) ===
 # Serving size ratios (fraction of 100g that represents one serving)
 # Used to scale per-100g nutrition data to realistic portions
@@ -130,185 +143,231 @@ def get_scientific_db():
             zip_ref.extractall('/tmp/')
     return duckdb.connect(db_path, read_only=True)
 
+def get_rating(score):
+    return "Metabolic Green" if score < 3.0 else "Metabolic Yellow" if score < 7.0 else "Metabolic Red"
+
+def score_product_row(row):
+    """
+    Scores a raw product row [name, brand, cal, sug, fib, prot, fat, sod, carbs, nova]
+    and builds the result dict shown in the UI
+    """
+    score = calculate_vms_science(row)
+    full_name = str(row[0]).title()
+    brand = str(row[1]).title() if row[1] and str(row[1]).strip() else ""
+
+    if brand and brand not in full_name:
+        display_name = f"{brand} {full_name}"
+    else:
+        display_name = full_name
+
+    return {
+        "name": display_name,
+        "brand": brand,
+        "vms_score": score,
+        "rating": get_rating(score),
+        "raw": row
+    }
+
+MAX_FALLBACK_LOOKUPS = 200  # per-name fuzzy searches the batch scorer will do for names without an exact match
+
+def score_item_names(names):
+    """
+    Batch scorer: VMS for many item names at once (e.g. a calendar import).
+    Exact product-name matches are resolved in one join; the remaining names fall
+    back to the usual fuzzy search, up to MAX_FALLBACK_LOOKUPS of them.
+
+    Returns:
+        {name: score or None}
+    """
+    names = list(dict.fromkeys(n for n in names if n))
+    if not names:
+        return {}
+    scores = {}
+    try:
+        rows = get_scientific_db().cursor().execute("""
+            SELECT n.name, p.*
+            FROM unnest(?::VARCHAR[]) AS n(name)
+            JOIN products p ON LOWER(p.product_name) = LOWER(n.name)
+            QUALIFY row_number() OVER (PARTITION BY n.name ORDER BY (p.brand IS NULL OR p.brand = '') DESC) = 1
+        """, [names]).fetchall()
+        for row in rows:
+            scores[row[0]] = calculate_vms_science(row[1:])
+    except Exception as e:
+        log.warning("Batch scorer exact-match join failed", error=str(e))
+
+    for name in [n for n in names if n not in scores][:MAX_FALLBACK_LOOKUPS]:
+        try:
+            rows = query_vantage_rows(name, limit=1)
+            scores[name] = calculate_vms_science(rows[0]) if rows else None
+        except Exception as e:
+            log.warning("Batch scorer lookup failed", name=name, error=str(e))
+    log.info("Batch scored names", scored=sum(v is not None for v in scores.values()), names=len(names))
+    return {name: scores.get(name) for name in names}
+
+metrics.describe("product_search_seconds", "Product lookups: local index query or the whole Open Food Facts fallback")
+metrics.describe("off_request_seconds", "Single Open Food Facts HTTP requests")
+metrics.describe("off_responses_total", "Open Food Facts responses by HTTP status")
+
+@metrics.timed("product_search_seconds", source="local")
+def query_vantage_rows(product_name: str, limit=5):
+    """Raw product rows from the local index, best matches first"""
+    con = get_scientific_db()
+    if not con: return []
+    safe_name = product_name.replace("'", "''")
+
+    query = f"""
+        SELECT * FROM products 
+        WHERE product_name ILIKE '%{safe_name}%'
+        ORDER BY 
+            CASE 
+                WHEN LOWER(product_name) = LOWER('{safe_name}') THEN 0
+                WHEN product_name NOT LIKE '%,%' AND (brand IS NULL OR brand = '') THEN 1
+                WHEN LENGTH(product_name) - LENGTH(REPLACE(product_name, ' ', '')) <= 2 THEN 2
+                ELSE 3
+            END,
+            LENGTH(product_name),
+            sugar DESC
+        LIMIT {limit}
+    """
+
+    # One cursor per call: the shared connection is used from many session threads
+    return con.cursor().execute(query).fetchall()
+
+@profiler.profile("search")
 def search_vantage_db(product_name: str, limit=5):
     """
     FIX 3: Returns up to 20 results (increased from 5)
     Returns top results with full product names
     """
-    con = get_scientific_db()
-    if not con: return None
     try:
-        safe_name = product_name.replace("'", "''")
-        
-        query = f"""
-            SELECT * FROM products 
-            WHERE product_name ILIKE '%{safe_name}%'
-            ORDER BY 
-                CASE 
-                    WHEN LOWER(product_name) = LOWER('{safe_name}') THEN 0
-                    WHEN product_name NOT LIKE '%,%' AND (brand IS NULL OR brand = '') THEN 1
-                    WHEN LENGTH(product_name) - LENGTH(REPLACE(product_name, ' ', '')) <= 2 THEN 2
-                    ELSE 3
-                END,
-                LENGTH(product_name),
-                sugar DESC
-            LIMIT {limit}
-        """
-        
-        results = con.execute(query).fetchall()
+        results = query_vantage_rows(product_name, limit)
         
         # If no results in local DB, try Open Food Facts API
         if not results or len(results) == 0:
-            print(f"[DB] No results in local database, trying Open Food Facts...")
+            log.debug("No local match, trying Open Food Facts", query=product_name)
             return search_open_food_facts(product_name, limit)
         
-        output = []
-        for r in results:
-            score = calculate_vms_science(r)
-            rating = "Metabolic Green" if score < 3.0 else "Metabolic Yellow" if score < 7.0 else "Metabolic Red"
-            
-            full_name = r[0].title()
-            brand = str(r[1]).title() if r[1] and r[1].strip() else ""
-            
-            if brand and brand not in full_name:
-                display_name = f"{brand} {full_name}"
-            else:
-                display_name = full_name
-            
-            output.append({
-                "name": display_name,
-                "brand": brand,
-                "vms_score": score, 
-                "rating": rating, 
-                "raw": r
-            })
+        return [score_product_row(r) for r in results]
         
-        return output
-        
-    except Exception as e:
-        print(f"[DB ERROR] {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        log.exception("Product search failed", query=product_name)
         return None
 
-def search_open_food_facts(product_name: str, limit=5):
+@metrics.timed("product_search_seconds", source="open_food_facts")
+def fetch_open_food_facts_rows(product_name: str, limit=5):
     """
     FIX 7: Fallback to Open Food Facts API with better error handling
+    Returns raw product rows in the same shape as the local index
     """
-    try:
-        search_term = product_name.lower().strip()
-        search_term = search_term.replace("'", "").replace('"', '').replace("'s", "s")
-        
-        print(f"\n[OPEN FOOD FACTS] ==================")
-        print(f"[OPEN FOOD FACTS] Original query: '{product_name}'")
-        print(f"[OPEN FOOD FACTS] Cleaned query: '{search_term}'")
-        
-        # Try multiple search strategies
-        search_attempts = [
-            search_term,
-            " ".join(search_term.split()[:3]),
-            search_term.split()[0] if search_term.split() else search_term
-        ]
+    import requests
+    search_term = product_name.lower().strip()
+    search_term = search_term.replace("'", "").replace('"', '').replace("'s", "s")
+    
+    log.debug("Open Food Facts search", query=product_name, cleaned=search_term)
+    
+    # Try multiple search strategies
+    search_attempts = [
+        search_term,
+        " ".join(search_term.split()[:3]),
+        search_term.split()[0] if search_term.split() else search_term
+    ]
+    
+    all_products = []
+    
+    for attempt_num, term in enumerate(search_attempts):
+        if not term or len(term) < 3:
+            continue
+            
+        log.debug("Open Food Facts attempt", attempt=attempt_num + 1, term=term)
         
-        all_products = []
+        url = "https://world.openfoodfacts.org/cgi/search.pl"
+        params = {
+            "search_terms": term,
+            "page_size": limit * 3,
+            "json": 1,
+            "fields": "product_name,brands,nutriments,nova_group"
+        }
         
-        for attempt_num, term in enumerate(search_attempts):
-            if not term or len(term) < 3:
-                continue
-                
-            print(f"[OPEN FOOD FACTS] Attempt {attempt_num + 1}: '{term}'")
-            
-            url = "https://world.openfoodfacts.org/cgi/search.pl"
-            params = {
-                "search_terms": term,
-                "page_size": limit * 3,
-                "json": 1,
-                "fields": "product_name,brands,nutriments,nova_group"
-            }
-            
-            try:
+        try:
+            with metrics.timed("off_request_seconds"):
                 response = requests.get(url, params=params, timeout=10)
-                print(f"[OPEN FOOD FACTS] Status code: {response.status_code}")
+            metrics.inc("off_responses_total", status=response.status_code)
+            log.debug("Open Food Facts response", attempt=attempt_num + 1, status=response.status_code)
+            
+            if response.status_code == 200:
+                data = response.json()
+                products = data.get('products', [])
+                log.debug("Open Food Facts results", attempt=attempt_num + 1, products=len(products))
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    products = data.get('products', [])
-                    print(f"[OPEN FOOD FACTS] Found {len(products)} raw results")
-                    
-                    if products:
-                        all_products.extend(products)
-                        if len(all_products) >= limit:
-                            break
-                            
-            except requests.Timeout:
-                print(f"[OPEN FOOD FACTS] Timeout on attempt {attempt_num + 1}")
-                continue
-            except Exception as e:
-                print(f"[OPEN FOOD FACTS] Error on attempt {attempt_num + 1}: {e}")
+                if products:
+                    all_products.extend(products)
+                    if len(all_products) >= limit:
+                        break
+                        
+        except requests.Timeout:
+            log.warning("Open Food Facts timeout", attempt=attempt_num + 1, term=term)
+            continue
+        except Exception as e:
+            log.warning("Open Food Facts request failed", attempt=attempt_num + 1, term=term, error=str(e))
+            continue
+    
+    if not all_products:
+        log.info("Open Food Facts found nothing", query=product_name)
+        return []
+    
+    rows = []
+    seen_names = set()
+    
+    for p in all_products[:limit * 2]:
+        try:
+            nutriments = p.get('nutriments', {})
+            
+            name = p.get('product_name', '').strip()
+            if not name or name in seen_names:
                 continue
-        
-        if not all_products:
-            print(f"[OPEN FOOD FACTS] No results found after all attempts")
-            return None
-        
-        # Process results
+            seen_names.add(name)
+            
+            brand = p.get('brands', '').split(',')[0].strip() if p.get('brands') else ''
+            
+            calories = float(nutriments.get('energy-kcal_100g', 0) or 0)
+            sugar = float(nutriments.get('sugars_100g', 0) or 0)
+            fiber = float(nutriments.get('fiber_100g', 0) or 0)
+            protein = float(nutriments.get('proteins_100g', 0) or 0)
+            fat = float(nutriments.get('fat_100g', 0) or 0)
+            sodium = float(nutriments.get('sodium_100g', 0) or 0) * 1000
+            nova = int(p.get('nova_group', 3) or 3)
+            
+            rows.append([name, brand, calories, sugar, fiber, protein, fat, sodium, None, nova])
+            
+            if len(rows) >= limit:
+                break
+            
+        except Exception as e:
+            log.debug("Open Food Facts product skipped", error=str(e))
+            continue
+    
+    return rows
+
+def search_open_food_facts(product_name: str, limit=5):
+    """
+    FIX 7: Fallback to Open Food Facts API with better error handling
+    """
+    try:
         output = []
-        seen_names = set()
-        
-        for p in all_products[:limit * 2]:
-            try:
-                nutriments = p.get('nutriments', {})
-                
-                name = p.get('product_name', '').strip()
-                if not name or name in seen_names:
-                    continue
-                seen_names.add(name)
-                
-                brand = p.get('brands', '').split(',')[0].strip() if p.get('brands') else ''
-                
-                calories = float(nutriments.get('energy-kcal_100g', 0) or 0)
-                sugar = float(nutriments.get('sugars_100g', 0) or 0)
-                fiber = float(nutriments.get('fiber_100g', 0) or 0)
-                protein = float(nutriments.get('proteins_100g', 0) or 0)
-                fat = float(nutriments.get('fat_100g', 0) or 0)
-                sodium = float(nutriments.get('sodium_100g', 0) or 0) * 1000
-                nova = int(p.get('nova_group', 3) or 3)
-                
-                row = [name, brand, calories, sugar, fiber, protein, fat, sodium, None, nova]
-                
-                score = calculate_vms_science(row)
-                rating = "Metabolic Green" if score < 3.0 else "Metabolic Yellow" if score < 7.0 else "Metabolic Red"
-                
-                display_name = f"{brand.title()} {name.title()}" if brand else name.title()
-                
-                output.append({
-                    "name": display_name,
-                    "brand": brand.title() if brand else "",
-                    "vms_score": score,
-                    "rating": rating,
-                    "raw": row
-                })
-                
-                print(f"[OPEN FOOD FACTS] ✅ Added: {display_name} (Score: {score})")
-                
-                if len(output) >= limit:
-                    break
-                
-            except Exception as e:
-                print(f"[OPEN FOOD FACTS] Error processing product: {e}")
-                continue
+        for row in fetch_open_food_facts_rows(product_name, limit):
+            result = score_product_row(row)
+            output.append(result)
+            log.debug("Open Food Facts product scored", name=result['name'], score=result['vms_score'])
         
         if output:
-            print(f"[OPEN FOOD FACTS] Successfully processed {len(output)} products")
+            log.info("Open Food Facts products scored", query=product_name, products=len(output))
             return output
         else:
-            print(f"[OPEN FOOD FACTS] No valid products after processing")
+            log.info("Open Food Facts returned no usable products", query=product_name)
             return None
         
-    except Exception as e:
-        print(f"[OPEN FOOD FACTS] Fatal error: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        log.exception("Open Food Facts search failed", query=product_name)
         return None
 
 # === 3. SCANNER WITH ENHANCED DETECTION (FIX 3, 6) ===
@@ -316,7 +375,10 @@ def vision_live_scan_dark(image_bytes):
     """
     FIX 3: Enhanced to detect ALL items in frame with accurate counting
     FIX 6: Status tracking for in-widget display
+    UI wrapper around scan_pipeline.run_scan, which holds the non-UI logic
     """
+    from scan_pipeline import run_scan, OpenAIVisionBackend
+
     api_key = get_gemini_api_key()
     if not api_key:
         st.markdown("""
@@ -327,129 +389,18 @@ def vision_live_scan_dark(image_bytes):
         """, unsafe_allow_html=True)
         return None
 
-    try:
-        # Handle different input types
-        if isinstance(image_bytes, io.BytesIO):
-            image_bytes = image_bytes.getvalue()
-        elif hasattr(image_bytes, 'read'):
-            image_bytes = image_bytes.read()
-
-        print(f"[DEBUG] Image type: {type(image_bytes)}, size: {len(image_bytes)} bytes")
-
-        # Convert to PIL Image
-        img = Image.open(io.BytesIO(image_bytes))
-        w, h = img.size
-        print(f"[DEBUG] Image dimensions: {w}x{h}, mode: {img.mode}")
-
-        # Convert to RGB
-        if img.mode == 'RGBA':
-            print("[DEBUG] Converting RGBA to RGB...")
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            background.paste(img, mask=img.split()[3] if len(img.split()) == 4 else None)
-            img = background
-        elif img.mode == 'LA':
-            print("[DEBUG] Converting LA to RGB...")
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            background.paste(img, mask=img.split()[1])
-            img = background
-        elif img.mode != 'RGB':
-            print(f"[DEBUG] Converting {img.mode} to RGB...")
-            img = img.convert('RGB')
-
-        # Minimal crop (10% edges) to avoid UI elements, but scan most of frame
-        left = int(w * 0.05)
-        top = int(h * 0.05)
-        right = int(w * 0.95)
-        bottom = int(h * 0.95)
-        img_cropped = img.crop((left, top, right, bottom))
-
-        # Enhance image
-        from PIL import ImageEnhance
-        enhancer = ImageEnhance.Contrast(img_cropped)
-        img_cropped = enhancer.enhance(1.5)
-        enhancer = ImageEnhance.Brightness(img_cropped)
-        img_cropped = enhancer.enhance(1.2)
-
-        # Final RGB check
-        if img_cropped.mode != 'RGB':
-            img_cropped = img_cropped.convert('RGB')
-
-        # Convert to base64
-        buf = io.BytesIO()
-        img_cropped.save(buf, format="JPEG", quality=95)
-        buf.seek(0)
-        img_bytes = buf.read()
-        img_b64 = base64.b64encode(img_bytes).decode('utf-8')
-
-        # Enhanced prompt for whole-frame detection
-        prompt = """You are a food detection AI. Identify ALL food items visible in this image.
-
-CRITICAL RULES:
-1. Count EACH item separately (1 apple, 2 bananas = 3 total items)
-2. For PACKAGED goods: Use exact product name from label
-3. For FRESH produce: Use common name, count each piece
-4. List ALL items you see in the frame
-5. Scan the ENTIRE visible area
-
-Return a JSON array like: ["Apple", "Banana", "Banana", "Orange", "Coca Cola"]
-
-If you see 2 apples, list "Apple" twice.
-Be PRECISE. Return ONLY the JSON array, no other text."""
-
-        client = OpenAI(api_key=api_key)
-
-        print("[DEBUG] Calling OpenAI GPT-4o API...")
-
-        # Analyzing message
-        st.markdown("""
-            <div class="scanner-result">
-                <div class="scanner-result-title">🔍 Analyzing Image</div>
-                <div class="scanner-result-text">Processing with GPT-4o Vision...</div>
-            </div>
-        """, unsafe_allow_html=True)
-
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{img_b64}",
-                                    "detail": "high"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=500
-            )
-
-            response_text = response.choices[0].message.content.strip()
-            print(f"[GPT-4o] Raw response: {response_text}")
-
-            # Parse JSON array of items
-            import re
-            json_match = re.search(r'\[.*?\]', response_text, re.DOTALL)
-            if json_match:
-                import json
-                detected_items = json.loads(json_match.group(0))
-                print(f"✅ [GPT-4o] Detected {len(detected_items)} items: {detected_items}")
-            else:
-                # Fallback to single item
-                product_name = response_text.replace('"', '').replace('*', '').replace('.', '')
-                detected_items = [product_name]
-                print(f"✅ [GPT-4o] Single item detected: {product_name}")
-
-            # Detection message
-            items_display = ", ".join(detected_items[:3])
-            if len(detected_items) > 3:
-                items_display += f" +{len(detected_items) - 3} more"
-
+    def on_status(stage, payload):
+        if stage == "analyzing":
+            st.markdown("""
+                <div class="scanner-result">
+                    <div class="scanner-result-title">🔍 Analyzing Image</div>
+                    <div class="scanner-result-text">Processing with GPT-4o Vision...</div>
+                </div>
+            """, unsafe_allow_html=True)
+        elif stage == "detected":
+            items_display = ", ".join(payload[:3])
+            if len(payload) > 3:
+                items_display += f" +{len(payload) - 3} more"
             st.markdown(f"""
                 <div class="scanner-result">
                     <div class="scanner-result-title">👁️ Items Detected</div>
@@ -457,22 +408,12 @@ Be PRECISE. Return ONLY the JSON array, no other text."""
                 </div>
             """, unsafe_allow_html=True)
 
-        except Exception as api_error:
-            print(f"[GPT-4o ERROR] {api_error}")
-            raise api_error
-        
-        # FIX 3: Search for ALL detected items
-        all_results = []
-        for item in detected_items:
-            results = search_vantage_db(item, limit=1)
-            if results and len(results) > 0:
-                # FIX: Filter 10.0 default scores
-                for r in results:
-                    if r['vms_score'] != 10.0:
-                        all_results.append(r)
+    try:
+        scan = run_scan(image_bytes, OpenAIVisionBackend(api_key), on_status=on_status)
+        all_results = scan["results"]
         
         if all_results:
-            print(f"✅ [DATABASE] Found {len(all_results)} total matches")
+            log.info("Scan matched", matches=len(all_results))
             
             # DARK themed success message
             st.markdown(f"""
@@ -484,7 +425,7 @@ Be PRECISE. Return ONLY the JSON array, no other text."""
             
             return all_results
         else:
-            print(f"❌ [DATABASE] No matches found")
+            log.info("Scan found no matches")
             
             # FIX 7: Friendly error message
             st.markdown(f"""
@@ -501,12 +442,10 @@ Be PRECISE. Return ONLY the JSON array, no other text."""
         
     except Exception as e:
         error_msg = str(e)
-        print(f"❌ [SCAN ERROR] {error_msg}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Scan failed")
         
         # Better error handling for API quota
-        if "429" in error_msg or "quota" in error_msg.lower() or "RESOURCE_EXHAUSTED" in error_msg:
+        if is_rate_limit_error(e):
             st.markdown(f"""
                 <div class="scanner-result" style="border-left-color: #D4765E;">
                     <div class="scanner-result-title">⚠️ API Limit Reached</div>
@@ -524,50 +463,48 @@ Be PRECISE. Return ONLY the JSON array, no other text."""
         return None
 
 # === 3B. AI HEALTH COACH AGENT ===
-def generate_health_insights(trend_data, history_data, days_range):
+# Bump when the coach prompt changes so cached insights are regenerated
+INSIGHTS_PROMPT_VERSION = 2
+# Token budgets (local estimate) for each agent's prompt
+INSIGHTS_PROMPT_BUDGET = 900
+MEAL_PLAN_PROMPT_BUDGET = 700   # shared constraint summary; each day's rules add ~200
+RECIPES_PROMPT_BUDGET = 700
+
+def generate_health_insights(summary, days_range):
     """
     Smart Health Coach: Analyzes user's eating trends and generates
     3 personalized, actionable recommendations using Gemini AI.
 
     Args:
-        trend_data: list of (date, category, count) tuples from get_trend_data_db
-        history_data: list of (date, item_name, score, category) tuples from get_all_calendar_data_db
+        summary: dict from get_coach_summary_db (category counts + up to 20 recent items)
         days_range: int, number of days being analyzed
     Returns:
         list of insight dicts or None on error
     """
     api_key = get_gemini_api_key()
     if not api_key:
-        print("[INSIGHTS] No OpenAI API key configured")
+        log.warning("No OpenAI API key configured", agent="insights")
         return None
 
     try:
-        # Build summary statistics
-        total_items = sum(count for _, _, count in trend_data) if trend_data else 0
-        healthy_count = sum(count for _, cat, count in trend_data if cat == 'healthy') if trend_data else 0
-        moderate_count = sum(count for _, cat, count in trend_data if cat == 'moderate') if trend_data else 0
-        unhealthy_count = sum(count for _, cat, count in trend_data if cat == 'unhealthy') if trend_data else 0
-
-        # Build recent items list (last 20 items max)
-        recent_items = []
-        if history_data:
-            for date, item_name, score, category in history_data[:20]:
-                recent_items.append(f"- {date}: {item_name} (score: {score}, {category})")
+        total_items = summary["total"]
+        healthy_count = summary["healthy"]
+        moderate_count = summary["moderate"]
+        unhealthy_count = summary["unhealthy"]
 
-        items_str = "\n".join(recent_items) if recent_items else "No items logged yet."
+        # Repeated items collapse into one line with a count
+        _, item_lines = compress_history(summary["recent_items"])
 
-        prompt = f"""You are a friendly, expert nutritionist AI health coach. Analyze this user's eating data and provide exactly 3 personalized, specific, actionable insights.
+        pb = PromptBuilder("insights", INSIGHTS_PROMPT_BUDGET)
+        pb.add(f"""You are a friendly, expert nutritionist AI health coach. Analyze this user's eating data and provide exactly 3 personalized, specific, actionable insights.
 
 USER'S EATING DATA (last {days_range} days):
 - Total items logged: {total_items}
 - Healthy items (score < 3.0): {healthy_count}
 - Moderate items (score 3.0-7.0): {moderate_count}
-- Unhealthy items (score > 7.0): {unhealthy_count}
-
-RECENT ITEMS:
-{items_str}
-
-SCORING SYSTEM:
+- Unhealthy items (score > 7.0): {unhealthy_count}""")
+        pb.add_list("RECENT ITEMS:", item_lines, priority=1, min_lines=5, empty="No items logged yet.")
+        pb.add("""SCORING SYSTEM:
 - Score < 3.0 = Metabolic Green (healthy)
 - Score 3.0-7.0 = Metabolic Yellow (moderate)
 - Score > 7.0 = Metabolic Red (unhealthy)
@@ -582,22 +519,22 @@ RULES:
 
 Return ONLY valid JSON array, no other text:
 [
-  {{"emoji": "🥗", "title": "Short Title", "insight": "Your personalized observation...", "action": "Specific action step..."}},
-  {{"emoji": "💪", "title": "Short Title", "insight": "Your personalized observation...", "action": "Specific action step..."}},
-  {{"emoji": "🎯", "title": "Short Title", "insight": "Your personalized observation...", "action": "Specific action step..."}}
-]"""
+  {"emoji": "🥗", "title": "Short Title", "insight": "Your personalized observation...", "action": "Specific action step..."},
+  {"emoji": "💪", "title": "Short Title", "insight": "Your personalized observation...", "action": "Specific action step..."},
+  {"emoji": "🎯", "title": "Short Title", "insight": "Your personalized observation...", "action": "Specific action step..."}
+]""")
+        prompt = pb.build()
 
-        client = OpenAI(api_key=api_key)
-        print(f"[INSIGHTS] Calling OpenAI GPT-4o with {total_items} items over {days_range} days...")
+        log.info("Generating insights", items=total_items, days=days_range)
 
-        response = client.chat.completions.create(
-            model="gpt-4o",
+        response = chat_completion(
+            "insights", api_key,
             messages=[{"role": "user", "content": prompt}],
             max_tokens=800
         )
 
         response_text = response.choices[0].message.content.strip()
-        print(f"[INSIGHTS] Raw response: {response_text[:200]}...")
+        log.debug("Insights response", text=response_text[:200])
 
         # Parse JSON response
         import json
@@ -605,20 +542,123 @@ Return ONLY valid JSON array, no other text:
         json_match = re.search(r'\[.*\]', response_text, re.DOTALL)
         if json_match:
             insights = json.loads(json_match.group(0))
-            print(f"✅ [INSIGHTS] Generated {len(insights)} insights")
+            log.info("Insights generated", insights=len(insights))
             return insights
         else:
-            print(f"❌ [INSIGHTS] Could not parse JSON from response")
+            log.error("Insights response is not JSON", text=response_text[:200])
             return None
 
-    except Exception as e:
-        print(f"❌ [INSIGHTS ERROR] {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        log.exception("Insights generation failed")
         raise  # Re-raise so the UI can display the actual error
 
 
+_insights_flight = SingleFlight()
+
+def _insights_digest(summary, days_range):
+    payload = json.dumps({"v": INSIGHTS_PROMPT_VERSION, "days": days_range, "summary": summary},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def health_insights_key(username, days_range):
+    """(days, digest of the trend window): insights shown for another key are out of date. None on a DB error."""
+    try:
+        return days_range, _insights_digest(get_coach_summary_db(username, days_range), days_range)
+    except Exception as e:
+        log.error("Coach summary read failed", user=username, days=days_range, error=str(e))
+        return None
+
+def peek_health_insights(username, days_range):
+    """Stored insights if the user's trend window hasn't changed since they were generated, else None"""
+    try:
+        summary = get_coach_summary_db(username, days_range)
+        return _load_insights_db(username, days_range, _insights_digest(summary, days_range))
+    except Exception as e:
+        log.error("Insights cache read failed", user=username, days=days_range, error=str(e))
+        return None
+
+def get_health_insights(username, days_range):
+    """
+    Coach insights for the user's trend window. The model is only called when new
+    logs change the window's digest; otherwise the stored insights are returned.
+    """
+    summary = get_coach_summary_db(username, days_range)
+    digest = _insights_digest(summary, days_range)
+    cached = _load_insights_db(username, days_range, digest)
+    if cached:
+        log.debug("Insights cache hit", user=username, days=days_range)
+        return cached
+
+    def generate():
+        insights = generate_health_insights(summary, days_range)
+        if insights:
+            _save_insights_db(username, days_range, digest, insights)
+        return insights
+
+    return _insights_flight.do((username, days_range, digest), generate)
+
+
 # === 3C. AI MEAL PLANNING AGENT ===
+MEAL_PLAN_DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+MEAL_TYPES = ["Breakfast", "Lunch", "Dinner"]
+# "parallel": one small call per day, run concurrently and streamed to the UI; "single": one 7-day call
+MEAL_PLAN_MODE = os.getenv("MEAL_PLAN_MODE", "parallel")
+# Days still missing after this many seconds are filled in by the local planner
+MEAL_PLAN_TIMEOUT = float(os.getenv("MEAL_PLAN_TIMEOUT", "25"))
+# Gives each concurrently generated day its own direction, since days can't see each other
+DAY_THEMES = {
+    "Monday": "Mediterranean", "Tuesday": "East Asian", "Wednesday": "Mexican",
+    "Thursday": "Indian", "Friday": "Middle Eastern", "Saturday": "Classic American",
+    "Sunday": "Italian",
+}
+
+def build_meal_plan_constraints(user_history):
+    """
+    Shared constraint summary (profile, compressed history, scoring system) used by
+    every meal plan prompt, built once per plan and kept under MEAL_PLAN_PROMPT_BUDGET.
+    """
+    total = len(user_history) if user_history else 0
+    category_lines, item_lines = compress_history(user_history)
+
+    pb = PromptBuilder("meal_plan_constraints", MEAL_PLAN_PROMPT_BUDGET)
+    pb.add(f"""USER PROFILE:
+- Total items logged: {total}""")
+    pb.add_list("CATEGORY BREAKDOWN:", category_lines, priority=2, empty="- No items logged yet")
+    pb.add_list("ITEMS THEY'VE CONSUMED (most frequent first):", item_lines, priority=1, min_lines=5,
+                empty="No items logged yet - create a general healthy plan.")
+    pb.add("""SCORING SYSTEM (Vantage Metabolic Score):
+- Score < 3.0 = Metabolic Green (healthy)
+- Score 3.0-7.0 = Metabolic Yellow (moderate)
+- Score > 7.0 = Metabolic Red (unhealthy)
+- Lower scores are better""")
+    return pb.build()
+
+def validate_day_meals(meals):
+    """
+    Checks one day of a meal plan against the expected schema:
+    3 meals (Breakfast, Lunch, Dinner), each with a name and a numeric score.
+    Returns the cleaned list or raises ValueError.
+    """
+    if not isinstance(meals, list):
+        raise ValueError(f"expected a list of meals, got {type(meals).__name__}")
+    by_type = {}
+    for meal in meals:
+        if not isinstance(meal, dict):
+            raise ValueError("meal entries must be objects")
+        meal_type = str(meal.get("meal", "")).strip().title()
+        name = str(meal.get("name", "")).strip()
+        try:
+            score = float(meal.get("estimated_score"))
+        except (TypeError, ValueError):
+            raise ValueError(f"missing or non-numeric estimated_score for '{name}'")
+        if meal_type in MEAL_TYPES and name and meal_type not in by_type:
+            by_type[meal_type] = {"meal": meal_type, "name": name,
+                                  "estimated_score": round(max(-2.0, min(10.0, score)), 1)}
+    missing = [t for t in MEAL_TYPES if t not in by_type]
+    if missing:
+        raise ValueError(f"missing meals: {', '.join(missing)}")
+    return [by_type[t] for t in MEAL_TYPES]
+
 def generate_meal_plan(user_history, user_id):
     """
     AI Meal Planning Agent: Generates a personalized 7-day meal plan
@@ -632,41 +672,15 @@ def generate_meal_plan(user_history, user_id):
     """
     api_key = get_gemini_api_key()
     if not api_key:
-        print("[MEAL PLAN] No OpenAI API key configured")
+        log.warning("No OpenAI API key configured", agent="meal_plan")
         return None
 
     try:
-        # Analyze user's history for patterns
-        total = len(user_history) if user_history else 0
-        healthy_items = [h for h in user_history if h[3] == 'healthy'] if user_history else []
-        unhealthy_items = [h for h in user_history if h[3] == 'unhealthy'] if user_history else []
-
-        # Get unique items the user has consumed
-        liked_items = []
-        if user_history:
-            for _, item_name, score, category in user_history[:30]:
-                liked_items.append(f"- {item_name} (score: {score}, {category})")
-
-        items_str = "\n".join(liked_items) if liked_items else "No items logged yet - create a general healthy plan."
-
-        healthy_pct = round((len(healthy_items) / total * 100), 1) if total > 0 else 0
-        unhealthy_pct = round((len(unhealthy_items) / total * 100), 1) if total > 0 else 0
+        constraints = build_meal_plan_constraints(user_history)
 
         prompt = f"""You are an expert nutritionist AI. Generate a personalized 7-day meal plan for this user.
 
-USER PROFILE:
-- Total items logged: {total}
-- Healthy choices: {healthy_pct}%
-- Unhealthy choices: {unhealthy_pct}%
-
-ITEMS THEY'VE CONSUMED RECENTLY:
-{items_str}
-
-SCORING SYSTEM (Vantage Metabolic Score):
-- Score < 3.0 = Metabolic Green (healthy)
-- Score 3.0-7.0 = Metabolic Yellow (moderate)
-- Score > 7.0 = Metabolic Red (unhealthy)
-- Lower scores are better
+{constraints}
 
 RULES:
 1. Generate 3 meals per day (Breakfast, Lunch, Dinner) for 7 days
@@ -692,17 +706,16 @@ Return ONLY valid JSON, no other text:
   "Sunday": [...]
 }}"""
 
-        client = OpenAI(api_key=api_key)
-        print(f"[MEAL PLAN] Calling OpenAI GPT-4o for user {user_id}...")
+        log.info("Generating meal plan", user=user_id)
 
-        response = client.chat.completions.create(
-            model="gpt-4o",
+        response = chat_completion(
+            "meal_plan", api_key,
             messages=[{"role": "user", "content": prompt}],
             max_tokens=2000
         )
 
         response_text = response.choices[0].message.content.strip()
-        print(f"[MEAL PLAN] Raw response: {response_text[:200]}...")
+        log.debug("Meal plan response", text=response_text[:200])
 
         # Parse JSON response
         import json
@@ -711,37 +724,124 @@ Return ONLY valid JSON, no other text:
         if json_match:
             meal_plan = json.loads(json_match.group(0))
             total_meals = sum(len(v) for v in meal_plan.values())
-            print(f"✅ [MEAL PLAN] Generated plan with {total_meals} meals across {len(meal_plan)} days")
+            log.info("Meal plan generated", meals=total_meals, days=len(meal_plan))
             return meal_plan
         else:
-            print(f"❌ [MEAL PLAN] Could not parse JSON from response")
+            log.error("Meal plan response is not JSON", text=response_text[:200])
             return None
 
-    except Exception as e:
-        print(f"❌ [MEAL PLAN ERROR] {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        log.exception("Meal plan generation failed", user=user_id)
         raise  # Re-raise so the UI can display the actual error
 
 
+def generate_meal_plan_day(day_name, constraints, api_key):
+    """One day of the meal plan (3 meals), validated. Raises on API or schema errors."""
+    prompt = f"""You are an expert nutritionist AI. Plan {day_name}'s meals for this user as part of a 7-day plan.
+
+{constraints}
+
+RULES:
+1. Generate exactly 3 meals: Breakfast, Lunch, Dinner
+2. Incorporate foods they already enjoy (when healthy)
+3. Suggest healthier alternatives to their unhealthy choices
+4. Keep estimated scores realistic (don't make everything 0)
+5. Lean towards {DAY_THEMES.get(day_name, 'varied')} dishes today so the week has variety
+6. Make meals practical and easy to prepare
+7. Use common grocery items
+
+Return ONLY a valid JSON array, no other text:
+[
+  {{"meal": "Breakfast", "name": "Meal description", "estimated_score": 1.5}},
+  {{"meal": "Lunch", "name": "Meal description", "estimated_score": 2.0}},
+  {{"meal": "Dinner", "name": "Meal description", "estimated_score": 2.5}}
+]"""
+
+    last_error = None
+    for attempt in range(2):  # one retry if the reply doesn't match the schema
+        response = chat_completion(
+            "meal_plan_day", api_key,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=350
+        )
+        response_text = response.choices[0].message.content.strip()
+        try:
+            import re
+            json_match = re.search(r'\[.*\]', response_text, re.DOTALL)
+            if not json_match:
+                raise ValueError("no JSON array in response")
+            parsed = json.loads(json_match.group(0))
+            # Some replies wrap the day: [{"Monday": [...]}]
+            if len(parsed) == 1 and isinstance(parsed[0], dict) and day_name in parsed[0]:
+                parsed = parsed[0][day_name]
+            return validate_day_meals(parsed)
+        except ValueError as e:
+            last_error = e
+            log.warning("Meal plan day failed validation", day=day_name, attempt=attempt + 1, error=str(e))
+    raise ValueError(f"{day_name}: {last_error}")
+
+def generate_meal_plan_streaming(user_history, user_id, max_workers=7, timeout=None):
+    """
+    Parallel meal planning: one call per day with a shared constraint summary.
+    Yields (day_name, meals, error) as each day finishes, so the UI can render
+    days as soon as they're ready. meals is None when that day failed or missed
+    the `timeout` (seconds, default MEAL_PLAN_TIMEOUT).
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
+
+    api_key = get_gemini_api_key()
+    if not api_key:
+        log.warning("No OpenAI API key configured", agent="meal_plan")
+        return
+
+    constraints = build_meal_plan_constraints(user_history)
+    log.info("Generating meal plan days in parallel", user=user_id, days=len(MEAL_PLAN_DAYS))
+
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {pool.submit(generate_meal_plan_day, day, constraints, api_key): day for day in MEAL_PLAN_DAYS}
+    pending = set(MEAL_PLAN_DAYS)
+    try:
+        for future in as_completed(futures, timeout=timeout or MEAL_PLAN_TIMEOUT):
+            day = futures[future]
+            pending.discard(day)
+            try:
+                yield day, future.result(), None
+            except Exception as e:
+                log.error("Meal plan day failed", day=day, error=str(e))
+                yield day, None, e
+    except FuturesTimeout as e:
+        log.error("Meal plan timed out", days=sorted(pending))
+        for day in MEAL_PLAN_DAYS:
+            if day in pending:
+                yield day, None, e
+    finally:
+        # Don't block the page on stragglers
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
 # === 3D. DAILY HEALTHY RECIPES AGENT ===
-def generate_daily_recipes():
+# Bump when the recipe prompt changes so cached days are regenerated
+RECIPES_PROMPT_VERSION = 1
+
+def generate_daily_recipes(day=None, exclude=()):
     """
     Generates 5 unique healthy recipe tiles for the day.
     Uses OpenAI to pick random healthy recipes inspired by BBC Food.
-    Caches per day so recipes rotate daily but stay consistent within a day.
+    Uncached - the app goes through get_daily_recipes so every session shares one result per day;
+    "New Recipes" calls it directly with the names on screen in `exclude`, for that session only.
     Returns list of 5 recipe dicts or None on error.
     """
     api_key = get_gemini_api_key()
     if not api_key:
-        print("[RECIPES] No OpenAI API key configured")
+        log.warning("No OpenAI API key configured", agent="recipes")
         return None
 
     try:
-        today = datetime.now()
+        today = day or datetime.now()
         day_of_week = today.strftime("%A")
         day_of_year = today.timetuple().tm_yday
         week_number = today.isocalendar()[1]
+        avoid = f"\n8. Suggest none of these recipes again: {', '.join(exclude)}" if exclude else ""
 
         prompt = f"""You are a healthy recipe curator inspired by BBC Food recipes. Today is {day_of_week}, day {day_of_year} of the year, week {week_number}.
 
@@ -754,7 +854,7 @@ RULES:
 4. All recipes should be genuinely healthy (low sugar, high fiber/protein, whole ingredients)
 5. Use the day number ({day_of_year}) as a seed - generate DIFFERENT recipes than you would for day {day_of_year - 1} or {day_of_year + 1}
 6. Include estimated prep time
-7. Keep recipe names concise (max 6 words)
+7. Keep recipe names concise (max 6 words){avoid}
 
 Return ONLY valid JSON array, no other text:
 [
@@ -765,158 +865,989 @@ Return ONLY valid JSON array, no other text:
   {{"name": "Recipe Name", "cuisine": "Cuisine Type", "meal_type": "Dessert", "prep_time": "15 min", "description": "One sentence description", "key_ingredients": "3-4 main ingredients"}}
 ]"""
 
-        client = OpenAI(api_key=api_key)
-        print(f"[RECIPES] Calling OpenAI GPT-4o for daily recipes (day {day_of_year})...")
+        prompt = PromptBuilder("recipes", RECIPES_PROMPT_BUDGET).add(prompt).build()
+        log.info("Generating daily recipes", day=day_of_year)
 
-        response = client.chat.completions.create(
-            model="gpt-4o",
+        response = chat_completion(
+            "recipes", api_key,
             messages=[{"role": "user", "content": prompt}],
             max_tokens=1000
         )
 
         response_text = response.choices[0].message.content.strip()
-        print(f"[RECIPES] Raw response: {response_text[:200]}...")
+        log.debug("Recipes response", text=response_text[:200])
 
         import json
         import re
         json_match = re.search(r'\[.*\]', response_text, re.DOTALL)
         if json_match:
             recipes = json.loads(json_match.group(0))
-            print(f"✅ [RECIPES] Generated {len(recipes)} recipes")
+            log.info("Recipes generated", recipes=len(recipes))
             return recipes[:5]
         else:
-            print(f"❌ [RECIPES] Could not parse JSON from response")
+            log.error("Recipes response is not JSON", text=response_text[:200])
             return None
 
-    except Exception as e:
-        print(f"❌ [RECIPES ERROR] {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        log.exception("Recipe generation failed")
         raise
 
 
-# === 4. USER DB & TRENDS ===
+_recipes_memory = {}
+_recipes_lock = threading.Lock()
+_recipes_flight = SingleFlight()
+_recipes_disk = JsonDiskCache("recipes")
+
+def _recipes_key(day):
+    return f"v{RECIPES_PROMPT_VERSION}-{day.strftime('%Y-%m-%d')}"
+
+def peek_daily_recipes(day=None):
+    """Cached recipes for the day (memory, then disk) without ever calling the model"""
+    key = _recipes_key(day or datetime.now())
+    with _recipes_lock:
+        recipes = _recipes_memory.get(key)
+    if recipes is None:
+        recipes = _recipes_disk.get(key)
+        if recipes:
+            with _recipes_lock:
+                _recipes_memory[key] = recipes
+    return recipes
+
+def get_daily_recipes(day=None, force=False):
+    """
+    Today's recipes, shared by every session: memory → disk → one model call.
+    Concurrent first requests wait on the same in-flight generation.
+    force=True regenerates and replaces the shared entry (maintenance only: it changes every
+    user's recipes; the app's "New Recipes" uses generate_daily_recipes per session instead).
+    """
+    day = day or datetime.now()
+    key = _recipes_key(day)
+    if not force:
+        recipes = peek_daily_recipes(day)
+        if recipes:
+            return recipes
+
+    def generate():
+        # Another session may have finished while we waited for the flight
+        if not force:
+            cached = peek_daily_recipes(day)
+            if cached:
+                return cached
+        recipes = generate_daily_recipes(day)
+        if recipes:
+            _recipes_disk.set(key, recipes)
+            with _recipes_lock:
+                _recipes_memory[key] = recipes
+                # Keep only the last few days in memory
+                for old in sorted(_recipes_memory)[:-3]:
+                    _recipes_memory.pop(old, None)
+        return recipes
+
+    return _recipes_flight.do(key, generate)
+
+def pregenerate_daily_recipes(days_ahead=1):
+    """Warm the cache for the next `days_ahead` days so nobody waits on first load"""
+    for offset in range(1, days_ahead + 1):
+        day = datetime.now() + timedelta(days=offset)
+        try:
+            recipes = get_daily_recipes(day)
+            log.info("Recipes pre-generated", day=day.strftime('%Y-%m-%d'), ok=bool(recipes))
+        except Exception as e:
+            log.error("Recipe pre-generation failed", day=day.strftime('%Y-%m-%d'), error=str(e))
+
 @st.cache_resource
-def get_db_connection():
-    con = duckdb.connect('/tmp/user_data.db', read_only=False)
+def start_recipe_pregeneration(interval_seconds=3600):
+    """Background thread (once per process) that keeps tomorrow's recipes ready"""
+    def loop():
+        while True:
+            pregenerate_daily_recipes(1)
+            time.sleep(interval_seconds)
+
+    thread = threading.Thread(target=loop, name="recipe-pregeneration", daemon=True)
+    thread.start()
+    return thread
+
+
+# === 4. USER DB & TRENDS ===
+# Point FOODVANTAGE_USER_DB at a persistent volume in production; /tmp does not survive restarts
+USER_DB_PATH = os.getenv("FOODVANTAGE_USER_DB", "/tmp/user_data.db")
+CHECKPOINT_INTERVAL = float(os.getenv("FOODVANTAGE_CHECKPOINT_INTERVAL", 60))        # seconds
+COMPACT_INTERVAL = float(os.getenv("FOODVANTAGE_COMPACT_INTERVAL", 6 * 3600))        # seconds
+COMPACT_MIN_WRITES = int(os.getenv("FOODVANTAGE_COMPACT_MIN_WRITES", 1000))  # inserts + deletes since the last compaction
+COMPACT_CHUNK_ROWS = 200_000  # rows rewritten per writer transaction, so other writes interleave
+# DuckDB's own auto-checkpoint is only a safety net; regular checkpoints happen in the background
+WAL_AUTOCHECKPOINT_MB = int(os.getenv("FOODVANTAGE_WAL_AUTOCHECKPOINT_MB", 256))
+# Rows older than HOT_DAYS move to Parquet under ARCHIVE_DIR (see calendar_archive.py). At least
+# 60 days stay hot so the coach's 30-day window and the trend views never touch the archive.
+ARCHIVE_DIR = os.getenv("FOODVANTAGE_ARCHIVE_DIR") or os.path.join(
+    os.path.dirname(os.path.abspath(USER_DB_PATH)), "calendar_archive")
+HOT_DAYS = max(60, int(os.getenv("FOODVANTAGE_HOT_DAYS", 365)))
+ARCHIVE_INTERVAL = float(os.getenv("FOODVANTAGE_ARCHIVE_INTERVAL", 24 * 3600))  # seconds
+# User-partitioned storage (user_shards.py): with FOODVANTAGE_USER_SHARDS > 1 every user lives in one of N
+# DuckDB files, each with its own writer. With FOODVANTAGE_STORAGE_ADDRS set (storage_service.py) the app
+# opens no user DB at all and sends each user's calls to the service that owns the user's shard.
+STORAGE_ADDRS = parse_addresses(os.getenv("FOODVANTAGE_STORAGE_ADDRS"))
+USER_DB_SHARDS = int(os.getenv("FOODVANTAGE_USER_SHARDS") or len(STORAGE_ADDRS) or 1)
+USER_DB_PATHS = shard_paths(USER_DB_PATH, USER_DB_SHARDS)
+ARCHIVE_DIRS = shard_paths(ARCHIVE_DIR, USER_DB_SHARDS)
+CALENDAR_COLUMNS = "username, date, item_name, score, category"
+
+def _migrate_calendar_v1(con):
+    """
+    id becomes a BIGINT primary key and rows are rewritten ordered by (username, date),
+    so each user's rows sit in a few row groups and zone maps skip everyone else's.
+    """
+    con.execute("""
+        CREATE TABLE calendar_v1 (
+            id BIGINT PRIMARY KEY DEFAULT nextval('seq_cal_id'),
+            username VARCHAR NOT NULL, date DATE NOT NULL, item_name VARCHAR, score FLOAT, category VARCHAR
+        )
+    """)
+    con.execute(f"""
+        INSERT INTO calendar_v1 (id, {CALENDAR_COLUMNS})
+        SELECT COALESCE(id, nextval('seq_cal_id')), {CALENDAR_COLUMNS}
+        FROM calendar
+        ORDER BY username, date, id
+    """)
+    con.execute("DROP TABLE calendar")
+    con.execute("ALTER TABLE calendar_v1 RENAME TO calendar")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_calendar_user_date ON calendar (username, date)")
+
+def rebuild_daily_rollup(cur):
+    """Recompute daily_rollup from hot and archived rows (backfill / repair). Returns the number of rollup rows."""
+    cur.execute("DELETE FROM daily_rollup")
+    cur.execute("""
+        INSERT INTO daily_rollup
+        SELECT username, date, category, COUNT(*), COALESCE(SUM(score), 0)
+        FROM calendar_all
+        GROUP BY username, date, category
+        ORDER BY username, date, category
+    """)
+    return cur.execute("SELECT COUNT(*) FROM daily_rollup").fetchone()[0]
+
+def compact_calendar(cur, usernames=None):
+    """
+    Rewrites calendar rows (all, or only these users') in (username, date, id) order,
+    inside the caller's transaction. Re-clusters rows that were appended one at a time
+    and leaves the deleted rows' space to be reclaimed at the next checkpoint.
+    Returns the number of rows rewritten.
+    """
+    if usernames is None:
+        where, params = "", []
+    else:
+        where, params = "WHERE username IN (SELECT unnest(?::VARCHAR[]))", [list(usernames)]
+    cur.execute(f"CREATE OR REPLACE TEMP TABLE calendar_compact AS SELECT * FROM calendar {where} ORDER BY username, date, id", params)
+    cur.execute(f"DELETE FROM calendar {where}", params)
+    cur.execute("INSERT INTO calendar SELECT * FROM calendar_compact")
+    rows = cur.execute("SELECT COUNT(*) FROM calendar_compact").fetchone()[0]
+    cur.execute("DROP TABLE calendar_compact")
+    return rows
+
+def _migrate_daily_rollup_v2(con):
+    """Per (user, day, category) counts and score sums, so trends never re-aggregate raw rows."""
+    con.execute("""
+        CREATE TABLE daily_rollup (
+            username VARCHAR NOT NULL, date DATE NOT NULL, category VARCHAR NOT NULL,
+            count BIGINT NOT NULL, score_sum DOUBLE NOT NULL,
+            PRIMARY KEY (username, date, category)
+        )
+    """)
+    rebuild_daily_rollup(con)
+
+# (version, description, fn) - append only; each runs once, in its own transaction
+USER_DB_MIGRATIONS = [
+    (1, "calendar: BIGINT id primary key, (username, date) index, rows clustered by user", _migrate_calendar_v1),
+    (2, "daily_rollup: per-user daily category counts and score sums", _migrate_daily_rollup_v2),
+]
+
+def init_user_db(con, archive_dir=None):
+    """Create the user DB tables, bring the schema up to the latest version and (re)create calendar_all."""
+    try:
+        # Top-N reads ("latest 50 items") otherwise re-scan the whole table by rowid to fetch
+        # the remaining columns, which makes them grow with the table instead of with the user
+        con.execute("SET GLOBAL late_materialization_max_rows = 0")
+    except Exception:
+        pass  # setting not available in this DuckDB version
     con.execute("CREATE TABLE IF NOT EXISTS users (username VARCHAR PRIMARY KEY, password_hash VARCHAR)")
-    try: con.execute("CREATE SEQUENCE IF NOT EXISTS seq_cal_id START 1")
-    except: pass
+    con.execute("CREATE SEQUENCE IF NOT EXISTS seq_cal_id START 1")
     con.execute("CREATE TABLE IF NOT EXISTS calendar (id INTEGER DEFAULT nextval('seq_cal_id'), username VARCHAR, date DATE, item_name VARCHAR, score FLOAT, category VARCHAR)")
+    con.execute("CREATE TABLE IF NOT EXISTS coach_insights (username VARCHAR, days INTEGER, digest VARCHAR, insights VARCHAR, created_at TIMESTAMP, PRIMARY KEY (username, days))")
+    con.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description VARCHAR, applied_at TIMESTAMP)")
+    # Hot-only placeholder so migrations can read calendar_all; replaced with the tiered view below
+    con.execute("CREATE OR REPLACE VIEW calendar_all AS SELECT *, year(date) AS year, month(date) AS month, 'hot' AS tier FROM calendar")
+
+    current = con.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+    for version, description, migrate in USER_DB_MIGRATIONS:
+        if version <= current:
+            continue
+        start = time.perf_counter()
+        con.execute("BEGIN TRANSACTION")
+        try:
+            migrate(con)
+            con.execute("INSERT INTO schema_version VALUES (?, ?, current_timestamp)", [version, description])
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        log.info("Migrated user DB", version=version, description=description, seconds=round(time.perf_counter() - start, 2))
+    create_calendar_view(con, archive_dir or ARCHIVE_DIR)
     return con
 
+def user_shard(username):
+    """Index of the shard that holds this user's data"""
+    return shard_for(username, USER_DB_SHARDS)
+
+@st.cache_resource
+def get_db_connection(shard=0):
+    if STORAGE_ADDRS:
+        raise RuntimeError("FOODVANTAGE_STORAGE_ADDRS is set: the user DB belongs to the storage services")
+    path = USER_DB_PATHS[shard]
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    con = duckdb.connect(path, read_only=False)
+    con.execute(f"SET checkpoint_threshold = '{WAL_AUTOCHECKPOINT_MB}MB'")
+    log.info("User DB opened", path=path, shard=shard, shards=USER_DB_SHARDS)
+    return init_user_db(con, archive_dir=ARCHIVE_DIRS[shard])
+
+@st.cache_resource
+def get_db_writer(shard=0):
+    """
+    The one writer for a user DB shard. All inserts/deletes go through it and are
+    group-committed in batches; reads use their own cursor (see get_db_reader).
+    """
+    return BatchWriter(get_db_connection(shard).cursor(), name=f"user-db-writer-{shard}")
+
+def get_db_reader(shard=0):
+    """A fresh cursor per call: each read sees a consistent snapshot and never shares state with another session"""
+    return get_db_connection(shard).cursor()
+
+@st.cache_resource
+def get_storage_client():
+    """Client for the storage services when FOODVANTAGE_STORAGE_ADDRS is set, else None (local DB files)"""
+    if not STORAGE_ADDRS:
+        return None
+    log.info("Using storage services", services=[f'{h}:{p}' for h, p in STORAGE_ADDRS])
+    return StorageClient(STORAGE_ADDRS, USER_DB_SHARDS)
+
+ROUTED_CALLS = {}  # name -> local function, the calls a storage service will run
+metrics.describe("user_db_seconds", "Per-user DB reads and writes (storage calls), by function")
+
+def routed(fn):
+    """
+    Storage call keyed by its first argument (a username, or a shard index). Runs locally,
+    or on the service that owns the key's shard when FOODVANTAGE_STORAGE_ADDRS is set.
+    """
+    ROUTED_CALLS[fn.__name__] = fn
+
+    @functools.wraps(fn)
+    def wrapper(key, *args, **kwargs):
+        client = get_storage_client()
+        # Timed as the session sees it: read cache hits, local DB work, or the round trip to the service
+        with metrics.timed("user_db_seconds", call=fn.__name__):
+            if client is None:
+                return fn(key, *args, **kwargs)
+            shard = key if isinstance(key, int) else user_shard(key)
+            try:
+                return client.call(shard, fn.__name__, (key,) + args, kwargs)
+            except (ConnectionError, TimeoutError) as e:
+                log.error("Storage call failed", call=fn.__name__, error=str(e))
+                raise
+    return wrapper
+
+DB_WRITE_TIMEOUT = 10  # seconds a session waits for its write to commit
+IMPORT_TIMEOUT = 600   # seconds; bulk imports and compaction hold the writer for their whole transaction
+
+# === 4B. STORAGE MAINTENANCE ===
+# Per shard: every shard has its own WAL, writer and archive, and is maintained on its own
+_storage_lock = threading.Lock()
+
+def _new_storage_stats():
+    return {
+        "checkpoints": 0, "checkpoint_retries": 0, "last_checkpoint_seconds": None, "max_checkpoint_seconds": None,
+        "last_checkpoint_at": None, "last_checkpoint_wal_bytes": None,
+        "compactions": 0, "last_compaction_seconds": None, "last_compaction_at": None,
+        "writes_since_compaction": 0,
+        "archives": 0, "last_archive_rows": None, "last_archive_seconds": None, "last_archive_at": None,
+    }
+
+_storage_stats = [_new_storage_stats() for _ in range(USER_DB_SHARDS)]
+_dirty_users = [set() for _ in range(USER_DB_SHARDS)]  # per shard: users with inserts/deletes since the last compaction
+
+def _mark_dirty(usernames, writes=1):
+    with _storage_lock:
+        for user in usernames:
+            shard = user_shard(user)
+            _dirty_users[shard].add(user)
+            _storage_stats[shard]["writes_since_compaction"] += writes
+
+def _wal_bytes(shard=0):
+    try:
+        return os.path.getsize(USER_DB_PATHS[shard] + ".wal")
+    except OSError:
+        return 0
+
+def _shard_label(shard):
+    return f" shard {shard}" if USER_DB_SHARDS > 1 else ""
+
+CHECKPOINT_ATTEMPTS = 5
+
+def checkpoint_user_db(shard=0):
+    """
+    Flush a shard's WAL into its DB file, on the writer thread between batches. Returns seconds taken.
+    A read still open from before the last commit makes CHECKPOINT refuse; those finish in
+    milliseconds, so it's retried shortly after (never FORCE, which would abort them).
+    """
+    wal = _wal_bytes(shard)
+    start = time.perf_counter()
+    stats = _storage_stats[shard]
+    for attempt in range(CHECKPOINT_ATTEMPTS):
+        try:
+            get_db_writer(shard).run_exclusive(lambda cur: cur.execute("CHECKPOINT")).result(timeout=DB_WRITE_TIMEOUT * 6)
+            break
+        except duckdb.TransactionException:
+            if attempt == CHECKPOINT_ATTEMPTS - 1:
+                raise
+            with _storage_lock:
+                stats["checkpoint_retries"] += 1
+            time.sleep(0.2 * (attempt + 1))
+    elapsed = time.perf_counter() - start
+    with _storage_lock:
+        stats["checkpoints"] += 1
+        stats["last_checkpoint_seconds"] = elapsed
+        stats["max_checkpoint_seconds"] = max(elapsed, stats["max_checkpoint_seconds"] or 0)
+        stats["last_checkpoint_at"] = datetime.now().isoformat(timespec="seconds")
+        stats["last_checkpoint_wal_bytes"] = wal
+    log.info("Checkpoint", shard=shard, wal_kb=round(wal / 1024), ms=round(elapsed * 1000))
+    return elapsed
+
+def compact_user_db(force=False, shard=0):
+    """
+    Re-cluster the rows of a shard's users who wrote since the last compaction, once enough
+    writes have piled up (or always, with force), then checkpoint. Users are rewritten in
+    chunks of about COMPACT_CHUNK_ROWS rows, one short writer transaction each.
+    Returns seconds taken, or None if skipped.
+    """
+    stats = _storage_stats[shard]
+    with _storage_lock:
+        writes = stats["writes_since_compaction"]
+        if not _dirty_users[shard] or (not force and writes < COMPACT_MIN_WRITES):
+            return None
+        users = sorted(_dirty_users[shard])
+        _dirty_users[shard].clear()
+        stats["writes_since_compaction"] = 0
+
+    start = time.perf_counter()
+    sizes = dict(get_db_reader(shard).execute(
+        "SELECT username, SUM(count) FROM daily_rollup WHERE username IN (SELECT unnest(?::VARCHAR[])) GROUP BY username",
+        [users]).fetchall())
+    rows, chunk, chunk_rows = 0, [], 0
+    for i, user in enumerate(users):
+        chunk.append(user)
+        chunk_rows += sizes.get(user, 0)
+        if chunk_rows >= COMPACT_CHUNK_ROWS or i == len(users) - 1:
+            rows += get_db_writer(shard).submit(lambda cur, c=chunk: compact_calendar(cur, c)).result(timeout=IMPORT_TIMEOUT)
+            chunk, chunk_rows = [], 0
+    checkpoint_user_db(shard)
+    elapsed = time.perf_counter() - start
+    with _storage_lock:
+        stats["compactions"] += 1
+        stats["last_compaction_seconds"] = elapsed
+        stats["last_compaction_at"] = datetime.now().isoformat(timespec="seconds")
+    log.info("Compacted calendar", shard=shard, users=len(users), rows=rows, writes=writes, seconds=round(elapsed, 2))
+    return elapsed
+
+def archive_user_db(hot_days=HOT_DAYS, shard=0):
+    """Move a shard's calendar rows older than hot_days to its Parquet archive. Returns rows archived."""
+    cutoff = datetime.now().date() - timedelta(days=hot_days)
+    start = time.perf_counter()
+    archive_dir = ARCHIVE_DIRS[shard]
+    # Alone in its own transaction: its Parquet files aren't rolled back if a batched write fails
+    rows = get_db_writer(shard).submit(lambda cur: archive_calendar(cur, archive_dir, cutoff),
+                                       exclusive=True).result(timeout=IMPORT_TIMEOUT)
+    elapsed = time.perf_counter() - start
+    stats = _storage_stats[shard]
+    with _storage_lock:
+        stats["archives"] += 1
+        stats["last_archive_rows"] = rows
+        stats["last_archive_seconds"] = elapsed
+        stats["last_archive_at"] = datetime.now().isoformat(timespec="seconds")
+    if rows:
+        user_data_cache.clear()  # cached day views still list the moved rows as deletable
+        checkpoint_user_db(shard)
+        log.info("Archived calendar rows", shard=shard, rows=rows, before=cutoff, archive_dir=archive_dir, seconds=round(elapsed, 2))
+    return rows
+
+def _archive_bytes(shard=0):
+    total = 0
+    for root, _, files in os.walk(ARCHIVE_DIRS[shard]):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+@routed
+def _shard_storage_metrics(shard):
+    try:
+        db_bytes = os.path.getsize(USER_DB_PATHS[shard])
+    except OSError:
+        db_bytes = 0
+    with _storage_lock:
+        return {"shard": shard, "path": USER_DB_PATHS[shard], "db_bytes": db_bytes, "wal_bytes": _wal_bytes(shard),
+                "archive_dir": ARCHIVE_DIRS[shard], "archive_bytes": _archive_bytes(shard), **_storage_stats[shard]}
+
+def get_storage_metrics():
+    """
+    Per shard: DB location and size, WAL and archive size, checkpoint/compaction/archive
+    counts and durations. Totals across shards at the top level.
+    """
+    shards = []
+    for shard in range(USER_DB_SHARDS):
+        try:
+            shards.append(_shard_storage_metrics(shard))
+        except Exception as e:
+            shards.append({"shard": shard, "error": str(e)})
+    totals = {key: sum(s.get(key, 0) for s in shards)
+              for key in ("db_bytes", "wal_bytes", "archive_bytes", "checkpoints", "compactions", "archives")}
+    return {"shard_count": USER_DB_SHARDS, **totals, "shards": shards}
+
+_maintained_shards = set()  # shards this process opens and maintains (none behind storage services)
+
+@metrics.register_collector
+def _storage_metric_samples():
+    """Sizes and maintenance counts of the local shards, for the metrics dump"""
+    samples = []
+    for shard in sorted(_maintained_shards):
+        try:
+            db_bytes = os.path.getsize(USER_DB_PATHS[shard])
+        except OSError:
+            db_bytes = 0
+        with _storage_lock:
+            stats = dict(_storage_stats[shard])
+        labels = {"shard": shard}
+        samples += [
+            ("user_db_bytes", "gauge", labels, db_bytes),
+            ("user_db_wal_bytes", "gauge", labels, _wal_bytes(shard)),
+            ("user_db_archive_bytes", "gauge", labels, _archive_bytes(shard)),
+            ("user_db_writes_since_compaction", "gauge", labels, stats["writes_since_compaction"]),
+            ("user_db_checkpoints_total", "counter", labels, stats["checkpoints"]),
+            ("user_db_checkpoint_retries_total", "counter", labels, stats["checkpoint_retries"]),
+            ("user_db_compactions_total", "counter", labels, stats["compactions"]),
+            ("user_db_archives_total", "counter", labels, stats["archives"]),
+            ("user_db_last_checkpoint_seconds", "gauge", labels, stats["last_checkpoint_seconds"]),
+            ("user_db_last_compaction_seconds", "gauge", labels, stats["last_compaction_seconds"]),
+        ]
+    return samples
+
+@st.cache_resource
+def start_db_maintenance(checkpoint_interval=CHECKPOINT_INTERVAL, compact_interval=COMPACT_INTERVAL,
+                         archive_interval=ARCHIVE_INTERVAL, shards=None):
+    """
+    Background thread (once per process): for each shard, checkpoint when the WAL has data,
+    compact after many single-row writes, archive rows past the hot horizon once a day.
+    With storage services the app has no local shards and this does nothing.
+    """
+    import atexit
+
+    if STORAGE_ADDRS:
+        return None
+    shards = tuple(range(USER_DB_SHARDS)) if shards is None else tuple(shards)
+    _maintained_shards.update(shards)
+
+    def maintain(shard, archive_due, compact_due):
+        if archive_due and archive_user_db(shard=shard):
+            return  # archiving ends with a checkpoint
+        if compact_due and compact_user_db(shard=shard) is not None:
+            return  # compaction ends with a checkpoint
+        if _wal_bytes(shard) > 0:
+            checkpoint_user_db(shard)
+
+    def loop():
+        last_compaction = time.monotonic()
+        last_archive = time.monotonic() - archive_interval  # first archive pass soon after startup
+        while True:
+            time.sleep(checkpoint_interval)
+            archive_due = time.monotonic() - last_archive >= archive_interval
+            compact_due = time.monotonic() - last_compaction >= compact_interval
+            if archive_due:
+                last_archive = time.monotonic()
+            if compact_due:
+                last_compaction = time.monotonic()
+            for shard in shards:
+                try:
+                    maintain(shard, archive_due, compact_due)
+                except Exception:
+                    log.exception("Maintenance failed", shard=shard)
+
+    def checkpoint_on_exit():
+        for shard in shards:
+            try:
+                get_db_connection(shard).cursor().execute("CHECKPOINT")
+            except Exception:
+                pass
+
+    atexit.register(checkpoint_on_exit)
+    thread = threading.Thread(target=loop, name="user-db-maintenance", daemon=True)
+    thread.start()
+    return thread
+
+# Writer operations: each runs inside the writer's transaction, so a calendar
+# change and its rollup update always commit (or roll back) together.
+def _add_calendar_item_op(cur, username, date_str, item_name, score, category):
+    cur.execute(f"INSERT INTO calendar ({CALENDAR_COLUMNS}) VALUES (?, ?, ?, ?, ?)",
+                [username, date_str, item_name, score, category])
+    cur.execute("""
+        INSERT INTO daily_rollup VALUES (?, ?, ?, 1, ?)
+        ON CONFLICT (username, date, category) DO UPDATE
+        SET count = count + 1, score_sum = score_sum + EXCLUDED.score_sum
+    """, [username, date_str, category, score])
+
+def _delete_calendar_item_op(cur, username, item_id):
+    deleted = cur.execute("DELETE FROM calendar WHERE id = ? AND username = ? RETURNING username, date, category, score",
+                          [item_id, username]).fetchall()
+    for username, date, category, score in deleted:
+        cur.execute("""
+            UPDATE daily_rollup SET count = count - 1, score_sum = score_sum - ?
+            WHERE username = ? AND date = ? AND category = ?
+        """, [score or 0, username, date, category])
+        cur.execute("DELETE FROM daily_rollup WHERE username = ? AND date = ? AND category = ? AND count <= 0",
+                    [username, date, category])
+    return {row[0] for row in deleted}
+
+# Per-user reads are served from memory until that user writes (or the TTL passes)
+user_data_cache = VersionedCache("user_data", ttl=120)
+
+def get_read_cache_metrics():
+    """Hit/miss counts and hit rates of the per-user read cache"""
+    return user_data_cache.stats()
+
+@metrics.register_collector
+def _read_cache_metric_samples():
+    stats = user_data_cache.stats()
+    samples = [("read_cache_entries", "gauge", {}, stats["entries"])]
+    for name, counts in stats["functions"].items():
+        samples += [("read_cache_hits_total", "counter", {"function": name}, counts["hits"]),
+                    ("read_cache_misses_total", "counter", {"function": name}, counts["misses"])]
+    return samples
+
+@routed
+@user_data_cache.cached
 def get_trend_data_db(username, days=30):
     """Use DuckDB-compatible date math"""
-    con = get_db_connection()
+    con = get_db_reader(user_shard(username))
     try:
         threshold_date = datetime.now().date() - timedelta(days=days - 1)
         threshold_str = threshold_date.strftime('%Y-%m-%d')
         
-        print(f"\n[TRENDS] ==================")
-        print(f"[TRENDS] Username: {username}")
-        print(f"[TRENDS] Looking for items since: {threshold_str}")
-        print(f"[TRENDS] Days requested: {days}")
-        
         results = con.execute("""
-            SELECT date, category, COUNT(*) as count
-            FROM calendar 
+            SELECT date, category, count
+            FROM daily_rollup
             WHERE username = ? AND date >= ?
-            GROUP BY date, category 
-            ORDER BY date ASC
+            ORDER BY date ASC, category
         """, [username, threshold_str]).fetchall()
         
-        print(f"[TRENDS] Found {len(results)} result rows")
-        print(f"[TRENDS] ==================\n")
+        log.debug("Trend rows", user=username, days=days, since=threshold_str, rows=len(results))
         
         return results
         
+    except Exception:
+        log.exception("Trend query failed", user=username)
+        return NoCache([])
+
+TREND_CATEGORIES = ("healthy", "moderate", "unhealthy")
+
+@routed
+@user_data_cache.cached
+def get_trend_chart_db(username, days=30):
+    """
+    Trend chart data already pivoted by SQL: one row per logged day, one count column per category.
+    Returns {"dates": [ISO dates], "healthy": [...], "moderate": [...], "unhealthy": [...]} (plain
+    lists, so it pickles cheaply and keys the app's figure cache).
+    """
+    con = get_db_reader(user_shard(username))
+    threshold_str = (datetime.now().date() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    chart = {"dates": []}
+    chart.update({c: [] for c in TREND_CATEGORIES})
+    try:
+        rows = con.execute(f"""
+            SELECT strftime(date, '%Y-%m-%d'),
+                   {", ".join(f"COALESCE(SUM(count) FILTER (WHERE category = '{c}'), 0)" for c in TREND_CATEGORIES)}
+            FROM daily_rollup
+            WHERE username = ? AND date >= ?
+            GROUP BY date
+            ORDER BY date
+        """, [username, threshold_str]).fetchall()
     except Exception as e:
-        print(f"[TRENDS ERROR] {e}")
-        import traceback
-        traceback.print_exc()
-        return []
+        log.error("Trend query failed", user=username, error=str(e))
+        return NoCache(chart)
+    for row in rows:
+        chart["dates"].append(row[0])
+        for c, n in zip(TREND_CATEGORIES, row[1:]):
+            chart[c].append(int(n))
+    return chart
+
+@routed
+@user_data_cache.cached
+def get_month_summary_db(username, year, month):
+    """
+    Per-day totals for one calendar month from daily_rollup, in one query.
 
+    Returns:
+        {day_of_month: (item_count, average_score)} for days with logged items
+    """
+    try:
+        first = datetime(year, month, 1).date()
+        next_month = datetime(year + month // 12, month % 12 + 1, 1).date()
+        rows = get_db_reader(user_shard(username)).execute("""
+            SELECT day(date), SUM(count), SUM(score_sum) / SUM(count)
+            FROM daily_rollup
+            WHERE username = ? AND date >= ? AND date < ?
+            GROUP BY date
+        """, [username, first, next_month]).fetchall()
+        return {int(day): (int(count), float(avg)) for day, count, avg in rows}
+    except Exception as e:
+        log.error("Calendar query failed", user=username, error=str(e))
+        return NoCache({})
+
+@routed
+@user_data_cache.cached
 def get_all_calendar_data_db(username):
     """Get ALL calendar items for debugging"""
-    con = get_db_connection()
+    con = get_db_reader(user_shard(username))
     try:
         results = con.execute("""
-            SELECT date, item_name, score, category 
-            FROM calendar 
-            WHERE username = ? 
-            ORDER BY date DESC
+            SELECT date, item_name, score, category
+            FROM calendar_all
+            WHERE username = ?
+            ORDER BY date DESC, id DESC
         """, [username]).fetchall()
         return results
     except Exception as e:
-        print(f"[ALL CALENDAR ERROR] {e}")
-        return []
+        log.error("Calendar export query failed", user=username, error=str(e))
+        return NoCache([])
+
+@routed
+@user_data_cache.cached
+def get_coach_summary_db(username, days=30):
+    """
+    Everything the coach prompt needs for the window, in one query:
+    category counts from daily_rollup plus the 20 most recent items.
+    """
+    con = get_db_reader(user_shard(username))
+    threshold_str = (datetime.now().date() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    total, healthy, moderate, unhealthy, recent = con.execute("""
+        WITH counts AS (
+            SELECT
+                COALESCE(SUM(count), 0) AS total,
+                COALESCE(SUM(count) FILTER (WHERE category = 'healthy'), 0) AS healthy,
+                COALESCE(SUM(count) FILTER (WHERE category = 'moderate'), 0) AS moderate,
+                COALESCE(SUM(count) FILTER (WHERE category = 'unhealthy'), 0) AS unhealthy
+            FROM daily_rollup
+            WHERE username = $1 AND date >= $2
+        ), recent AS (
+            SELECT list([CAST(date AS VARCHAR), item_name, CAST(score AS VARCHAR), category]
+                        ORDER BY date DESC, id DESC) AS items
+            FROM (
+                SELECT date, id, item_name, score, category FROM calendar
+                WHERE username = $1 AND date >= $2
+                ORDER BY date DESC, id DESC LIMIT 20
+            )
+        )
+        SELECT total, healthy, moderate, unhealthy, items FROM counts, recent
+    """, [username, threshold_str]).fetchone()
+    return {
+        "total": int(total),
+        "healthy": int(healthy),
+        "moderate": int(moderate),
+        "unhealthy": int(unhealthy),
+        "recent_items": [tuple(r) for r in (recent or [])],
+    }
+
+@routed
+def _load_insights_db(username, days, digest):
+    row = get_db_reader(user_shard(username)).execute(
+        "SELECT insights FROM coach_insights WHERE username = ? AND days = ? AND digest = ?",
+        [username, days, digest]).fetchone()
+    return json.loads(row[0]) if row else None
+
+@routed
+def _save_insights_db(username, days, digest, insights):
+    try:
+        get_db_writer(user_shard(username)).execute(
+            "INSERT OR REPLACE INTO coach_insights VALUES (?, ?, ?, ?, current_timestamp)",
+            [username, days, digest, json.dumps(insights)]).result(timeout=DB_WRITE_TIMEOUT)
+    except Exception as e:
+        log.error("Insights cache write failed", user=username, days=days, error=str(e))
 
 # === 5. AUTH HELPERS ===
 def get_gemini_api_key():
     """Now returns OpenAI API key (function name kept for import compatibility)"""
-    if hasattr(st, 'secrets') and "OPENAI_API_KEY" in st.secrets:
-        return st.secrets["OPENAI_API_KEY"]
+    try:
+        if hasattr(st, 'secrets') and "OPENAI_API_KEY" in st.secrets:
+            return st.secrets["OPENAI_API_KEY"]
+    except Exception:
+        pass  # No secrets.toml (e.g. headless scripts) - fall back to the environment
     return os.getenv("OPENAI_API_KEY")
 
+@routed
 def authenticate_user(username, password):
     try:
-        con = get_db_connection()
+        con = get_db_reader(user_shard(username))
         pwd_hash = hashlib.sha256(password.encode()).hexdigest()
         result = con.execute("SELECT * FROM users WHERE username = ? AND password_hash = ?", [username, pwd_hash]).fetchone()
         is_valid = result is not None
-        print(f"[AUTH] Login attempt for '{username}': {'SUCCESS' if is_valid else 'FAILED'}")
+        log.info("Login attempt", user=username, ok=is_valid)
         return is_valid
     except Exception as e:
-        print(f"[AUTH ERROR] {e}")
+        log.error("Login check failed", user=username, error=str(e))
         return False
 
+@routed
 def add_calendar_item_db(username, date_str, item_name, score):
     try:
-        con = get_db_connection()
         category = 'healthy' if score < 3.0 else 'moderate' if score < 7.0 else 'unhealthy'
-        con.execute("INSERT INTO calendar (username, date, item_name, score, category) VALUES (?, ?, ?, ?, ?)", 
-                   [username, date_str, item_name, score, category])
-        print(f"[CALENDAR] Added: {item_name} ({score}) for {username} on {date_str}")
+        get_db_writer(user_shard(username)).submit(
+            lambda cur: _add_calendar_item_op(cur, username, date_str, item_name, score, category)
+        ).result(timeout=DB_WRITE_TIMEOUT)
+        user_data_cache.bump(username)
+        _mark_dirty([username])
+        log.info("Item logged", user=username, date=date_str, item=item_name, score=score)
     except Exception as e:
-        print(f"[CALENDAR ERROR] {e}")
+        log.error("Calendar write failed", op="add_item", user=username, date=date_str, item=item_name, error=str(e))
 
+@routed
+@user_data_cache.cached
 def get_calendar_items_db(username, date_str):
+    """(id, item_name, score, category, tier) for one day; tier 'cold' items are archived and read-only"""
     try:
-        con = get_db_connection()
-        return con.execute("SELECT id, item_name, score, category FROM calendar WHERE username = ? AND date = ?", 
-                          [username, date_str]).fetchall()
+        shard = user_shard(username)
+        con = get_db_reader(shard)
+        bound = cold_upper_bound(ARCHIVE_DIRS[shard])
+        if bound is None or str(date_str) >= str(bound):
+            return con.execute("SELECT id, item_name, score, category, 'hot' FROM calendar WHERE username = ? AND date = ? ORDER BY id",
+                               [username, date_str]).fetchall()
+        months, params = month_bounds(date_str, date_str)
+        return con.execute(f"""
+            SELECT id, item_name, score, category, tier FROM calendar_all
+            WHERE username = ? AND date = ? AND {months} ORDER BY id
+        """, [username, date_str] + params).fetchall()
     except Exception as e:
-        print(f"[CALENDAR ERROR] {e}")
-        return []
+        log.error("Calendar query failed", user=username, error=str(e))
+        return NoCache([])
 
-def delete_item_db(item_id):
+@routed
+def delete_item_db(username, item_id):
     try:
-        con = get_db_connection()
-        con.execute("DELETE FROM calendar WHERE id = ?", [item_id])
-        print(f"[CALENDAR] Deleted item ID: {item_id}")
+        owners = get_db_writer(user_shard(username)).submit(
+            lambda cur: _delete_calendar_item_op(cur, username, item_id)).result(timeout=DB_WRITE_TIMEOUT)
+        for owner in owners:
+            user_data_cache.bump(owner)
+        _mark_dirty(owners)
+        log.info("Item deleted", user=username, item_id=item_id)
     except Exception as e:
-        print(f"[CALENDAR ERROR] {e}")
+        log.error("Calendar write failed", op="delete_item", user=username, item_id=item_id, error=str(e))
 
-def get_log_history_db(username):
+@routed
+@user_data_cache.cached
+def get_log_history_db(username, limit=None):
+    """The user's items, newest first. Pass a limit to bound it (e.g. for agent prompts)."""
     try:
-        con = get_db_connection()
-        return con.execute("SELECT date, item_name, score, category FROM calendar WHERE username = ? ORDER BY date DESC", 
-                          [username]).fetchall()
+        if limit:
+            return [row[1:] for row in _history_rows(get_db_reader(user_shard(username)), username, None, int(limit))]
+        return get_db_reader(user_shard(username)).execute(
+            "SELECT date, item_name, score, category FROM calendar_all WHERE username = ? ORDER BY date DESC, id DESC",
+            [username]).fetchall()
     except Exception as e:
-        print(f"[LOG ERROR] {e}")
-        return []
+        log.error("Log history query failed", user=username, error=str(e))
+        return NoCache([])
+
+LOG_PAGE_SIZE = 50
+AGENT_HISTORY_LIMIT = 500  # most recent items the meal planners look at
+
+def _history_rows(con, username, cursor, limit):
+    """
+    Up to `limit` rows (id, date, item_name, score, category) after the keyset cursor, newest first.
+    The hot table is tried first; the archive is only read when the hot rows can't fill
+    the page with dates newer than anything archived.
+    """
+    after, params = "", []
+    if cursor is not None:
+        last_date, last_id = cursor
+        after, params = "AND (date < ? OR (date = ? AND id < ?))", [last_date, last_date, last_id]
+    rows = con.execute(f"""
+        SELECT id, date, item_name, score, category FROM calendar
+        WHERE username = ? {after}
+        ORDER BY date DESC, id DESC LIMIT ?
+    """, [username] + params + [limit]).fetchall()
+    bound = cold_upper_bound(ARCHIVE_DIRS[user_shard(username)])
+    if bound is None or (len(rows) == limit and rows[-1][1] >= bound):
+        return rows
+    months, month_params = ("TRUE", []) if cursor is None else month_bounds("0001-01", cursor[0])
+    return con.execute(f"""
+        SELECT id, date, item_name, score, category FROM calendar_all
+        WHERE username = ? {after} AND {months}
+        ORDER BY date DESC, id DESC LIMIT ?
+    """, [username] + params + month_params + [limit]).fetchall()
+
+@routed
+@user_data_cache.cached
+def get_log_history_page_db(username, cursor=None, page_size=LOG_PAGE_SIZE):
+    """
+    One page of history, newest first, using a keyset cursor on (date, id) so
+    every page costs the same no matter how deep into the history it is.
+
+    Args:
+        cursor: None for the first page, otherwise the next_cursor of the previous page
+    Returns:
+        (rows, next_cursor): rows are (id, date, item_name, score, category);
+        next_cursor is None on the last page
+    """
+    try:
+        rows = _history_rows(get_db_reader(user_shard(username)), username, cursor, page_size + 1)
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        next_cursor = (rows[-1][1], rows[-1][0]) if has_more else None
+        return rows, next_cursor
+    except Exception as e:
+        log.error("Log history query failed", user=username, error=str(e))
+        return NoCache(([], None))
 
+@routed
+@user_data_cache.cached
+def count_calendar_items_db(username, since=None):
+    """Number of logged items (optionally since a date), summed from daily_rollup"""
+    try:
+        con = get_db_reader(user_shard(username))
+        if since is None:
+            return int(con.execute("SELECT COALESCE(SUM(count), 0) FROM daily_rollup WHERE username = ?",
+                                   [username]).fetchone()[0])
+        return int(con.execute("SELECT COALESCE(SUM(count), 0) FROM daily_rollup WHERE username = ? AND date >= ?",
+                               [username, since]).fetchone()[0])
+    except Exception as e:
+        log.error("Log history query failed", user=username, error=str(e))
+        return NoCache(0)
+
+@routed
+def export_calendar_db(username, fmt="parquet"):
+    """
+    One user's calendar as file bytes (parquet, csv or jsonl), written by DuckDB's COPY.
+    Not cached: exports are made on demand and can be large. For the app, see export_calendar_file.
+    """
+    import tempfile
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        rows = export_calendar(get_db_reader(user_shard(username)), path, username=username, fmt=fmt)
+        with open(path, "rb") as f:
+            data = f.read()
+        log.info("Calendar exported", user=username, rows=rows, format=fmt, kb=round(len(data) / 1024, 1))
+        return data
+    finally:
+        os.remove(path)
+
+EXPORT_DIR = os.path.join(tempfile.gettempdir(), "foodvantage_exports")
+EXPORT_TTL = 3600  # seconds an export file is kept for its download
+
+def export_calendar_file(username, fmt="parquet"):
+    """
+    Writes one user's calendar to a new file in EXPORT_DIR and returns its path, for
+    st.download_button. Local shards COPY straight into the file; with storage services
+    the bytes come over the connection first. Exports older than EXPORT_TTL are removed.
+    """
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    cutoff = time.time() - EXPORT_TTL
+    for name in os.listdir(EXPORT_DIR):
+        old = os.path.join(EXPORT_DIR, name)
+        try:
+            if os.path.getmtime(old) < cutoff:
+                os.remove(old)
+        except OSError:
+            pass  # removed by another session
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}", dir=EXPORT_DIR)
+    try:
+        if get_storage_client() is None:
+            os.close(fd)
+            with metrics.timed("user_db_seconds", call="export_calendar_file"):
+                rows = export_calendar(get_db_reader(user_shard(username)), path, username=username, fmt=fmt)
+            log.info("Calendar exported", user=username, rows=rows, format=fmt,
+                     kb=round(os.path.getsize(path) / 1024, 1))
+        else:
+            with os.fdopen(fd, "wb") as f:
+                f.write(export_calendar_db(username, fmt))
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+def import_calendar_db(path, username=None, fmt=None):
+    """
+    Bulk import of a calendar file through the writer, in one transaction per shard
+    (a multi-user file is split by user when there are several shards).
+    Unscored rows are rescored by the batch scorer first (outside the transaction).
+
+    Returns:
+        the stats dict from calendar_io.import_calendar, summed over shards
+    """
+    start = time.time()
+    fmt = detect_format(path, fmt)
+    if username is not None or USER_DB_SHARDS == 1:
+        groups = {user_shard(username) if username is not None else 0: None}
+    else:
+        con = duckdb.connect()
+        try:
+            groups = {}
+            for user in file_usernames(con, path, fmt):
+                groups.setdefault(user_shard(user), []).append(user)
+        finally:
+            con.close()
+    data = None
+    if get_storage_client() is not None:
+        with open(path, "rb") as f:
+            data = f.read()  # the storage services may be on other hosts
+    totals = {"read": 0, "inserted": 0, "duplicates": 0, "rescored": 0, "skipped": 0, "users": []}
+    for shard, users in sorted(groups.items()):
+        stats = _import_calendar_shard(shard, path, fmt, username, users, data=data)
+        for key in totals:
+            totals[key] += stats[key]
+    log.info("Calendar imported", path=path, inserted=totals['inserted'], duplicates=totals['duplicates'],
+             rescored=totals['rescored'], skipped=totals['skipped'], seconds=round(time.time() - start, 2))
+    return totals
+
+@routed
+def _import_calendar_shard(shard, path, fmt, username, usernames, data=None):
+    """One shard's part of import_calendar_db; with data, the file's bytes are imported instead of path"""
+    import tempfile
+    if data is not None:
+        fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+    try:
+        names = unscored_item_names(get_db_reader(shard), path, fmt=fmt, username=username, usernames=usernames)
+        scores = score_item_names(names) if names else {}
+        stats = get_db_writer(shard).submit(
+            lambda cur: import_calendar(cur, path, fmt=fmt, username=username, scores=scores, usernames=usernames)
+        ).result(timeout=IMPORT_TIMEOUT)
+    finally:
+        if data is not None:
+            os.remove(path)
+    for user in stats["users"]:
+        user_data_cache.bump(user)  # imported rows go in sorted, so they don't need compaction
+    return stats
+
+@routed
 def create_user(username, password):
     try:
-        con = get_db_connection()
-        exists = con.execute("SELECT * FROM users WHERE username = ?", [username]).fetchone()
-        if exists: 
-            print(f"[AUTH] User '{username}' already exists")
-            return False
         pwd_hash = hashlib.sha256(password.encode()).hexdigest()
-        con.execute("INSERT INTO users VALUES (?, ?)", [username, pwd_hash])
-        print(f"[AUTH] Created new user: '{username}'")
+
+        def _create(cur):
+            # Check and insert in the same transaction so two sign-ups can't race
+            if cur.execute("SELECT 1 FROM users WHERE username = ?", [username]).fetchone():
+                return False
+            cur.execute("INSERT INTO users VALUES (?, ?)", [username, pwd_hash])
+            return True
+
+        created = get_db_writer(user_shard(username)).submit(_create).result(timeout=DB_WRITE_TIMEOUT)
+        if not created:
+            log.info("User already exists", user=username)
+            return False
+        log.info("User created", user=username)
         return True
     except Exception as e:
-        print(f"[AUTH ERROR] Failed to create user '{username}': {e}")
+        log.error("User creation failed", user=username, error=str(e))
         return False
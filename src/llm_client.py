@@ -0,0 +1,274 @@
+"""
+Process-wide OpenAI client layer shared by every Streamlit session.
+
+- One client per (api key, base url), so HTTP connections are kept alive and reused
+- Configurable connect/read timeouts
+- Exponential backoff with full jitter on 429 / 5xx / timeouts (honours Retry-After)
+- Token-bucket limiter for requests/min and tokens/min shared by all sessions
+- Per-endpoint latency and error metrics (in the shared registry, see metrics.py)
+
+Configuration (environment variables):
+    OPENAI_BASE_URL         Point at a local stub server in tests (see stub_openai_server.py)
+    OPENAI_TIMEOUT          Read timeout in seconds (default 60)
+    OPENAI_CONNECT_TIMEOUT  Connect timeout in seconds (default 5)
+    OPENAI_MAX_RETRIES      Retries after the first attempt (default 4)
+    OPENAI_RPM              Requests per minute for the whole process (default 300)
+    OPENAI_TPM              Tokens per minute for the whole process (default 150000)
+"""
+import os
+import sys
+import time
+import random
+import threading
+
+import metrics
+from logs import get_logger
+from prompt_builder import count_tokens
+
+log = get_logger("llm")
+
+# === 1. CONFIG ===
+def _env_float(name, default):
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return float(default)
+
+BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+READ_TIMEOUT = _env_float("OPENAI_TIMEOUT", 60)
+CONNECT_TIMEOUT = _env_float("OPENAI_CONNECT_TIMEOUT", 5)
+MAX_RETRIES = int(_env_float("OPENAI_MAX_RETRIES", 4))
+REQUESTS_PER_MIN = _env_float("OPENAI_RPM", 300)
+TOKENS_PER_MIN = _env_float("OPENAI_TPM", 150000)
+
+BACKOFF_BASE = 0.5   # seconds
+BACKOFF_CAP = 20.0   # seconds
+LIMITER_WAIT = 30.0  # max seconds a call waits for the limiter before giving up
+
+
+def _retryable_errors():
+    # openai is imported on the first call (about 250 ms), not when the app starts
+    import openai
+    return (
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    )
+
+
+class RateLimitedError(Exception):
+    """Raised when the shared limiter cannot admit a call within LIMITER_WAIT."""
+
+
+# === 2. TOKEN BUCKET ===
+class TokenBucket:
+    """Thread-safe token bucket. `rate` tokens are added per second up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1.0, timeout=None):
+        """Block until `amount` tokens are available. Returns False on timeout."""
+        amount = min(float(amount), self.capacity)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return True
+                wait = (amount - self.tokens) / self.rate if self.rate > 0 else 1.0
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(max(wait, 0.01))
+
+    def adjust(self, delta):
+        """Refund (positive) or charge (negative) tokens once the real cost is known."""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + delta)
+
+
+_request_bucket = TokenBucket(REQUESTS_PER_MIN / 60.0, max(1.0, REQUESTS_PER_MIN / 6.0))
+_token_bucket = TokenBucket(TOKENS_PER_MIN / 60.0, max(1.0, TOKENS_PER_MIN / 6.0))
+
+
+def estimate_tokens(messages, max_tokens):
+    """Pre-call cost: local token estimate for text, a flat 800 per image, plus the completion budget."""
+    total = 0
+    for m in messages:
+        content = m.get("content", "")
+        if isinstance(content, str):
+            total += count_tokens(content)
+        else:
+            for part in content:
+                if part.get("type") == "text":
+                    total += count_tokens(part.get("text", ""))
+                else:
+                    total += 800
+    return total + (max_tokens or 0)
+
+
+# === 3. METRICS ===
+# Recorded in the process-wide metrics registry (metrics.py); the last error text is kept here
+_last_errors = {}
+
+metrics.describe("llm_request_seconds", "OpenAI call latency per attempt, by endpoint")
+metrics.describe("llm_errors_total", "Failed OpenAI attempts, by endpoint and error type")
+metrics.describe("llm_retries_total", "Retried OpenAI attempts, by endpoint")
+metrics.describe("llm_rate_limited_total", "Calls refused by the provider (429) or by the shared limiter")
+metrics.describe("llm_tokens_total", "Tokens reported by the provider, by endpoint and kind")
+
+def _record(endpoint, latency=None, error=None, retry=False, rate_limited=False, usage=None):
+    if usage is not None:
+        metrics.inc("llm_tokens_total", getattr(usage, "prompt_tokens", 0) or 0, endpoint=endpoint, kind="prompt")
+        metrics.inc("llm_tokens_total", getattr(usage, "completion_tokens", 0) or 0, endpoint=endpoint, kind="completion")
+    if latency is not None:
+        metrics.observe("llm_request_seconds", latency, endpoint=endpoint)
+    if error is not None:
+        metrics.inc("llm_errors_total", endpoint=endpoint, error=type(error).__name__)
+        _last_errors[endpoint] = f"{type(error).__name__}: {str(error)[:200]}"
+    if retry:
+        metrics.inc("llm_retries_total", endpoint=endpoint)
+    if rate_limited:
+        metrics.inc("llm_rate_limited_total", endpoint=endpoint)
+
+def get_llm_metrics():
+    """Snapshot of per-endpoint stats: calls, errors, retries, rate_limited, token totals, p50/p95/p99 latency (s)."""
+    snap = metrics.snapshot()
+    snapshot = {}
+
+    def stats(endpoint):
+        if endpoint not in snapshot:
+            snapshot[endpoint] = {"calls": 0, "errors": 0, "retries": 0, "rate_limited": 0,
+                                  "prompt_tokens": 0, "completion_tokens": 0,
+                                  "p50": None, "p95": None, "p99": None, "last_error": _last_errors.get(endpoint)}
+        return snapshot[endpoint]
+
+    for name, labels, summary in snap["histograms"]:
+        if name == "llm_request_seconds":
+            stats(labels["endpoint"]).update(calls=summary["count"], p50=summary["p50"],
+                                             p95=summary["p95"], p99=summary["p99"])
+    for name, labels, value in snap["counters"]:
+        field = {"llm_errors_total": "errors", "llm_retries_total": "retries",
+                 "llm_rate_limited_total": "rate_limited"}.get(name)
+        if name == "llm_tokens_total":
+            field = f"{labels['kind']}_tokens"
+        if field:
+            stats(labels["endpoint"])[field] += value
+    return snapshot
+
+
+# === 4. SHARED CLIENT ===
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_openai_client(api_key):
+    """One OpenAI client per (api key, base url) for the whole process, so connections are reused."""
+    key = (api_key, BASE_URL)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            import openai
+            client = openai.OpenAI(
+                api_key=api_key,
+                base_url=BASE_URL,
+                timeout=openai.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+                max_retries=0,  # retries are handled below so they share the limiter
+            )
+            _clients[key] = client
+        return client
+
+def is_rate_limit_error(exc):
+    """True for provider 429s and for our own limiter refusing a call."""
+    if isinstance(exc, RateLimitedError):
+        return True
+    openai = sys.modules.get("openai")  # a provider error means openai is already imported
+    return openai is not None and isinstance(exc, openai.RateLimitError)
+
+def _retry_after(exc):
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def _backoff_delay(attempt, exc):
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+    retry_after = _retry_after(exc)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, BACKOFF_CAP))
+    return delay
+
+
+def chat_completion(endpoint, api_key, messages, max_tokens, model="gpt-4o", **kwargs):
+    """
+    Rate-limited, retried chat completion on the shared client.
+
+    Args:
+        endpoint: metrics label, e.g. "scan", "insights", "meal_plan", "recipes"
+        api_key: OpenAI API key
+        messages: chat messages
+        max_tokens: completion budget (also used for the token limiter)
+    Returns:
+        the OpenAI ChatCompletion response
+    Raises:
+        RateLimitedError if the shared limiter can't admit the call,
+        or the last OpenAI error once retries are exhausted.
+    """
+    client = get_openai_client(api_key)
+    retryable = _retryable_errors()
+    estimated = estimate_tokens(messages, max_tokens)
+
+    for attempt in range(MAX_RETRIES + 1):
+        if not _request_bucket.acquire(1, timeout=LIMITER_WAIT):
+            _record(endpoint, rate_limited=True)
+            raise RateLimitedError(f"Request limit reached for {endpoint}")
+        if not _token_bucket.acquire(estimated, timeout=LIMITER_WAIT):
+            _request_bucket.adjust(1)
+            _record(endpoint, rate_limited=True)
+            raise RateLimitedError(f"Token limit reached for {endpoint}")
+
+        start = time.perf_counter()
+        try:
+            response = client.chat.completions.create(
+                model=model, messages=messages, max_tokens=max_tokens, **kwargs
+            )
+        except retryable as e:
+            _record(endpoint, latency=time.perf_counter() - start, error=e,
+                    rate_limited=is_rate_limit_error(e))
+            if attempt >= MAX_RETRIES:
+                raise
+            delay = _backoff_delay(attempt, e)
+            _record(endpoint, retry=True)
+            log.warning("Retrying LLM call", endpoint=endpoint, error=type(e).__name__, attempt=attempt + 1,
+                        max_retries=MAX_RETRIES, delay=round(delay, 2))
+            time.sleep(delay)
+            continue
+        except Exception as e:
+            _record(endpoint, latency=time.perf_counter() - start, error=e)
+            raise
+
+        latency = time.perf_counter() - start
+        usage = getattr(response, "usage", None)
+        _record(endpoint, latency=latency, usage=usage)
+        if usage is not None and getattr(usage, "total_tokens", None) is not None:
+            _token_bucket.adjust(estimated - usage.total_tokens)
+            log.info("LLM call", endpoint=endpoint, prompt_tokens=usage.prompt_tokens,
+                     completion_tokens=usage.completion_tokens, seconds=round(latency, 3))
+        return response
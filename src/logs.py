@@ -0,0 +1,195 @@
+"""
+Structured, non-blocking logging for the app and the storage services.
+
+- get_logger(name) returns a logger taking fields as keywords:
+      log.info("Item added", user=username, item=item_name)
+- Records go onto a bounded in-memory queue; one background thread formats them
+  (JSON lines, including tracebacks) and writes them, so a request thread never
+  waits on stdout. When the queue is full records are dropped and counted.
+- bind(**fields) / set_context(**fields) attach correlation IDs (session, run,
+  storage call) to every record logged by the current thread or task
+- DEBUG records can be sampled per correlation ID, so a sampled run keeps all of
+  its debug lines and the others keep none
+
+Configuration (environment variables):
+    FOODVANTAGE_LOG_LEVEL         DEBUG, INFO (default), WARNING, ERROR
+    FOODVANTAGE_LOG_FORMAT        json, text, or auto (default: text on a terminal, json otherwise)
+    FOODVANTAGE_LOG_DEBUG_SAMPLE  Fraction of runs whose DEBUG records are kept (default 1.0)
+    FOODVANTAGE_LOG_FILE          Append to this file instead of stderr
+    FOODVANTAGE_LOG_QUEUE         Max records waiting to be written (default 10000)
+
+Only the "foodvantage" logger tree is configured; Streamlit's own logging is untouched.
+"""
+import os
+import sys
+import json
+import uuid
+import zlib
+import queue
+import atexit
+import random
+import logging
+import threading
+import contextvars
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+ROOT_LOGGER = "foodvantage"
+LOG_LEVEL = os.getenv("FOODVANTAGE_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("FOODVANTAGE_LOG_FORMAT", "auto")
+DEBUG_SAMPLE = float(os.getenv("FOODVANTAGE_LOG_DEBUG_SAMPLE", 1.0))
+LOG_FILE = os.getenv("FOODVANTAGE_LOG_FILE") or None
+QUEUE_SIZE = int(os.getenv("FOODVANTAGE_LOG_QUEUE", 10000))
+
+_context = contextvars.ContextVar("log_context", default={})
+
+
+# === 1. CORRELATION IDS ===
+def new_id():
+    return uuid.uuid4().hex[:12]
+
+
+def get_context():
+    return _context.get()
+
+
+def set_context(**fields):
+    """Replaces the current thread's log context, e.g. at the top of each script run"""
+    _context.set({k: v for k, v in fields.items() if v is not None})
+
+
+class bind:
+    """Adds fields to the log context for a block: `with bind(call="add_calendar_item_db"): ...`"""
+
+    def __init__(self, **fields):
+        self.fields = fields
+        self.token = None
+
+    def __enter__(self):
+        self.token = _context.set({**_context.get(), **{k: v for k, v in self.fields.items() if v is not None}})
+        return self
+
+    def __exit__(self, *exc):
+        _context.reset(self.token)
+        return False
+
+
+# === 2. LOGGERS ===
+class FieldLogger(logging.LoggerAdapter):
+    """Keyword arguments other than logging's own become fields of the record"""
+
+    def process(self, msg, kwargs):
+        fields = {k: kwargs.pop(k) for k in list(kwargs) if k not in ("exc_info", "stack_info", "stacklevel", "extra")}
+        kwargs["extra"] = {**kwargs.get("extra", {}), "fields": fields}
+        return msg, kwargs
+
+
+def get_logger(name):
+    setup_logging()
+    return FieldLogger(logging.getLogger(f"{ROOT_LOGGER}.{name}"), {})
+
+
+# === 3. HANDLERS ===
+class _SampleDebug(logging.Filter):
+    """Keeps DEBUG records for DEBUG_SAMPLE of the runs (by correlation ID; random without one)"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.INFO or self.rate >= 1.0:
+            return True
+        ctx = _context.get()
+        key = ctx.get("run") or ctx.get("session")
+        keep = (zlib.crc32(str(key).encode()) % 10000 < self.rate * 10000) if key else random.random() < self.rate
+        if not keep:
+            _count_dropped("sampled")
+        return keep
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """Captures the log context on the calling thread; formatting happens on the listener thread"""
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        record.context = _context.get()
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _count_dropped("queue_full")
+
+
+def _count_dropped(reason):
+    import metrics
+    metrics.inc("log_records_dropped_total", reason=reason)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name.removeprefix(ROOT_LOGGER + "."),
+            "msg": record.getMessage(),
+            "thread": record.threadName,
+            **getattr(record, "context", {}),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        fields = {**getattr(record, "context", {}), **getattr(record, "fields", {})}
+        line = (f"{datetime.fromtimestamp(record.created).strftime('%H:%M:%S.%f')[:-3]} {record.levelname:<7} "
+                f"[{record.name.removeprefix(ROOT_LOGGER + '.')}] {record.getMessage()}")
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+_listener = None
+_setup_lock = threading.Lock()
+
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT, debug_sample=DEBUG_SAMPLE, path=LOG_FILE):
+    """Configures the foodvantage logger once per process and starts the writer thread"""
+    global _listener
+    if _listener is not None:
+        return
+    with _setup_lock:
+        if _listener is not None:
+            return
+        stream = open(path, "a", buffering=1, encoding="utf-8") if path else sys.stderr
+        if fmt == "auto":
+            fmt = "text" if stream.isatty() else "json"
+        writer = logging.StreamHandler(stream)
+        writer.setFormatter(TextFormatter() if fmt == "text" else JsonFormatter())
+
+        handler = _NonBlockingQueueHandler(queue.Queue(maxsize=QUEUE_SIZE))
+        handler.addFilter(_SampleDebug(debug_sample))
+        logger = logging.getLogger(ROOT_LOGGER)
+        logger.setLevel(level)
+        logger.addHandler(handler)
+        logger.propagate = False
+
+        listener = QueueListener(handler.queue, writer)
+        listener.start()
+        atexit.register(_stop_listener, listener)
+        _listener = listener
+
+
+def _stop_listener(listener):
+    """At exit: writes out what is still queued"""
+    try:
+        listener.stop()
+    except queue.Full:
+        pass  # no room for the stop marker; the daemon writer thread ends with the process
@@ -0,0 +1,182 @@
+"""
+Local meal planner: a deterministic 7×3 plan from the products index and the
+user's history, with no LLM call. Same output shape as generate_meal_plan, so
+it can stand in whenever the model is slow, rate-limited or unavailable.
+
+Candidate lists are built once per process; planning itself is a greedy pass
+over those lists and takes a few milliseconds.
+"""
+import re
+import time
+import zlib
+from collections import Counter
+
+import streamlit as st
+
+from gemini_api import (
+    get_scientific_db, calculate_vms_science, MEAL_PLAN_DAYS, MEAL_TYPES
+)
+from logs import get_logger
+
+log = get_logger("meal_planner")
+
+# Keywords that make a product a sensible main for each meal slot
+SLOT_KEYWORDS = {
+    "Breakfast": ["oat", "yogurt", "egg", "muesli", "porridge", "cottage cheese", "whole wheat bread", "kefir"],
+    "Lunch": ["lentil", "chickpea", "bean", "quinoa", "hummus", "tuna", "spinach", "salad"],
+    "Dinner": ["salmon", "chicken breast", "cod", "tofu", "turkey", "brown rice", "sweet potato", "broccoli"],
+}
+# Fresh sides paired with a main to make a meal
+SIDES = {
+    "Breakfast": ["Berries", "Banana", "Apple", "Kiwi"],
+    "Lunch": ["Cucumber", "Cherry Tomatoes", "Avocado", "Mixed Greens"],
+    "Dinner": ["Broccoli", "Spinach", "Green Beans", "Roasted Peppers", "Kale"],
+}
+# Used when the products index isn't available
+STAPLES = {
+    "Breakfast": [("Plain Greek Yogurt", 0.5), ("Rolled Oats", 1.0), ("Boiled Eggs", 0.0), ("Cottage Cheese", 0.5)],
+    "Lunch": [("Lentil Soup", 0.5), ("Chickpea Salad", 1.0), ("Tuna", 0.0), ("Quinoa Bowl", 1.5)],
+    "Dinner": [("Baked Salmon", -1.0), ("Grilled Chicken Breast", 0.0), ("Tofu Stir Fry", 1.0), ("Baked Cod", 0.0)],
+}
+
+HEALTHY_MAX = 3.0       # candidate mains must be Metabolic Green
+DAILY_AVG_MAX = 2.5     # keep each day's average estimated score under this
+CANDIDATES_PER_SLOT = 60
+
+
+def _words(name):
+    return {w for w in re.findall(r"[a-z]+", name.lower()) if len(w) >= 4}
+
+
+@st.cache_resource
+def get_meal_candidates():
+    """
+    Low-VMS candidate mains per meal slot, scored once per process:
+    {slot: [(display_name, score, words), ...]} sorted by score.
+    """
+    start = time.perf_counter()
+    candidates = {}
+    try:
+        con = get_scientific_db().cursor()
+        for slot, keywords in SLOT_KEYWORDS.items():
+            clauses = " OR ".join(["product_name ILIKE ?"] * len(keywords))
+            rows = con.execute(f"""
+                SELECT * FROM products
+                WHERE ({clauses}) AND product_name NOT LIKE '%,%' AND LENGTH(product_name) <= 40
+                LIMIT 3000
+            """, [f"%{k}%" for k in keywords]).fetchall()
+
+            seen, scored = set(), []
+            for r in rows:
+                name = str(r[0]).strip().title()
+                if name in seen:
+                    continue
+                seen.add(name)
+                score = calculate_vms_science(r)
+                if score < HEALTHY_MAX:
+                    scored.append((name, score, _words(name)))
+            scored.sort(key=lambda c: (c[1], c[0]))
+            candidates[slot] = scored[:CANDIDATES_PER_SLOT]
+    except Exception as e:
+        log.warning("Products index unavailable, using staples", error=str(e))
+        candidates = {}
+
+    for slot, staples in STAPLES.items():
+        if len(candidates.get(slot, [])) < 7:
+            candidates[slot] = candidates.get(slot, []) + [(n, s, _words(n)) for n, s in staples]
+    log.info("Meal candidates ready", ms=round((time.perf_counter() - start) * 1000),
+             candidates={k: len(v) for k, v in candidates.items()})
+    return candidates
+
+
+def frequent_high_score_items(user_history, limit=5):
+    """The user's most frequently logged items scoring in the moderate/unhealthy range"""
+    counts = Counter(name for _, name, score, _ in (user_history or []) if score is not None and float(score) >= HEALTHY_MAX)
+    return [name for name, _ in counts.most_common(limit)]
+
+
+def _find_swap(item_name, candidates):
+    """A healthy candidate sharing a word with the item (e.g. 'Strawberry Yogurt' → 'Plain Greek Yogurt')"""
+    words = _words(item_name)
+    best = None
+    for slot in MEAL_TYPES:
+        for cand in candidates[slot]:
+            if words & cand[2] and (best is None or cand[1] < best[1][1]):
+                best = (slot, cand)
+    return best
+
+
+def _estimate(score):
+    """Estimated score of a main served with its side: fresh sides pull it down slightly, but never to 0"""
+    return round(max(-1.0, min(10.0, score * 0.8 + 0.3)), 1)
+
+
+def plan_meals_local(user_history, user_id):
+    """
+    Deterministic 7-day plan built from the local index.
+
+    Constraints: no main repeated within the week, each day's average estimated
+    score under DAILY_AVG_MAX, swaps for the user's frequent high-score items
+    placed first when they fit that budget. Users get different (but stable) plans
+    via their user id. The cap is best effort: when no unused main fits, the
+    best-scoring one is reused and that day may end up over it.
+
+    Returns:
+        dict with day names as keys, list of meal dicts as values (same shape as generate_meal_plan)
+    """
+    start = time.perf_counter()
+    candidates = get_meal_candidates()
+    offset = zlib.crc32(str(user_id).encode())
+
+    # Swaps for frequently logged high-score items go into the plan first
+    swaps = {}  # (day index, slot) -> (name, score, note)
+    used = set()
+    day_idx = 0
+    for item in frequent_high_score_items(user_history):
+        found = _find_swap(item, candidates)
+        if not found or found[1][0] in used:
+            continue
+        slot, (name, score, _) = found
+        swaps[(day_idx % 7, slot)] = (name, score, f"instead of {item}")
+        used.add(name)
+        day_idx += 2  # spread swaps across the week
+
+    plan = {}
+    for d, day_name in enumerate(MEAL_PLAN_DAYS):
+        meals, day_total = [], 0.0
+        for s, slot in enumerate(MEAL_TYPES):
+            # Estimated-score budget left so the day's average so far stays under DAILY_AVG_MAX
+            budget = DAILY_AVG_MAX * (s + 1) - day_total
+            if (d, slot) in swaps and _estimate(swaps[(d, slot)][1]) <= budget:
+                name, score, note = swaps[(d, slot)]
+            else:
+                pool = candidates[slot]
+                name, score, note = None, None, None
+                # Rotate through the pool from a per-user offset; first unused candidate within budget wins
+                for i in range(len(pool)):
+                    cand = pool[(offset + d * 3 + s + i) % len(pool)]
+                    if cand[0] not in used and _estimate(cand[1]) <= budget:
+                        name, score = cand[0], cand[1]
+                        break
+                if name is None:  # everything used or over budget: reuse the best-scoring main
+                    name, score = pool[0][0], pool[0][1]
+                used.add(name)
+
+            side = SIDES[slot][(offset + d) % len(SIDES[slot])]
+            dish = f"{name} with {side}" + (f" ({note})" if note else "")
+            est = _estimate(score)
+            day_total += est
+            meals.append({"meal": slot, "name": dish, "estimated_score": est})
+        plan[day_name] = meals
+
+    log.info("Local meal plan built", user=user_id, ms=round((time.perf_counter() - start) * 1000, 1))
+    return plan
+
+
+@st.cache_resource
+def start_meal_planner_warmup():
+    """Build the candidate lists in the background once per process, so the first plan is instant too"""
+    import threading
+    thread = threading.Thread(target=get_meal_candidates, name="meal-planner-warmup", daemon=True)
+    thread.start()
+    return thread
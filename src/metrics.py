@@ -0,0 +1,269 @@
+"""
+Process-wide metrics: counters and latency histograms for the hot paths.
+
+- inc(name, **labels) counts events, observe(name, seconds, **labels) records a latency
+- timed(name, **labels) times a block (`with timed(...)`) or a function (`@timed(...)`)
+- Histograms keep Prometheus buckets for the whole process plus the last SAMPLES
+  observations for p50/p95/p99
+- register_collector(fn) adds values read from existing stats dicts at dump time
+  (read cache, storage maintenance, DB writer)
+- prometheus_text() renders everything in the Prometheus text format, served by
+  start_metrics_server() on FOODVANTAGE_METRICS_PORT and shown on the admin page
+
+Metric names get the "foodvantage_" prefix in the dump only.
+"""
+import os
+import time
+import threading
+import functools
+from collections import deque
+
+from logs import get_logger
+
+PREFIX = "foodvantage_"
+SAMPLES = 1024  # recent observations kept per histogram for percentiles
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRICS_PORT = int(os.getenv("FOODVANTAGE_METRICS_PORT", 0))  # 0: no HTTP endpoint
+METRICS_HOST = os.getenv("FOODVANTAGE_METRICS_HOST", "127.0.0.1")
+
+log = get_logger("metrics")
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> _Histogram
+_help = {}        # name -> description
+_collectors = []
+
+
+# === 1. RECORDING ===
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=SAMPLES)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def describe(name, text):
+    """Help line for a metric in the Prometheus dump"""
+    _help[name] = text
+
+
+def inc(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = _Histogram(buckets)
+        hist.observe(value)
+
+
+class timed:
+    """
+    Observes the elapsed seconds of a block or of every call of a function into
+    histogram `name`:
+
+        with timed("product_search_seconds", source="local"): ...
+
+        @timed("scan_seconds")
+        def scan(...): ...
+
+    Exceptions are timed too and also counted in `<name without _seconds>_errors_total`.
+    """
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+        if exc_type is not None:
+            inc(self.name.removesuffix("_seconds") + "_errors_total", error=exc_type.__name__, **self.labels)
+        return False
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(self.name, **self.labels):
+                return fn(*args, **kwargs)
+        return wrapper
+
+
+def register_collector(fn):
+    """
+    fn() -> iterable of (name, kind, labels dict, value), kind "counter" or "gauge",
+    called on every dump. For stats that already live elsewhere. Returns fn.
+    """
+    with _lock:
+        if fn not in _collectors:
+            _collectors.append(fn)
+    return fn
+
+
+# === 2. READING ===
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def _collected():
+    samples = []
+    for fn in list(_collectors):
+        try:
+            samples.extend(fn())
+        except Exception as e:
+            log.error("Metrics collector failed", collector=getattr(fn, "__name__", str(fn)), error=str(e))
+    return samples
+
+
+def snapshot():
+    """
+    {"counters": [(name, labels, value)], "histograms": [(name, labels, {count, sum, mean,
+    p50, p95, p99, max})], "collected": [(name, kind, labels, value)]}, sorted by name.
+    Percentiles are over the last SAMPLES observations, in seconds.
+    """
+    with _lock:
+        counters = [(name, dict(labels), value) for (name, labels), value in _counters.items()]
+        histograms = [(name, dict(labels), hist.count, hist.sum, hist.max, list(hist.recent))
+                      for (name, labels), hist in _histograms.items()]
+    summaries = []
+    for name, labels, count, total, peak, recent in histograms:
+        summaries.append((name, labels, {
+            "count": count, "sum": total, "mean": total / count if count else None,
+            "p50": percentile(recent, 50), "p95": percentile(recent, 95), "p99": percentile(recent, 99), "max": peak,
+        }))
+    return {
+        "counters": sorted(counters, key=lambda c: (c[0], sorted(c[1].items()))),
+        "histograms": sorted(summaries, key=lambda h: (h[0], sorted(h[1].items()))),
+        "collected": sorted(_collected(), key=lambda c: (c[0], sorted(c[2].items()))),
+    }
+
+
+def reset():
+    """Drops every recorded counter and histogram (collectors stay registered)"""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+# === 3. PROMETHEUS TEXT FORMAT ===
+def _labels_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def prometheus_text():
+    """All metrics in the Prometheus text exposition format (version 0.0.4)"""
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, (hist.buckets, list(hist.counts), hist.count, hist.sum))
+                            for key, hist in _histograms.items())
+    collected = sorted(((name, kind, tuple(sorted((k, str(v)) for k, v in labels.items()))), value)
+                       for name, kind, labels, value in _collected() if value is not None)
+
+    lines, typed = [], set()
+
+    def header(name, kind):
+        if name not in typed:
+            typed.add(name)
+            if name in _help:
+                lines.append(f"# HELP {PREFIX}{name} {_help[name]}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+    for (name, labels), value in counters:
+        header(name, "counter")
+        lines.append(f"{PREFIX}{name}{_labels_text(labels)} {_number(value)}")
+    for (name, labels), (buckets, counts, count, total) in histograms:
+        header(name, "histogram")
+        cumulative = 0
+        for bound, n in zip(buckets, counts):
+            cumulative += n
+            lines.append(f"{PREFIX}{name}_bucket{_labels_text(labels, [('le', _number(float(bound)))])} {cumulative}")
+        lines.append(f"{PREFIX}{name}_bucket{_labels_text(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{PREFIX}{name}_sum{_labels_text(labels)} {_number(float(total))}")
+        lines.append(f"{PREFIX}{name}_count{_labels_text(labels)} {count}")
+    for (name, kind, labels), value in collected:
+        header(name, kind)
+        lines.append(f"{PREFIX}{name}{_labels_text(labels)} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# === 4. HTTP ENDPOINT ===
+_server = None
+_server_lock = threading.Lock()
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """
+    Serves prometheus_text() at http://host:port/metrics from a daemon thread, once per
+    process. Does nothing when port is 0. Returns the server (or None).
+    """
+    global _server
+    if not port:
+        return None
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer((host, port), Handler)
+            except OSError as e:
+                log.error("Metrics endpoint can't listen", host=host, port=port, error=str(e))
+                return None
+            threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
+            log.info("Serving metrics", url=f"http://{host}:{port}/metrics")
+        return _server
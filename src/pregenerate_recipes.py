@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+"""
+Pre-generates the shared daily recipes so the first visitor of the day doesn't wait.
+
+Usage (e.g. from cron shortly before midnight):
+    python src/pregenerate_recipes.py --days 1
+"""
+import os
+import sys
+import argparse
+
+sys.path.append(os.path.dirname(__file__))
+from gemini_api import pregenerate_daily_recipes
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Warm the shared daily recipe cache")
+    parser.add_argument("--days", type=int, default=1, help="How many days ahead to generate")
+    args = parser.parse_args()
+    pregenerate_daily_recipes(args.days)
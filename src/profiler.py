@@ -0,0 +1,351 @@
+"""
+On-demand CPU and memory profiling of script runs and named operations.
+
+Nothing is profiled until a target is armed, from the admin 📊 Metrics page or with
+FOODVANTAGE_PROFILE at startup:
+
+    FOODVANTAGE_PROFILE="run:3,scan"   # the next 3 script runs and the next scan
+
+Targets: "run" (a full run of app.py or a fragment rerun), "scan" (run_scan) and
+"search" (search_vantage_db). Every profile writes to PROFILE_DIR:
+- <id>.prof    cProfile stats (pstats, snakeviz)
+- <id>.folded  stacks of the profiled thread sampled every INTERVAL_MS, in folded
+               format (flamegraph.pl, speedscope)
+- <id>.json    summary shown on the admin page: wall and CPU time, top functions and,
+               with memory on, the tracemalloc diff over the profile and since tracing
+               started (growth across the armed runs)
+
+One profile records at a time per process: a call starting while another is recorded
+is not profiled and doesn't use up its target's count. Arming is per process, so each
+Streamlit worker is armed on its own.
+
+Configuration (environment variables):
+    FOODVANTAGE_PROFILE              target[:count],... armed at startup
+    FOODVANTAGE_PROFILE_MEMORY       1: targets armed at startup also trace memory
+    FOODVANTAGE_PROFILE_DIR          Where profiles are written (default /tmp/foodvantage_profiles)
+    FOODVANTAGE_PROFILE_KEEP         Newest profiles kept on disk (default 50)
+    FOODVANTAGE_PROFILE_INTERVAL_MS  Stack sampling interval (default 5)
+"""
+import os
+import sys
+import glob
+import json
+import time
+import functools
+import threading
+from collections import Counter
+
+import metrics
+from logs import get_logger, get_context, new_id
+
+TARGETS = ("run", "scan", "search")
+PROFILE_DIR = os.getenv("FOODVANTAGE_PROFILE_DIR", "/tmp/foodvantage_profiles")
+KEEP = int(os.getenv("FOODVANTAGE_PROFILE_KEEP", 50))
+INTERVAL_MS = float(os.getenv("FOODVANTAGE_PROFILE_INTERVAL_MS", 5))
+TOP = 25  # functions and memory lines kept in the summary
+
+log = get_logger("profiler")
+
+_lock = threading.Lock()
+_armed = {}         # target -> {"remaining", "cpu", "memory"}
+_active = None      # the _Recording in progress
+_tracing = False    # tracemalloc was started here
+_baseline = None    # tracemalloc snapshot taken when tracing started
+_local = threading.local()  # the open "run" recording of this thread
+
+
+# === 1. ARMING ===
+def arm(target, runs=1, cpu=True, memory=False):
+    """Profiles the next `runs` calls of target (replaces what was armed for it)"""
+    if target not in TARGETS:
+        raise ValueError(f"Unknown profile target {target!r}, expected one of {TARGETS}")
+    with _lock:
+        _armed[target] = {"remaining": int(runs), "cpu": bool(cpu), "memory": bool(memory)}
+    log.info("Profiling armed", target=target, runs=runs, cpu=cpu, memory=memory)
+
+
+def disarm(target=None):
+    """Drops what is armed for target (all targets when None)"""
+    with _lock:
+        if target is None:
+            _armed.clear()
+        else:
+            _armed.pop(target, None)
+        _stop_tracing_if_idle()
+
+
+def armed():
+    """{target: {"remaining", "cpu", "memory"}} still to be profiled"""
+    with _lock:
+        return {target: dict(settings) for target, settings in _armed.items()}
+
+
+def _arm_from_env():
+    memory = os.getenv("FOODVANTAGE_PROFILE_MEMORY") == "1"
+    for item in filter(None, (s.strip() for s in os.getenv("FOODVANTAGE_PROFILE", "").split(","))):
+        target, _, runs = item.partition(":")
+        try:
+            arm(target, int(runs or 1), memory=memory)
+        except ValueError as e:
+            log.error("Ignoring FOODVANTAGE_PROFILE entry", entry=item, error=str(e))
+
+
+# === 2. RECORDING ===
+class _StackSampler(threading.Thread):
+    """Counts the stacks of one thread, from just inside `base` down, every interval"""
+
+    def __init__(self, thread_id, base, root, interval):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.base = base
+        self.root = root
+        self.interval = interval
+        self.stacks = Counter()
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and frame is not self.base:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[";".join([self.root, *reversed(stack)])] += 1
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+
+class _Recording:
+    def __init__(self, target, labels, cpu, memory):
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{target}-{new_id()[:6]}"
+        self.target = target
+        self.labels = labels
+        self.cpu = cpu
+        self.memory = memory
+        self.thread = threading.current_thread()
+        self.profiler = self.sampler = self.before = None
+
+    def start(self, base):
+        global _tracing, _baseline
+        self.context = dict(get_context())
+        self.started = time.time()
+        if self.memory:
+            import tracemalloc
+            with _lock:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    _tracing, _baseline = True, _memory_snapshot()
+            tracemalloc.reset_peak()
+            self.before = _memory_snapshot()
+        if self.cpu:
+            import cProfile
+            self.sampler = _StackSampler(threading.get_ident(), base, self.target, INTERVAL_MS / 1000)
+            self.sampler.start()
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.wall_start, self.cpu_start = time.perf_counter(), time.thread_time()
+
+    def stop(self, outcome):
+        wall = time.perf_counter() - self.wall_start
+        own_thread = threading.current_thread() is self.thread
+        cpu = time.thread_time() - self.cpu_start if own_thread else None
+        if self.profiler:
+            self.profiler.disable()
+            self.sampler.stop()
+        summary = {"id": self.id, "target": self.target, "labels": self.labels, "context": self.context,
+                   "started": self.started, "outcome": outcome, "wall_ms": wall * 1000,
+                   "cpu_ms": cpu * 1000 if cpu is not None else None, "files": []}
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            stem = os.path.join(PROFILE_DIR, self.id)
+            if self.profiler:
+                self._save_cpu(stem, summary)
+            if self.before is not None:
+                self._save_memory(summary)
+            summary["files"].append(self.id + ".json")
+            with open(stem + ".json", "w") as f:
+                json.dump(summary, f, default=str)
+            _prune()
+        except Exception:
+            log.exception("Saving profile failed", profile=self.id)
+            return None
+        metrics.inc("profiles_total", target=self.target)
+        log.info("Profile saved", profile=self.id, target=self.target, outcome=outcome,
+                 wall_ms=round(wall * 1000, 1), path=PROFILE_DIR)
+        return summary
+
+    def _save_cpu(self, stem, summary):
+        import pstats
+        self.profiler.dump_stats(stem + ".prof")
+        stats = pstats.Stats(self.profiler).stats  # (file, line, name) -> (calls, total calls, own, cumulative, callers)
+        by_cumulative = sorted(stats.items(), key=lambda s: -s[1][3])[:TOP]
+        by_own = sorted(stats.items(), key=lambda s: -s[1][2])[:TOP]
+        summary["functions"] = [
+            {"function": f"{name} ({os.path.basename(path)}:{line})", "calls": calls,
+             "own_ms": own * 1000, "cumulative_ms": cumulative * 1000}
+            for (path, line, name), (_, calls, own, cumulative, _) in dict(by_cumulative + by_own).items()
+        ]
+        with open(stem + ".folded", "w") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in self.sampler.stacks.items())
+        summary["samples"] = sum(self.sampler.stacks.values())
+        summary["files"] += [self.id + ".prof", self.id + ".folded"]
+
+    def _save_memory(self, summary):
+        import tracemalloc
+        after = _memory_snapshot()
+        summary["memory"] = {"peak_kb": tracemalloc.get_traced_memory()[1] / 1024,
+                             "profile": _memory_diff(after, self.before),
+                             "since_tracing": _memory_diff(after, _baseline)}
+
+
+def _memory_snapshot():
+    import tracemalloc
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+
+
+def _memory_diff(after, before):
+    diff = after.compare_to(before, "lineno")
+    top = sorted(diff, key=lambda s: -abs(s.size_diff))[:TOP]
+    return {
+        "kb": sum(s.size_diff for s in diff) / 1024,
+        "lines": [{"line": f"{s.traceback[0].filename}:{s.traceback[0].lineno}", "kb": s.size_diff / 1024,
+                   "blocks": s.count_diff, "total_kb": s.size / 1024} for s in top if s.size_diff],
+    }
+
+
+def _stop_tracing_if_idle():
+    """With _lock held: stops tracemalloc once nothing armed or recording needs it"""
+    global _tracing, _baseline
+    if _tracing and _active is None and not any(a["memory"] for a in _armed.values()):
+        import tracemalloc
+        tracemalloc.stop()
+        _tracing, _baseline = False, None
+
+
+def _begin(target, labels, base):
+    """Starts a recording if target is armed and nothing else is recorded, else None"""
+    global _active
+    with _lock:
+        stale = _active if _active is not None and not _active.thread.is_alive() else None
+    if stale:
+        _end(stale, "unfinished")  # its thread ended without finishing it (script error, session closed)
+    with _lock:
+        settings = _armed.get(target)
+        if settings is None or _active is not None:
+            return None
+        settings["remaining"] -= 1
+        if settings["remaining"] <= 0:
+            del _armed[target]
+        recording = _active = _Recording(target, labels, settings["cpu"], settings["memory"])
+    try:
+        recording.start(base)
+    except Exception:
+        log.exception("Starting profile failed", target=target)
+        with _lock:
+            _active = None
+        return None
+    return recording
+
+
+def _end(recording, outcome):
+    global _active
+    if recording is None:
+        return None
+    try:
+        return recording.stop(outcome)
+    finally:
+        with _lock:
+            if _active is recording:
+                _active = None
+            _stop_tracing_if_idle()
+
+
+class profile:
+    """
+    Profiles a block or every call of a function while `target` is armed:
+
+        with profile("run", fragment="render_trends"): ...
+
+        @profile("scan")
+        def run_scan(...): ...
+
+    Unarmed, it costs one dict lookup.
+    """
+
+    def __init__(self, target, **labels):
+        self.target = target
+        self.labels = labels
+        self.recording = None
+
+    def __enter__(self):
+        if self.target in _armed:
+            self.recording = _begin(self.target, self.labels, sys._getframe(1))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        recording, self.recording = self.recording, None
+        _end(recording, exc_type.__name__ if exc_type else "ok")
+        return False
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with profile(self.target, **self.labels):
+                return fn(*args, **kwargs)
+        return wrapper
+
+
+def start_run(**labels):
+    """
+    Top of a script run: records it if "run" is armed, until finish_run() at the end of
+    the script. A run cut short by st.rerun() is saved as "unfinished" when the next one
+    starts on the same thread.
+    """
+    finish_run("unfinished")
+    if "run" in _armed:
+        _local.run = _begin("run", labels, sys._getframe(1))
+
+
+def finish_run(outcome="ok"):
+    recording, _local.run = getattr(_local, "run", None), None
+    return _end(recording, outcome)
+
+
+# === 3. READING ===
+def list_profiles(limit=None):
+    """Summaries of the saved profiles, newest first"""
+    paths = sorted(glob.glob(os.path.join(PROFILE_DIR, "*.json")), reverse=True)
+    summaries = []
+    for path in paths[:limit]:
+        try:
+            with open(path) as f:
+                summaries.append(json.load(f))
+        except (OSError, ValueError):
+            continue  # being pruned or written
+    return summaries
+
+
+def read_profile_file(name):
+    """Bytes of one file of a saved profile (a name from its summary's "files")"""
+    path = os.path.join(PROFILE_DIR, os.path.basename(name))
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _prune():
+    for path in sorted(glob.glob(os.path.join(PROFILE_DIR, "*.json")), reverse=True)[KEEP:]:
+        for old in glob.glob(path[:-len(".json")] + ".*"):
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+
+_arm_from_env()
@@ -0,0 +1,120 @@
+"""
+Token-aware prompt building shared by the AI agents.
+
+- count_tokens: local estimate (tiktoken when installed, otherwise a chars/words heuristic)
+- compress_history: deduplicated items with counts plus per-category aggregates
+- PromptBuilder: assembles fixed text and trimmable list sections under a token budget
+"""
+from collections import defaultdict
+
+from logs import get_logger
+
+log = get_logger("prompt")
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:  # optional dependency
+    _encoding = None
+
+
+def count_tokens(text):
+    """Token estimate for text. Exact with tiktoken, otherwise ~4 chars or ~0.75 words per token."""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return max(len(text) // 4, int(len(text.split()) * 1.33))
+
+
+def compress_history(history, max_items=None):
+    """
+    Collapses (date, item_name, score, category) rows into prompt lines.
+
+    Returns:
+        (category_lines, item_lines): one line per category with count and average
+        score, and one line per distinct item with how often it was logged -
+        most frequent first, worst score first on ties.
+    """
+    by_category = defaultdict(lambda: [0, 0.0])
+    by_item = {}
+    for _, item_name, score, category in history or []:
+        score = float(score or 0)
+        by_category[category][0] += 1
+        by_category[category][1] += score
+        entry = by_item.setdefault(item_name, [0, 0.0, category])
+        entry[0] += 1
+        entry[1] += score
+
+    category_lines = [
+        f"- {category}: {count} items (avg score {total / count:.1f})"
+        for category, (count, total) in sorted(by_category.items(), key=lambda kv: -kv[1][0])
+    ]
+
+    ordered = sorted(by_item.items(), key=lambda kv: (-kv[1][0], -kv[1][1] / kv[1][0]))
+    if max_items:
+        ordered = ordered[:max_items]
+    item_lines = []
+    for item_name, (count, total, category) in ordered:
+        times = f" ×{count}" if count > 1 else ""
+        item_lines.append(f"- {item_name}{times} (score: {total / count:.1f}, {category})")
+    return category_lines, item_lines
+
+
+class PromptBuilder:
+    """
+    Builds a prompt from ordered sections under a token budget.
+
+    Fixed text is always kept. List sections are trimmed from the end (so put
+    the most important lines first), lowest priority first, down to min_lines,
+    until the prompt fits. Usage:
+
+        pb = PromptBuilder("insights", budget=900)
+        pb.add("You are a coach...")
+        pb.add_list("RECENT ITEMS:", item_lines, priority=1, min_lines=5, empty="No items logged yet.")
+        prompt = pb.build()
+    """
+
+    def __init__(self, name, budget):
+        self.name = name
+        self.budget = budget
+        self.sections = []
+
+    def add(self, text):
+        self.sections.append({"fixed": True, "text": text})
+        return self
+
+    def add_list(self, header, lines, priority=1, min_lines=0, empty=""):
+        self.sections.append({"fixed": False, "header": header, "lines": list(lines),
+                              "priority": priority, "min_lines": min_lines, "empty": empty})
+        return self
+
+    def _render(self):
+        parts = []
+        for s in self.sections:
+            if s["fixed"]:
+                parts.append(s["text"])
+            else:
+                body = "\n".join(s["lines"]) if s["lines"] else s["empty"]
+                parts.append(f"{s['header']}\n{body}" if s["header"] else body)
+        return "\n\n".join(parts)
+
+    def build(self):
+        prompt = self._render()
+        tokens = count_tokens(prompt)
+        trimmed = 0
+        while tokens > self.budget:
+            trimmable = [s for s in self.sections if not s["fixed"] and len(s["lines"]) > s["min_lines"]]
+            if not trimmable:
+                log.warning("Prompt over budget after trimming", prompt=self.name, tokens=tokens, budget=self.budget)
+                break
+            section = min(trimmable, key=lambda s: s["priority"])
+            # Drop roughly the overshoot in one go rather than a line at a time
+            per_line = max(1, count_tokens("\n".join(section["lines"])) // max(1, len(section["lines"])))
+            drop = max(1, min(len(section["lines"]) - section["min_lines"], (tokens - self.budget) // per_line + 1))
+            section["lines"] = section["lines"][:-drop]
+            trimmed += drop
+            prompt = self._render()
+            tokens = count_tokens(prompt)
+        log.debug("Prompt built", prompt=self.name, tokens=tokens, budget=self.budget, trimmed_lines=trimmed)
+        return prompt
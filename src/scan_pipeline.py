@@ -0,0 +1,214 @@
+"""
+Scan pipeline without any UI: preprocess → detect → resolve → score.
+
+Used by `vision_live_scan_dark` in the app (which renders status messages through
+the `on_status` callback) and by the headless `batch_scan.py` CLI.
+"""
+import io
+import re
+import json
+import time
+import base64
+import hashlib
+
+from PIL import Image, ImageEnhance
+
+from gemini_api import (
+    query_vantage_rows, fetch_open_food_facts_rows, score_product_row
+)
+from llm_client import chat_completion
+from logs import get_logger
+import metrics
+import profiler
+
+DETECT_PROMPT = """You are a food detection AI. Identify ALL food items visible in this image.
+
+CRITICAL RULES:
+1. Count EACH item separately (1 apple, 2 bananas = 3 total items)
+2. For PACKAGED goods: Use exact product name from label
+3. For FRESH produce: Use common name, count each piece
+4. List ALL items you see in the frame
+5. Scan the ENTIRE visible area
+
+Return a JSON array like: ["Apple", "Banana", "Banana", "Orange", "Coca Cola"]
+
+If you see 2 apples, list "Apple" twice.
+Be PRECISE. Return ONLY the JSON array, no other text."""
+
+STAGES = ("preprocess", "detect", "resolve", "score")
+
+log = get_logger("scan")
+metrics.describe("scan_stage_seconds", "Scan pipeline stages: image preprocessing, vision detection, lookup, scoring")
+
+
+# === 1. PREPROCESS ===
+def preprocess_image(image_bytes):
+    """
+    Normalises a camera frame for the vision model: RGB, 5% edge crop,
+    contrast/brightness boost. Returns base64 JPEG.
+    """
+    # Handle different input types
+    if isinstance(image_bytes, io.BytesIO):
+        image_bytes = image_bytes.getvalue()
+    elif hasattr(image_bytes, 'read'):
+        image_bytes = image_bytes.read()
+
+    log.debug("Image received", type=type(image_bytes).__name__, bytes=len(image_bytes))
+
+    img = Image.open(io.BytesIO(image_bytes))
+    w, h = img.size
+    log.debug("Image decoded", width=w, height=h, mode=img.mode)
+
+    # Convert to RGB
+    if img.mode == 'RGBA':
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[3] if len(img.split()) == 4 else None)
+        img = background
+    elif img.mode == 'LA':
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[1])
+        img = background
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    # Minimal crop (5% edges) to avoid UI elements, but scan most of frame
+    img_cropped = img.crop((int(w * 0.05), int(h * 0.05), int(w * 0.95), int(h * 0.95)))
+
+    img_cropped = ImageEnhance.Contrast(img_cropped).enhance(1.5)
+    img_cropped = ImageEnhance.Brightness(img_cropped).enhance(1.2)
+
+    if img_cropped.mode != 'RGB':
+        img_cropped = img_cropped.convert('RGB')
+
+    buf = io.BytesIO()
+    img_cropped.save(buf, format="JPEG", quality=95)
+    return base64.b64encode(buf.getvalue()).decode('utf-8')
+
+
+# === 2. DETECT (VISION BACKENDS) ===
+def parse_detected_items(response_text):
+    """JSON array of item names from a model reply, or the whole reply as one item"""
+    json_match = re.search(r'\[.*?\]', response_text, re.DOTALL)
+    if json_match:
+        return json.loads(json_match.group(0))
+    product_name = response_text.replace('"', '').replace('*', '').replace('.', '')
+    return [product_name]
+
+
+class VisionBackend:
+    """Turns a preprocessed (base64 JPEG) image into a list of detected item names."""
+    name = "base"
+
+    def detect(self, img_b64):
+        raise NotImplementedError
+
+
+class OpenAIVisionBackend(VisionBackend):
+    """GPT-4o vision through the shared, rate-limited client."""
+    name = "openai"
+
+    def __init__(self, api_key, model="gpt-4o"):
+        self.api_key = api_key
+        self.model = model
+
+    def detect(self, img_b64):
+        response = chat_completion(
+            "scan", self.api_key,
+            messages=[{
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": DETECT_PROMPT},
+                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_b64}", "detail": "high"}}
+                ]
+            }],
+            max_tokens=500,
+            model=self.model
+        )
+        response_text = response.choices[0].message.content.strip()
+        log.debug("Vision response", model=self.model, text=response_text)
+        return parse_detected_items(response_text)
+
+
+class LocalVisionBackend(VisionBackend):
+    """
+    Deterministic stand-in: the same image always yields the same 1-3 items,
+    picked from `vocabulary` by the image digest. No network, no API key.
+    """
+    name = "local"
+
+    DEFAULT_VOCABULARY = [
+        "Apple", "Banana", "Orange", "Avocado", "Broccoli", "Salmon",
+        "Greek Yogurt", "Coca Cola", "Orange Juice", "Peanut Butter",
+        "Whole Wheat Bread", "Cheddar Cheese", "Potato Chips", "Oat Milk",
+    ]
+
+    def __init__(self, vocabulary=None, latency=0.0):
+        self.vocabulary = list(vocabulary or self.DEFAULT_VOCABULARY)
+        self.latency = latency
+
+    def detect(self, img_b64):
+        if self.latency:
+            time.sleep(self.latency)
+        digest = hashlib.sha256(img_b64.encode()).digest()
+        count = 1 + digest[0] % 3
+        return [self.vocabulary[digest[i + 1] % len(self.vocabulary)] for i in range(count)]
+
+
+# === 3. RESOLVE + SCORE ===
+def resolve_items(detected_items):
+    """Best raw product row per detected item: local index first, then Open Food Facts"""
+    resolved = []
+    for item in detected_items:
+        try:
+            rows = query_vantage_rows(item, limit=1)
+        except Exception as e:
+            log.error("Local lookup failed", item=item, error=str(e))
+            rows = []
+        if not rows:
+            rows = fetch_open_food_facts_rows(item, limit=1)
+        resolved.extend(rows)
+    return resolved
+
+def score_rows(rows):
+    """VMS result dicts for resolved rows, dropping the 10.0 default scores"""
+    return [r for r in (score_product_row(row) for row in rows) if r['vms_score'] != 10.0]
+
+
+# === 4. PIPELINE ===
+@profiler.profile("scan")
+def run_scan(image_bytes, backend, on_status=None):
+    """
+    Runs preprocess → detect → resolve → score for one image.
+
+    Args:
+        image_bytes: bytes, BytesIO or file-like
+        backend: a VisionBackend
+        on_status: optional callback(stage, payload) for UI progress
+    Returns:
+        dict with "detected" (names), "results" (scored dicts) and "timings" (seconds per stage)
+    """
+    timings = {}
+    notify = on_status or (lambda stage, payload: None)
+
+    start = time.perf_counter()
+    img_b64 = preprocess_image(image_bytes)
+    timings["preprocess"] = time.perf_counter() - start
+
+    notify("analyzing", None)
+    start = time.perf_counter()
+    detected_items = backend.detect(img_b64)
+    timings["detect"] = time.perf_counter() - start
+    log.info("Items detected", backend=backend.name, count=len(detected_items), items=detected_items)
+    notify("detected", detected_items)
+
+    start = time.perf_counter()
+    rows = resolve_items(detected_items)
+    timings["resolve"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = score_rows(rows)
+    timings["score"] = time.perf_counter() - start
+
+    for stage, seconds in timings.items():
+        metrics.observe("scan_stage_seconds", seconds, stage=stage)
+    return {"detected": detected_items, "results": results, "timings": timings}
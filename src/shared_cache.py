@@ -0,0 +1,176 @@
+"""
+Process-wide caching helpers shared by all Streamlit sessions.
+
+- SingleFlight: concurrent callers for the same key wait on one in-flight computation
+- JsonDiskCache: small JSON documents on disk, written atomically, survive restarts
+- VersionedCache: per-user read cache invalidated by bumping the user's data version
+"""
+import os
+import json
+import time
+import threading
+import functools
+from collections import OrderedDict
+
+from logs import get_logger
+
+log = get_logger("cache")
+
+CACHE_DIR = os.getenv("FOODVANTAGE_CACHE_DIR", "/tmp/foodvantage_cache")
+
+
+class SingleFlight:
+    """Runs fn once per key at a time; everyone who asks meanwhile gets the same result (or error)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"event": threading.Event(), "result": None, "error": None}
+                self.calls[key] = call
+
+        if not leader:
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call["event"].set()
+
+
+class JsonDiskCache:
+    """One JSON file per key under CACHE_DIR/<namespace>/."""
+
+    def __init__(self, namespace):
+        self.dir = os.path.join(CACHE_DIR, namespace)
+
+    def _path(self, key):
+        safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in str(key))
+        return os.path.join(self.dir, f"{safe}.json")
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, value):
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            path = self._path(key)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(value, f)
+            os.replace(tmp, path)  # atomic: readers never see a half-written file
+        except OSError as e:
+            log.warning("Could not write cache entry to disk", key=key, error=str(e))
+
+
+class NoCache:
+    """
+    Returned by a VersionedCache.cached function to hand `value` to the caller without
+    caching it, for error fallbacks (`return NoCache([])`): the next call queries again
+    instead of serving "no data" for the whole TTL.
+    """
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class VersionedCache:
+    """
+    In-memory cache for per-user reads. Every write for a user bumps that user's
+    version, so cached reads keyed on the old version are simply never asked for
+    again (and age out of the LRU). A TTL bounds staleness from writers outside
+    this process.
+
+        cache = VersionedCache("user_data")
+
+        @cache.cached
+        def get_items(username, day): ...   # first argument must be the user
+
+        cache.bump(username)                # after a write commits
+
+    Cached values are shared by every caller: treat them as read-only (copy before
+    changing one). Error fallbacks should be returned as NoCache(value).
+    """
+
+    def __init__(self, name, ttl=120.0, max_entries=4096):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.versions = {}
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.counts = {}              # fn name -> [hits, misses]
+
+    def version(self, user):
+        with self.lock:
+            return self.versions.get(user, 0)
+
+    def bump(self, user):
+        with self.lock:
+            self.versions[user] = self.versions.get(user, 0) + 1
+
+    def clear(self):
+        """Drop every cached entry (for changes that aren't tied to one user's writes)"""
+        with self.lock:
+            self.entries.clear()
+
+    def cached(self, fn):
+        @functools.wraps(fn)
+        def wrapper(user, *args, **kwargs):
+            # Today's date is part of the key: "last N days" reads change at midnight without a write
+            key = (fn.__name__, user, self.version(user), time.strftime("%Y-%m-%d"),
+                   args, tuple(sorted(kwargs.items())))
+            now = time.monotonic()
+            with self.lock:
+                counts = self.counts.setdefault(fn.__name__, [0, 0])
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] > now:
+                    self.entries.move_to_end(key)
+                    counts[0] += 1
+                    return entry[1]
+                counts[1] += 1
+            value = fn(user, *args, **kwargs)
+            if isinstance(value, NoCache):
+                return value.value
+            with self.lock:
+                self.entries[key] = (now + self.ttl, value)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            return value
+        def uncached(*args, **kwargs):
+            value = fn(*args, **kwargs)
+            return value.value if isinstance(value, NoCache) else value
+        wrapper.uncached = uncached
+        return wrapper
+
+    def stats(self):
+        """Per-function hits, misses and hit rate, plus the number of cached entries."""
+        with self.lock:
+            per_fn = {
+                name: {"hits": h, "misses": m, "hit_rate": h / (h + m) if h + m else None}
+                for name, (h, m) in self.counts.items()
+            }
+            hits = sum(v["hits"] for v in per_fn.values())
+            misses = sum(v["misses"] for v in per_fn.values())
+            return {"entries": len(self.entries), "hits": hits, "misses": misses,
+                    "hit_rate": hits / (hits + misses) if hits + misses else None, "functions": per_fn}
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Storage service: one process per user DB shard, so several app replicas can share
+the user data (DuckDB lets only one process write a file).
+
+Each service opens its shard (see user_shards.py), runs the batch writer and the
+background maintenance, and answers per-user calls from the app over
+multiprocessing.connection. App replicas started with FOODVANTAGE_STORAGE_ADDRS
+(one host:port per shard, in shard order) send every call for a user to that
+user's service instead of opening the DB themselves; the per-user read cache
+lives in the service, next to the writes that invalidate it.
+
+Usage:
+    python src/storage_service.py --shard 0 --port 7400          # one shard
+    python src/storage_service.py --cluster --shards 4           # all shards, locally
+    python src/storage_service.py --cluster --shards 4 --replicas 2   # plus 2 app replicas
+    python src/storage_service.py --shard 0 --metrics-port 9400  # plus Prometheus metrics
+
+Every process must agree on FOODVANTAGE_USER_SHARDS and FOODVANTAGE_USER_DB.
+Calls are pickled, so whoever passes the handshake can run code in the service:
+services and clients refuse any non-loopback address unless
+FOODVANTAGE_STORAGE_AUTHKEY is set (to the same secret everywhere).
+"""
+import os
+import sys
+import time
+import queue
+import signal
+import socket
+import argparse
+import logging
+import ipaddress
+import threading
+import subprocess
+from multiprocessing.connection import Client, Listener
+
+from logs import get_logger, get_context, bind
+from metrics import timed, describe
+
+STORAGE_AUTHKEY = os.getenv("FOODVANTAGE_STORAGE_AUTHKEY", "").encode() or None
+LOOPBACK_AUTHKEY = b"foodvantage-local"  # only ever used on loopback addresses
+STORAGE_BASE_PORT = int(os.getenv("FOODVANTAGE_STORAGE_BASE_PORT", 7400))
+STORAGE_TIMEOUT = float(os.getenv("FOODVANTAGE_STORAGE_TIMEOUT", 30))  # seconds to wait for a reply
+
+describe("storage_call_seconds", "Storage calls served for app replicas, by function (service side)")
+log = get_logger("storage")
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        pass  # a host name
+    try:
+        return all(ipaddress.ip_address(info[4][0]).is_loopback for info in socket.getaddrinfo(host, None))
+    except (OSError, ValueError):
+        return False
+
+
+def storage_authkey(host, authkey=STORAGE_AUTHKEY):
+    """
+    The authkey for a service listening on (or a client connecting to) host.
+    Raises ValueError for a non-loopback host without FOODVANTAGE_STORAGE_AUTHKEY.
+    """
+    if authkey:
+        return authkey
+    if is_loopback(host):
+        return LOOPBACK_AUTHKEY
+    raise ValueError(f"Storage address {host} is not loopback: set FOODVANTAGE_STORAGE_AUTHKEY "
+                     f"(the same secret for every service and app replica)")
+
+
+def parse_addresses(value):
+    """'host:port,host:port' -> [(host, port), ...]"""
+    addresses = []
+    for part in (value or "").split(","):
+        if part.strip():
+            host, _, port = part.strip().rpartition(":")
+            addresses.append((host or "127.0.0.1", int(port)))
+    return addresses
+
+
+class StorageClient:
+    """
+    Sends calls to the storage service of each shard. Connections are pooled per
+    shard and reused, so a call costs one round trip. A pooled connection whose
+    service went away is replaced before sending; a call is never re-sent, since
+    the service may already have applied it.
+    """
+
+    def __init__(self, addresses, shards, authkey=STORAGE_AUTHKEY, timeout=STORAGE_TIMEOUT):
+        if len(addresses) != shards:
+            raise ValueError(f"FOODVANTAGE_STORAGE_ADDRS lists {len(addresses)} services for {shards} shards")
+        self.addresses = addresses
+        self.shards = shards
+        self.authkeys = [storage_authkey(host, authkey) for host, _ in addresses]
+        self.timeout = timeout
+        self.pools = [queue.LifoQueue() for _ in addresses]
+        self.stats = {"calls": 0, "connects": 0, "errors": 0}
+
+    def _connect(self, shard):
+        self.stats["connects"] += 1
+        try:
+            conn = Client(self.addresses[shard], authkey=self.authkeys[shard])
+            conn.send(("ping", (), {}))
+            status, info = conn.recv()
+        except (OSError, EOFError) as e:
+            raise ConnectionError(f"Storage shard {shard} at {self.addresses[shard]} unavailable: {e}") from e
+        if status != "ok" or info["shard"] != shard or info["shards"] != self.shards:
+            conn.close()
+            raise RuntimeError(f"Storage service at {self.addresses[shard]} is shard {info.get('shard')} of "
+                               f"{info.get('shards')}, expected shard {shard} of {self.shards}")
+        return conn
+
+    def _checkout(self, shard):
+        while True:
+            try:
+                conn = self.pools[shard].get_nowait()
+            except queue.Empty:
+                return self._connect(shard)
+            try:
+                if not conn.poll(0):  # idle connections have nothing to read unless the service closed them
+                    return conn
+            except (OSError, EOFError):
+                pass
+            conn.close()
+
+    def call(self, shard, name, args=(), kwargs=None):
+        """Runs the routed function `name` on the shard's service; raises the service's exception on failure"""
+        self.stats["calls"] += 1
+        conn = self._checkout(shard)
+        try:
+            conn.send((name, tuple(args), kwargs or {}, get_context()))  # the caller's correlation IDs
+            if not conn.poll(self.timeout):
+                raise TimeoutError(f"No reply from storage shard {shard} within {self.timeout}s")
+            status, result = conn.recv()
+        except Exception as e:
+            conn.close()  # a late reply would otherwise answer the next call on this connection
+            self.stats["errors"] += 1
+            if isinstance(e, (EOFError, ConnectionError)):
+                raise ConnectionError(f"Storage shard {shard} at {self.addresses[shard]} closed the connection") from e
+            raise
+        self.pools[shard].put(conn)
+        if status == "error":
+            self.stats["errors"] += 1
+            raise result
+        return result
+
+
+def _handle(conn, shard, shards, calls, key_shard):
+    with conn:
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                return
+            name, args, kwargs = message[:3]
+            context = message[3] if len(message) > 3 else {}
+            try:
+                if name == "ping":
+                    result = {"shard": shard, "shards": shards, "pid": os.getpid()}
+                else:
+                    if name not in calls:
+                        raise KeyError(f"Unknown storage call {name!r}")
+                    if not args or key_shard(args[0]) != shard:
+                        raise ValueError(f"{name}({args[0] if args else ''!r}) does not belong to shard {shard}")
+                    with bind(**{**context, "call": name, "shard": shard}), timed("storage_call_seconds", call=name):
+                        result = calls[name](*args, **kwargs)
+                reply = ("ok", result)
+            except Exception as e:
+                reply = ("error", e)
+            try:
+                conn.send(reply)
+            except (EOFError, OSError):
+                return
+            except Exception as e:  # result or exception that doesn't pickle
+                conn.send(("error", RuntimeError(f"{name}: {type(e).__name__}: {e}")))
+
+
+def serve(shard, host="127.0.0.1", port=None, authkey=STORAGE_AUTHKEY, metrics_port=0):
+    """Open the shard, start its maintenance and serve calls until the process is stopped"""
+    import gemini_api
+    from metrics import start_metrics_server
+
+    if gemini_api.STORAGE_ADDRS:
+        raise RuntimeError("Unset FOODVANTAGE_STORAGE_ADDRS for storage services; they open their shard directly")
+    if not 0 <= shard < gemini_api.USER_DB_SHARDS:
+        raise ValueError(f"Shard {shard} out of range for FOODVANTAGE_USER_SHARDS={gemini_api.USER_DB_SHARDS}")
+    port = STORAGE_BASE_PORT + shard if port is None else port
+
+    def key_shard(key):
+        return key if isinstance(key, int) else gemini_api.user_shard(key)
+
+    authkey = storage_authkey(host, authkey)
+    gemini_api.get_db_writer(shard)
+    gemini_api.start_db_maintenance(shards=(shard,))
+    start_metrics_server(metrics_port, host)
+    # The default backlog of 1 drops concurrent connects from busy replicas, which then hang in the handshake
+    listener = Listener((host, port), backlog=socket.SOMAXCONN, authkey=authkey)
+    log.info("Storage service listening", shard=shard, shards=gemini_api.USER_DB_SHARDS,
+             path=gemini_api.USER_DB_PATHS[shard], address=f"{host}:{port}")
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception as e:  # failed handshake (wrong authkey) or a dropped client
+            log.warning("Rejected connection", error=str(e))
+            continue
+        threading.Thread(target=_handle, args=(conn, shard, gemini_api.USER_DB_SHARDS, gemini_api.ROUTED_CALLS, key_shard),
+                         name=f"storage-{shard}-conn", daemon=True).start()
+
+
+def run_cluster(shards, host="127.0.0.1", base_port=STORAGE_BASE_PORT, replicas=0, app_port=8501):
+    """
+    Local multi-process setup: one storage service per shard and, optionally, app
+    replicas pointed at them. Ctrl-C stops everything.
+    """
+    storage_authkey(host)  # before starting anything: a non-loopback host needs FOODVANTAGE_STORAGE_AUTHKEY
+    env = dict(os.environ, FOODVANTAGE_USER_SHARDS=str(shards))
+    env.pop("FOODVANTAGE_STORAGE_ADDRS", None)
+    procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "--shard", str(i),
+                               "--host", host, "--port", str(base_port + i)], env=env)
+             for i in range(shards)]
+    addresses = ",".join(f"{host}:{base_port + i}" for i in range(shards))
+    app_env = dict(env, FOODVANTAGE_STORAGE_ADDRS=addresses)
+    app = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+    for i in range(replicas):
+        procs.append(subprocess.Popen([sys.executable, "-m", "streamlit", "run", app, "--server.port", str(app_port + i),
+                                       "--server.headless", "true"], env=app_env))
+    print(f"[STORAGE] Cluster: {shards} shards, {replicas} app replicas")
+    print(f"[STORAGE] export FOODVANTAGE_USER_SHARDS={shards} FOODVANTAGE_STORAGE_ADDRS={addresses}")
+    try:
+        while all(p.poll() is None for p in procs):
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.send_signal(signal.SIGINT)
+        for p in procs:
+            try:
+                p.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+
+def main():
+    sys.path.append(os.path.dirname(__file__))
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").setLevel(logging.ERROR)
+    parser = argparse.ArgumentParser(description="FoodVantage user DB storage service")
+    parser.add_argument("--shard", type=int, help="Serve this shard")
+    parser.add_argument("--cluster", action="store_true", help="Start a service for every shard locally")
+    parser.add_argument("--shards", type=int, help="Shard count for --cluster (default FOODVANTAGE_USER_SHARDS)")
+    parser.add_argument("--replicas", type=int, default=0, help="App replicas to start with --cluster")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help=f"Listen port (default {STORAGE_BASE_PORT} + shard)")
+    parser.add_argument("--metrics-port", type=int, default=0, help="Serve Prometheus metrics on this port")
+    args = parser.parse_args()
+
+    try:
+        storage_authkey(args.host)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.cluster:
+        run_cluster(args.shards or int(os.getenv("FOODVANTAGE_USER_SHARDS", 1)), host=args.host,
+                    base_port=args.port or STORAGE_BASE_PORT, replicas=args.replicas)
+    elif args.shard is not None:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: sys.exit(0))  # exit normally so atexit checkpoints the shard
+        serve(args.shard, host=args.host, port=args.port, metrics_port=args.metrics_port)
+    else:
+        parser.error("pass --shard N or --cluster")
+
+
+if __name__ == "__main__":
+    main()
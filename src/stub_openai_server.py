@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the OpenAI chat completions API.
+
+Returns canned JSON that matches what each FoodVantage agent expects, so the app
+and scripts can run without a real key or network access.
+
+Usage:
+    python src/stub_openai_server.py --port 8765 [--latency 0.2] [--fail-every 3]
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stub streamlit run app.py
+
+In Python (e.g. from a test script):
+    server, base_url = start_stub_server()
+    ...
+    server.shutdown()
+"""
+import re
+import json
+import time
+import threading
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+def _canned_reply(prompt, has_image):
+    """Pick a reply shaped like the agent that sent the prompt."""
+    if has_image:
+        return json.dumps(["Apple", "Banana", "Banana"])
+    def day_meals(d):
+        return [
+            {"meal": "Breakfast", "name": f"Greek yogurt with berries ({d})", "estimated_score": 1.5},
+            {"meal": "Lunch", "name": f"Lentil and spinach salad ({d})", "estimated_score": 1.0},
+            {"meal": "Dinner", "name": f"Baked salmon with broccoli ({d})", "estimated_score": 0.5},
+        ]
+    single_day = re.search(r"Plan (\w+)'s meals", prompt)
+    if single_day:
+        return json.dumps(day_meals(single_day.group(1)))
+    if "meal plan" in prompt.lower():
+        return json.dumps({d: day_meals(d) for d in DAYS})
+    if "recipe" in prompt.lower():
+        return json.dumps([
+            {"name": f"Stub Recipe {i + 1}", "cuisine": "Mediterranean", "meal_type": t,
+             "prep_time": "15 min", "description": "A stub recipe.", "key_ingredients": "beans, greens"}
+            for i, t in enumerate(["Breakfast", "Lunch", "Dinner", "Snack", "Dessert"])
+        ])
+    return json.dumps([
+        {"emoji": e, "title": f"Stub Insight {i + 1}", "insight": "Stub observation.", "action": "Stub action."}
+        for i, e in enumerate(["🥗", "💪", "🎯"])
+    ])
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    fail_every = 0
+    calls = 0
+    lock = threading.Lock()
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+
+        if not self.path.endswith("/chat/completions"):
+            self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        with StubHandler.lock:
+            StubHandler.calls += 1
+            call_no = StubHandler.calls
+        if self.fail_every and call_no % self.fail_every == 0:
+            self._send(429, {"error": {"message": "Rate limit reached (stub)", "type": "rate_limit_exceeded"}},
+                       headers={"Retry-After": "0"})
+            return
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        prompt, has_image = "", False
+        for m in request.get("messages", []):
+            content = m.get("content", "")
+            if isinstance(content, str):
+                prompt += content
+            else:
+                for part in content:
+                    if part.get("type") == "text":
+                        prompt += part.get("text", "")
+                    else:
+                        has_image = True
+
+        reply = _canned_reply(prompt, has_image)
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = len(reply) // 4
+        self._send(200, {
+            "id": f"chatcmpl-stub-{call_no}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4o"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": reply}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+
+def start_stub_server(port=0, latency=0.0, fail_every=0):
+    """Start the stub in a daemon thread. Returns (server, base_url)."""
+    StubHandler.latency = latency
+    StubHandler.fail_every = fail_every
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OpenAI stub for FoodVantage")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to sleep per request")
+    parser.add_argument("--fail-every", type=int, default=0, help="Return 429 on every Nth request")
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(args.port, args.latency, args.fail_every)
+    print(f"🧪 Stub OpenAI server on {base_url} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Archive integrity test.
+Queues a calendar archive right behind a write that fails, on the same user DB writer,
+then checks that every archived row was written to Parquet exactly once: the hot table,
+the archive files, calendar_all and daily_rollup must all agree on the row count.
+
+Usage:
+    cd FoodVantage/src
+    python test_archive.py
+    python test_archive.py --rows 500
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import threading
+from datetime import date, timedelta
+
+ITEMS = [("Apple", 1.2), ("Greek Yogurt", 2.1), ("Granola", 5.4), ("Cola", 8.9), ("Lentil Soup", 1.8)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive next to a failing write on the same writer")
+    parser.add_argument("--rows", type=int, default=50, help="Old calendar rows to archive")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="fv_archive_")
+    os.environ["FOODVANTAGE_USER_DB"] = os.path.join(workdir, "user_data.db")
+    os.environ.pop("FOODVANTAGE_STORAGE_ADDRS", None)
+    os.environ.setdefault("FOODVANTAGE_LOG_LEVEL", "WARNING")
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").setLevel(logging.ERROR)
+    from gemini_api import (get_db_writer, get_db_reader, archive_user_db, rebuild_daily_rollup,
+                            CALENDAR_COLUMNS, ARCHIVE_DIRS, HOT_DAYS)
+    from calendar_archive import archive_glob
+
+    old = date.today() - timedelta(days=HOT_DAYS + 30)
+    rows = [("archive_user", (old - timedelta(days=i % 20)).isoformat(), *ITEMS[i % len(ITEMS)],
+             "healthy" if ITEMS[i % len(ITEMS)][1] < 3.0 else "moderate") for i in range(args.rows)]
+    writer = get_db_writer(0)
+
+    def seed(cur):
+        cur.executemany(f"INSERT INTO calendar ({CALENDAR_COLUMNS}) VALUES (?, ?, ?, ?, ?)", rows)
+        rebuild_daily_rollup(cur)
+    writer.submit(seed).result(timeout=60)
+
+    # Hold the writer so the failing write and the archive are queued together
+    release = threading.Event()
+    writer.submit(lambda cur: release.wait(30))
+    time.sleep(writer.max_wait * 10)  # past the blocker's batch window
+    archived = []
+    archiver = threading.Thread(target=lambda: archived.append(archive_user_db(shard=0)))
+    archiver.start()
+    while writer.queue.qsize() < 1:
+        time.sleep(0.01)
+    # After the archive: it has written its files by the time this fails
+    failing = writer.submit(lambda cur: cur.execute(
+        f"INSERT INTO calendar ({CALENDAR_COLUMNS}) VALUES ('archive_user', 'not-a-date', 'Apple', 1.2, 'healthy')"))
+    release.set()
+    archiver.join(timeout=120)
+
+    reader = get_db_reader(0)
+    path = archive_glob(ARCHIVE_DIRS[0]).replace("'", "''")
+    counts = {
+        "archived": archived[0] if archived else None,
+        "hot": reader.execute("SELECT COUNT(*) FROM calendar").fetchone()[0],
+        "parquet": reader.execute(f"SELECT COUNT(*) FROM read_parquet('{path}')").fetchone()[0],
+        "calendar_all": reader.execute("SELECT COUNT(*) FROM calendar_all").fetchone()[0],
+        "daily_rollup": int(reader.execute("SELECT SUM(count) FROM daily_rollup").fetchone()[0]),
+    }
+    expected = {"archived": args.rows, "hot": 0, "parquet": args.rows, "calendar_all": args.rows,
+                "daily_rollup": args.rows}
+
+    print("\n" + "=" * 70)
+    print("FOODVANTAGE ARCHIVE NEXT TO A FAILING WRITE")
+    print("=" * 70)
+    print(f"   {'❌ succeeded' if failing.exception(timeout=10) is None else '✅ failed'}  bad-date insert")
+    for name, value in counts.items():
+        print(f"   {'✅' if value == expected[name] else '❌'} {name:<14} {value} (expected {expected[name]})")
+    ok = counts == expected and failing.exception() is not None
+    print("=" * 70)
+    print("\nEvery row archived once." if ok else "\n❌ Archive and table counts disagree.")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
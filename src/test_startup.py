@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Startup time check.
+Reports which imports the app pays for at startup (from `python -X importtime`), checks
+that the heavy optional dependencies are only imported on first use, then times a cold
+first run of app.py in a fresh process on a scratch user DB against a budget.
+
+Usage:
+    cd FoodVantage/src
+    python test_startup.py                     # budget from FOODVANTAGE_STARTUP_BUDGET_MS (default 1000)
+    python test_startup.py --budget-ms 2000 --runs 5 --top 20
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP = os.path.join(os.path.dirname(HERE), "app.py")
+APP_MODULES = "import gemini_api, meal_planner"
+
+# Loaded on first use (OpenAI call, Open Food Facts fallback, result grids / Vega chart, scan), never at startup
+LAZY_MODULES = ("openai", "requests", "pandas", "PIL.Image")
+
+COLD_START = r"""
+import os, sys, time, json, logging
+start = time.perf_counter()
+import streamlit
+imported = time.perf_counter()
+logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").setLevel(logging.ERROR)
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(sys.argv[1], default_timeout=120)
+ran = time.perf_counter()
+at.run()
+done = time.perf_counter()
+print("STARTUP", json.dumps({"streamlit_ms": (imported - start) * 1000, "first_run_ms": (done - ran) * 1000,
+                  "exceptions": [str(e.value) for e in at.exception],
+                  "loaded": [m for m in sys.argv[2:] if m in sys.modules]}))
+"""
+
+
+def _run(code, *argv, flags=(), env=None, cwd=HERE):
+    return subprocess.run([sys.executable, *flags, "-c", code, *argv], cwd=cwd, env=env,
+                          capture_output=True, text=True, check=True)
+
+
+def importtime_report(top):
+    """Import time (ms) per top-level package, for what the app modules import on top of Streamlit"""
+    # Streamlit is imported first, so only what the app adds on top of it is listed
+    out = _run(f"import streamlit; {APP_MODULES}", flags=("-X", "importtime")).stderr
+    started = False
+    packages = {}
+    for line in out.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            continue  # header
+        if name.strip() == "streamlit" and not name.startswith("  "):
+            started = True  # listed after all of its own imports
+            continue
+        if started:
+            package = name.strip().split(".")[0]
+            packages[package] = packages.get(package, 0) + int(self_us) / 1000
+    total = sum(packages.values())
+    print(f"\n📦 Imports added by `{APP_MODULES}` on top of Streamlit: {total:.0f} ms")
+    for name, ms in sorted(packages.items(), key=lambda p: -p[1])[:top]:
+        print(f"   {ms:>8.1f} ms  {name}")
+    return total
+
+
+def lazy_check():
+    """Heavy modules the app modules load at import time (should be none)"""
+    code = f"import sys, streamlit; {APP_MODULES}; print(' '.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    loaded = _run(code).stdout.split()
+    for module in LAZY_MODULES:
+        print(f"   {'❌ loaded at import' if module in loaded else '✅ lazy'}  {module}")
+    return not loaded
+
+
+def cold_start(runs):
+    """Fresh interpreter per run: Streamlit import + the first full run of app.py on an empty user DB"""
+    results = []
+    for _ in range(runs):
+        workdir = tempfile.mkdtemp(prefix="fv_startup_")
+        env = dict(os.environ, FOODVANTAGE_USER_DB=os.path.join(workdir, "user_data.db"))
+        env.pop("FOODVANTAGE_STORAGE_ADDRS", None)
+        # From the repo root like `streamlit run app.py`, so .streamlit/config.toml applies
+        out = _run(COLD_START, APP, *LAZY_MODULES, env=env, cwd=os.path.dirname(APP)).stdout
+        line = next(l for l in out.splitlines() if l.startswith("STARTUP "))  # the app prints its own log lines too
+        results.append(json.loads(line[len("STARTUP "):]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup import report and time budget")
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("FOODVANTAGE_STARTUP_BUDGET_MS", 1000)),
+                        help="Max median cold start (Streamlit import + first app run), ms")
+    parser.add_argument("--runs", type=int, default=3, help="Cold starts to take the median of")
+    parser.add_argument("--top", type=int, default=15, help="Imports to list")
+    args = parser.parse_args()
+
+    print("\n" + "=" * 70)
+    print("FOODVANTAGE STARTUP TIME")
+    print("=" * 70)
+    importtime_report(args.top)
+    print("\n💤 Deferred imports:")
+    lazy = lazy_check()
+
+    results = cold_start(args.runs)
+    streamlit_ms = statistics.median(r["streamlit_ms"] for r in results)
+    first_run_ms = statistics.median(r["first_run_ms"] for r in results)
+    total = statistics.median(r["streamlit_ms"] + r["first_run_ms"] for r in results)
+    errors = results[0]["exceptions"]
+    print(f"\n⏱️ Cold start, median of {args.runs}:")
+    print(f"   {streamlit_ms:>8.0f} ms  import streamlit")
+    print(f"   {first_run_ms:>8.0f} ms  first run of app.py (app imports + dashboard)")
+    print(f"   {total:>8.0f} ms  total, budget {args.budget_ms:.0f} ms")
+    print(f"   Loaded by the first run: {', '.join(results[0]['loaded']) or 'none of ' + ', '.join(LAZY_MODULES)}")
+    for e in errors:
+        print(f"   ❌ {e}")
+
+    ok = lazy and not errors and total <= args.budget_ms
+    print("=" * 70)
+    print("\nStartup within budget." if ok else "\n❌ Startup over budget or eager imports / errors above.")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Local multi-process test for the sharded user DB.
+Starts one storage service per shard in a scratch directory, drives it from several
+client processes (each like an app replica with concurrent sessions logging items and
+reading trends), then checks that every item landed in its user's shard and nowhere else,
+and that the most shards write at least --min-speedup times as fast as the fewest.
+
+Each session waits for every call, so one session per client measures round trips, not
+the services: a single-session client tops out at the same writes/s whatever the shard
+count. The sessions keep enough calls in flight to saturate one service, so extra shards
+show up as extra throughput. That needs a core per service and some for the clients; with
+fewer than 2 cores per shard the speedup is printed but not checked.
+
+Usage:
+    cd FoodVantage/src
+    python test_storage.py                     # 1 shard vs 4 shards, 4 clients × 8 sessions
+    python test_storage.py --shards 1 2 4 8 --clients 8 --seconds 10
+    python test_storage.py --min-speedup 0     # correctness only
+"""
+import os
+import sys
+import time
+import shutil
+import signal
+import argparse
+import logging
+import tempfile
+import subprocess
+import multiprocessing
+from datetime import date
+
+ITEMS = [("Apple", 1.2), ("Greek Yogurt", 2.1), ("Granola", 5.4), ("Cola", 8.9), ("Lentil Soup", 1.8)]
+
+
+def _env(workdir, shards, port):
+    return dict(os.environ, FOODVANTAGE_USER_DB=os.path.join(workdir, "user_data.db"),
+                FOODVANTAGE_USER_SHARDS=str(shards), FOODVANTAGE_STORAGE_BASE_PORT=str(port),
+                FOODVANTAGE_STORAGE_ADDRS=",".join(f"127.0.0.1:{port + i}" for i in range(shards)))
+
+
+def client(env, worker, users, threads, seconds, ready, go, results):
+    """
+    One app replica: `threads` sessions, each logging an item for a user, then reading
+    that user's trend and day view. Every call is a blocking round trip, so a single
+    session measures latency, not the services' capacity: the sessions keep several
+    calls in flight per replica, like concurrent users of one app.
+    """
+    import threading
+    os.environ.update(env)
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    logging.disable(logging.WARNING)  # the per-call log lines would drown the results
+    import gemini_api
+
+    ready.put(worker)
+    go.wait()  # the clock starts once every replica has imported the app
+    today = date.today().isoformat()
+    started = time.monotonic()
+    deadline = started + seconds
+    totals = [[0, 0, {}] for _ in range(threads)]
+
+    def session(t):
+        writes, reads, sent = totals[t]
+        i = 0
+        while time.monotonic() < deadline:
+            user = f"load{worker}_{t}_{i % users}"
+            name, score = ITEMS[i % len(ITEMS)]
+            gemini_api.add_calendar_item_db(user, today, name, score)
+            sent[user] = sent.get(user, 0) + 1
+            writes += 1
+            gemini_api.get_trend_data_db(user, 7)
+            gemini_api.get_calendar_items_db(user, today)
+            reads += 2
+            i += 1
+        totals[t][:2] = writes, reads
+
+    sessions = [threading.Thread(target=session, args=(t,)) for t in range(threads)]
+    for s in sessions:
+        s.start()
+    for s in sessions:
+        s.join()
+    elapsed = time.monotonic() - started
+    sent = {user: n for _, _, users_sent in totals for user, n in users_sent.items()}
+    counts = {user: gemini_api.count_calendar_items_db(user) for user in sent}
+    results.put((sum(t[0] for t in totals), sum(t[1] for t in totals), sent, counts, elapsed))
+
+
+def wait_for_services(env, shards, timeout=60):
+    from multiprocessing.connection import Client
+    from storage_service import STORAGE_AUTHKEY
+    port = int(env["FOODVANTAGE_STORAGE_BASE_PORT"])
+    deadline = time.monotonic() + timeout
+    for i in range(shards):
+        while True:
+            try:
+                Client(("127.0.0.1", port + i), authkey=STORAGE_AUTHKEY).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Storage shard {i} did not start")
+                time.sleep(0.2)
+
+
+def run(shards, clients, threads, seconds, users, port):
+    from user_shards import shard_for, shard_paths
+    import duckdb
+
+    workdir = tempfile.mkdtemp(prefix=f"fv_shards{shards}_")
+    env = _env(workdir, shards, port)
+    service_env = {k: v for k, v in env.items() if k != "FOODVANTAGE_STORAGE_ADDRS"}
+    here = os.path.dirname(os.path.abspath(__file__))
+    services = [subprocess.Popen([sys.executable, os.path.join(here, "storage_service.py"), "--shard", str(i)],
+                                 env=service_env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                for i in range(shards)]
+    try:
+        wait_for_services(env, shards)
+        ready, go, results = multiprocessing.Queue(), multiprocessing.Event(), multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=client, args=(env, w, users, threads, seconds, ready, go, results))
+                 for w in range(clients)]
+        for p in procs:
+            p.start()
+        for _ in procs:
+            ready.get(timeout=120)
+        go.set()
+        outcomes = [results.get(timeout=seconds + 120) for _ in procs]
+        for p in procs:
+            p.join()
+    finally:
+        for s in services:
+            s.send_signal(signal.SIGINT)  # lets the service checkpoint on exit
+        for s in services:
+            s.wait(timeout=30)
+
+    writes = sum(o[0] for o in outcomes)
+    reads = sum(o[1] for o in outcomes)
+    elapsed = max(o[4] for o in outcomes)  # the load itself, not startup or the checks below
+    sent = {u: n for o in outcomes for u, n in o[2].items()}
+    served = {u: n for o in outcomes for u, n in o[3].items()}
+
+    # Every user's items are in exactly their own shard
+    misplaced, stored = 0, {}
+    for i, path in enumerate(shard_paths(env["FOODVANTAGE_USER_DB"], shards)):
+        con = duckdb.connect(path, read_only=True)
+        for user, n in con.execute("SELECT username, COUNT(*) FROM calendar GROUP BY username").fetchall():
+            stored[user] = stored.get(user, 0) + n
+            misplaced += shard_for(user, shards) != i
+        con.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+    ok = stored == sent and served == sent and not misplaced
+    print(f"{shards:>6} {clients:>7} {writes / elapsed:>10.0f} {reads / elapsed:>10.0f} {writes:>8} "
+          f"{'✅' if ok else '❌'} {'' if ok else f'(stored {sum(stored.values())}, misplaced users {misplaced})'}")
+    return ok, writes / elapsed
+
+
+def main():
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description="Sharded storage multi-process test")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--clients", type=int, default=4, help="Client processes (app replicas)")
+    parser.add_argument("--threads", type=int, default=8, help="Concurrent sessions per client process")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--users", type=int, default=50, help="Users per session")
+    parser.add_argument("--port", type=int, default=7600)
+    parser.add_argument("--min-speedup", type=float, default=1.5,
+                        help="Required writes/s of the most shards over the fewest")
+    args = parser.parse_args()
+
+    print("\n" + "=" * 70)
+    print("FOODVANTAGE SHARDED STORAGE TEST")
+    print(f"{args.clients} client processes × {args.threads} sessions × {args.users} users, "
+          f"{args.seconds:.0f}s per run")
+    print("=" * 70)
+    print(f"{'shards':>6} {'clients':>7} {'writes/s':>10} {'reads/s':>10} {'writes':>8}")
+    runs = {n: run(n, args.clients, args.threads, args.seconds, args.users, args.port + 100 * k)
+            for k, n in enumerate(args.shards)}
+    print("=" * 70)
+    ok = all(stored for stored, _ in runs.values())
+    print("\nAll items stored once, in their user's shard." if ok else "\n❌ Mismatch between written and stored items.")
+
+    # Shards only scale writes when each service gets its own core (and the clients have some left)
+    fewest, most = min(runs), max(runs)
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    if most > fewest:
+        speedup = runs[most][1] / runs[fewest][1]
+        line = f"{most} shards vs {fewest}: {speedup:.2f}× writes/s (need {args.min_speedup:.2f}×)"
+        if cores < 2 * most:
+            print(f"⚠️  {line}, not checked: {cores} core(s), {2 * most} needed for {most} services and their clients")
+        elif speedup < args.min_speedup:
+            print(f"❌ {line}")
+            ok = False
+        else:
+            print(f"✅ {line}")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
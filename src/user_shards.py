@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+User-partitioned storage: which DuckDB file holds which user, and moving users
+when the number of shards changes.
+
+Each username is hashed (crc32) onto one of N shards with jump consistent
+hashing, so going from N to N+1 shards only moves about 1/(N+1) of the users.
+Shard 0 keeps the original paths; shard i adds ".i" before the extension:
+
+    user_data.db, user_data.1.db, user_data.2.db ...
+    calendar_archive, calendar_archive.1, calendar_archive.2 ...
+
+Usage:
+    python src/user_shards.py status --shards 4
+    python src/user_shards.py rebalance --from-shards 1 --to-shards 4
+
+Rebalancing is offline: stop the app and any storage services first. It is safe
+to re-run after an interruption (copied rows are de-duplicated on import).
+"""
+import os
+import sys
+import glob
+import time
+import zlib
+import argparse
+import logging
+import tempfile
+
+
+def jump_hash(key, buckets):
+    """Jump consistent hash (Lamping & Veach): bucket in [0, buckets) for an integer key"""
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def shard_for(username, shards):
+    """Shard index for a username; stable across processes and Python versions"""
+    if shards <= 1:
+        return 0
+    return jump_hash(zlib.crc32(str(username).encode("utf-8")), shards)
+
+
+def shard_path(base_path, shard):
+    """base_path for shard 0, otherwise base_path with '.<shard>' before the extension"""
+    if shard == 0:
+        return base_path
+    root, ext = os.path.splitext(base_path)
+    return f"{root}.{shard}{ext}"
+
+
+def shard_paths(base_path, shards):
+    return [shard_path(base_path, i) for i in range(max(1, shards))]
+
+
+def _shard_users(con):
+    """Every username with data in an open shard (users, calendar incl. archive, rollup, insights)"""
+    return [r[0] for r in con.execute("""
+        SELECT username FROM users
+        UNION SELECT DISTINCT username FROM calendar_all
+        UNION SELECT username FROM daily_rollup
+        UNION SELECT username FROM coach_insights
+    """).fetchall()]
+
+
+def _in_transaction(con, fn):
+    con.execute("BEGIN TRANSACTION")
+    try:
+        result = fn()
+        con.execute("COMMIT")
+        return result
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+
+
+def _remove_from_archive(con, archive_dir, usernames):
+    """Rewrites the archive files that hold any of these users' rows without them. Returns files rewritten."""
+    rewritten = 0
+    for path in glob.glob(os.path.join(archive_dir, "year=*", "month=*", "*.parquet")):
+        quoted = path.replace("'", "''")
+        hits = con.execute(f"SELECT COUNT(*) FROM read_parquet('{quoted}') WHERE username IN (SELECT unnest(?::VARCHAR[]))",
+                           [usernames]).fetchone()[0]
+        if not hits:
+            continue
+        tmp = path + ".tmp"
+        kept = con.execute(f"""
+            COPY (SELECT * FROM read_parquet('{quoted}') WHERE username NOT IN (SELECT unnest(?::VARCHAR[])))
+            TO '{tmp.replace("'", "''")}' (FORMAT PARQUET, COMPRESSION ZSTD)
+        """, [usernames]).fetchone()[0]
+        if kept:
+            os.replace(tmp, path)
+        else:
+            os.remove(tmp)
+            os.remove(path)
+        rewritten += 1
+    return rewritten
+
+
+def rebalance(db_path, archive_dir, from_shards, to_shards, log=print):
+    """
+    Moves every user whose shard differs between the two layouts into its new shard.
+
+    Per source shard: the movers' rows (hot and archived) are copied into each target
+    with calendar_io.import_calendar, which skips rows the target already has, along
+    with their users and coach_insights rows; then they are deleted from the source and
+    the source archive files are rewritten without them. Copied rows land in the
+    target's hot table and are re-archived by its next archive pass.
+
+    Returns:
+        {"users": moved users, "rows": calendar rows inserted into targets}
+    """
+    import duckdb
+    from gemini_api import init_user_db
+    from calendar_io import export_calendar, import_calendar
+    from calendar_archive import create_calendar_view
+
+    connections = {}
+
+    def shard_db(i):
+        if i not in connections:
+            os.makedirs(os.path.dirname(os.path.abspath(shard_path(db_path, i))), exist_ok=True)
+            connections[i] = init_user_db(duckdb.connect(shard_path(db_path, i)), archive_dir=shard_path(archive_dir, i))
+        return connections[i]
+
+    moved_users, moved_rows = 0, 0
+    try:
+        for source in range(max(from_shards, to_shards)):
+            if not os.path.exists(shard_path(db_path, source)):
+                continue
+            con = shard_db(source)
+            targets = {}
+            for user in _shard_users(con):
+                target = shard_for(user, to_shards)
+                if target != source:
+                    targets.setdefault(target, []).append(user)
+            if not targets:
+                continue
+            start = time.perf_counter()
+            movers = [u for users in targets.values() for u in users]
+            for target, users in sorted(targets.items()):
+                fd, tmp = tempfile.mkstemp(suffix=".parquet")
+                os.close(fd)
+                try:
+                    export_calendar(con, tmp, usernames=users)
+                    accounts = con.execute("SELECT * FROM users WHERE username IN (SELECT unnest(?::VARCHAR[]))", [users]).fetchall()
+                    insights = con.execute("SELECT * FROM coach_insights WHERE username IN (SELECT unnest(?::VARCHAR[]))", [users]).fetchall()
+                    dest = shard_db(target)
+
+                    def copy():
+                        stats = import_calendar(dest, tmp, fmt="parquet")
+                        if accounts:
+                            dest.executemany("INSERT OR REPLACE INTO users VALUES (?, ?)", accounts)
+                        if insights:
+                            dest.executemany("INSERT OR REPLACE INTO coach_insights VALUES (?, ?, ?, ?, ?)", insights)
+                        return stats
+
+                    stats = _in_transaction(dest, copy)
+                    moved_rows += stats["inserted"]
+                    log(f"  shard {source} → {target}: {len(users):,} users, {stats['inserted']:,} rows copied "
+                        f"({stats['duplicates']:,} already there)")
+                finally:
+                    os.remove(tmp)
+
+            def remove():
+                for table in ("calendar", "daily_rollup", "users", "coach_insights"):
+                    con.execute(f"DELETE FROM {table} WHERE username IN (SELECT unnest(?::VARCHAR[]))", [movers])
+
+            _in_transaction(con, remove)
+            files = _remove_from_archive(con, shard_path(archive_dir, source), movers)
+            create_calendar_view(con, shard_path(archive_dir, source))
+            con.execute("CHECKPOINT")
+            moved_users += len(movers)
+            log(f"✅ shard {source}: moved {len(movers):,} users out, {files} archive files rewritten "
+                f"in {time.perf_counter() - start:.2f}s")
+        for i in list(connections):
+            connections[i].execute("CHECKPOINT")
+    finally:
+        for con in connections.values():
+            con.close()
+    return {"users": moved_users, "rows": moved_rows}
+
+
+def cmd_status(args):
+    import duckdb
+    total = 0
+    for i, path in enumerate(shard_paths(args.db, args.shards)):
+        if not os.path.exists(path):
+            print(f"  shard {i}: {path} (missing)")
+            continue
+        con = duckdb.connect(path, read_only=True)
+        try:
+            users = con.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+            rows = con.execute("SELECT COALESCE(SUM(count), 0) FROM daily_rollup").fetchone()[0]
+            misplaced = sum(1 for (u,) in con.execute("SELECT DISTINCT username FROM daily_rollup").fetchall()
+                            if shard_for(u, args.shards) != i)
+        finally:
+            con.close()
+        total += rows
+        print(f"  shard {i}: {path}  {users:>8,} users  {rows:>12,} items  {os.path.getsize(path) / 1e6:>8.1f} MB"
+              + (f"  ⚠️ {misplaced:,} users belong elsewhere (rebalance)" if misplaced else ""))
+    print(f"  total: {total:,} items")
+
+
+def cmd_rebalance(args):
+    start = time.perf_counter()
+    print(f"🔀 Rebalancing {args.db}: {args.from_shards} → {args.to_shards} shards")
+    result = rebalance(args.db, args.archive_dir, args.from_shards, args.to_shards)
+    print(f"✅ Moved {result['users']:,} users ({result['rows']:,} rows) in {time.perf_counter() - start:.2f}s")
+    if result["users"]:
+        print("   DuckDB files don't shrink in place: run `db_admin.py --shard N compact` on the shards users left")
+    for i in range(args.to_shards, args.from_shards):
+        print(f"   Shard {i} is empty now: {shard_path(args.db, i)} and {shard_path(args.archive_dir, i)} can be removed")
+    print(f"   Start the app / storage services with FOODVANTAGE_USER_SHARDS={args.to_shards}")
+
+
+def main():
+    sys.path.append(os.path.dirname(__file__))
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").setLevel(logging.ERROR)
+    from gemini_api import USER_DB_PATH, ARCHIVE_DIR, USER_DB_SHARDS
+
+    parser = argparse.ArgumentParser(description="FoodVantage user DB shards")
+    parser.add_argument("--db", default=USER_DB_PATH, help=f"Shard 0 path (default {USER_DB_PATH})")
+    parser.add_argument("--archive-dir", default=ARCHIVE_DIR, help=f"Shard 0 archive directory (default {ARCHIVE_DIR})")
+    sub = parser.add_subparsers(dest="command", required=True)
+    status = sub.add_parser("status", help="Users, items and size per shard")
+    status.add_argument("--shards", type=int, default=USER_DB_SHARDS)
+    move = sub.add_parser("rebalance", help="Move users to their shard under a new shard count")
+    move.add_argument("--from-shards", type=int, required=True)
+    move.add_argument("--to-shards", type=int, required=True)
+    args = parser.parse_args()
+    {"status": cmd_status, "rebalance": cmd_rebalance}[args.command](args)
+
+
+if __name__ == "__main__":
+    main()